@@ -1,229 +1,774 @@
 # chip8.py
 #
-#  This is an attempt to create a CHIP8 interpreter in circuitpython
-#  for the RP2040 on the Adafruit Macropad
+#  This is the CHIP8 interpreter core.  It holds the complete machine state
+#  (memory, registers, I, stack, timers and framebuffer) and runs the
+#  fetch/decode/execute loop without touching any hardware, so the same code
+#  runs on the macropad under circuitpython and under CPython on a PC
 #
-#  It is a project to learn circuitpython and the RP2040 
+#  code.py is the macropad front end that drives this core
 #
 #  Started - 7/18/2024
 #
 
 # Imports
 #
-import time
-import board
-import displayio
+import array
+import chip8_tools
 
-# Initializations
+# Display size of the CHIP8
+WIDTH = 64
+HEIGHT = 32
 
-# Setup Display on macropad
-#
-display = board.DISPLAY
-
-# Create bitmap with 2 colors
-bitmap = displayio.Bitmap(display.width, display.height, 2)
-
-# Create a two color palette
-palette = displayio.Palette(2)
-palette[0] = 0x000000
-palette[1] = 0xffffff
+# All rows changed - used for the dirty row mask after a CLS
+ALL_ROWS = (1 << HEIGHT) - 1
 
-# Create a TileGrid using the Bitmap and Palette
-tile_grid = displayio.TileGrid(bitmap, pixel_shader=palette)
+# All pixels of a framebuffer row
+ROW_MASK = (1 << WIDTH) - 1
 
-# Create a Group
-group = displayio.Group()
+# Return addresses the stack holds, a 17th nested CALL stops the machine
+STACK_DEPTH = 16
 
-# Add the TileGrid to the Group
-group.append(tile_grid)
+# Memory is cleared this many zero bytes at a time so a reset doesn't
+# allocate
+_ZEROS = bytes(256)
 
-# Add the Group to the Display
-display.root_group = group
-
-
-# Memory - The CHIP8 has 4K (4096) bytes of RAM
-#          Implement this as a list with 4096 elements initialized to zeros
-#
-memory = [0] * 4096
-
-# Font - Use typical font and load starting at memory location 0x50
-memory[0x50] = 0xF0
-memory[0x51] = 0x90
-memory[0x52] = 0x90
-memory[0x53] = 0x90
-memory[0x54] = 0xF0
-
-memory[0x55] = 0x20
-memory[0x56] = 0x60
-memory[0x57] = 0x20
-memory[0x58] = 0x20
-memory[0x59] = 0x70
-
-memory[0x5A] = 0xF0
-memory[0x5B] = 0x10
-memory[0x5C] = 0xF0
-memory[0x5D] = 0x80
-memory[0x5E] = 0xF0
-
-memory[0x5F] = 0xF0
-memory[0x60] = 0x10
-memory[0x61] = 0xF0
-memory[0x62] = 0x10
-memory[0x63] = 0xF0
-
-memory[0x64] = 0x90
-memory[0x65] = 0x90
-memory[0x66] = 0xF0
-memory[0x67] = 0x10
-memory[0x68] = 0x10
-
-memory[0x69] = 0xF0
-memory[0x6A] = 0x80
-memory[0x6B] = 0xF0
-memory[0x6C] = 0x10
-memory[0x6D] = 0xF0
-
-memory[0x6E] = 0xF0
-memory[0x6F] = 0x80
-memory[0x70] = 0xF0
-memory[0x71] = 0x90
-memory[0x72] = 0xF0
-
-memory[0x73] = 0xF0
-memory[0x74] = 0x10
-memory[0x75] = 0x20
-memory[0x76] = 0x40
-memory[0x77] = 0x40
-
-memory[0x78] = 0xF0
-memory[0x79] = 0x90
-memory[0x7A] = 0xF0
-memory[0x7B] = 0x90
-memory[0x7C] = 0xF0
-
-memory[0x7D] = 0xF0
-memory[0x7E] = 0x90
-memory[0x7F] = 0xF0
-memory[0x80] = 0x10
-memory[0x81] = 0xF0
-
-memory[0x82] = 0xF0
-memory[0x83] = 0x90
-memory[0x84] = 0xF0
-memory[0x85] = 0x90
-memory[0x86] = 0x90
-
-memory[0x87] = 0xE0
-memory[0x88] = 0x90
-memory[0x89] = 0xE0
-memory[0x8A] = 0x90
-memory[0x8B] = 0xE0
-
-memory[0x8C] = 0xF0
-memory[0x8D] = 0x80
-memory[0x8E] = 0x80
-memory[0x8F] = 0x80
-memory[0x90] = 0xF0
-
-memory[0x91] = 0xE0
-memory[0x92] = 0x90
-memory[0x93] = 0x90
-memory[0x94] = 0x90
-memory[0x95] = 0xE0
-
-memory[0x96] = 0xF0
-memory[0x97] = 0x80
-memory[0x98] = 0xF0
-memory[0x99] = 0x80
-memory[0x9A] = 0xF0
-
-memory[0x9B] = 0xF0
-memory[0x9C] = 0x80
-memory[0x9D] = 0xF0
-memory[0x9E] = 0x80
-memory[0x9F] = 0x80
-
-# Stack - Make it unlimited for now
-stack = []
-
-# Timers
-delay_timer = 60
-sound_timer = 60
-
-# Registers
-#    sixteen 8 bit registers V0-VF
-#    sixteen bit index register
-#    Stack Pointer
-regs = [0] * 16
-index_reg = 0
-
-# Program counter - initialize to 0x200
-pc = 0x200
-
-# Function definitions
+# Behaviour that differs between CHIP8 variants.  Without any of them the
+# core behaves as it always has (SUPER-CHIP style shifts, loads and
+# stores, clipped sprites and CHIP8 style JP V0):
 #
-def read_rom(romname = "IBM Logo.ch8", startaddr=0x200):
-    # Function to read a rom into memory starting at address 0x200
+#   shift   8xy6 / 8xyE shift Vy into Vx (COSMAC VIP)
+#   memory  Fx55 / Fx65 leave I pointing after the last register (COSMAC VIP)
+#   wrap    DRW wraps sprites round the screen edges instead of clipping
+#   jump    Bxnn jumps to Vx + xnn (SUPER-CHIP)
+QUIRKS = ("shift", "memory", "wrap", "jump")
+
+# State the random number generator starts from when a seed folds to zero,
+# which xorshift can't leave
+_RNG_ZERO_SEED = 0xACE1
+
+
+def rng_state(seed):
+    """ The 16 bit random number generator state seed starts from, see
+    Chip8.seed().  Any int seed will do, the halves of a 32 bit one are
+    folded together
+    """
+
+    state = (seed ^ (seed >> 16)) & 0xFFFF
+    return state or _RNG_ZERO_SEED
+
+
+class Idle(Exception):
+    """ Raised by a handler that has found the ROM spinning in a loop that
+    can't end before the next timer tick or key press.  The pc is left at
+    the start of the loop and args[0] is the loop length in instructions
+    """
+
+
+class Chip8:
+    """ A headless CHIP8 machine
+
+    Load a ROM with load_rom() and then call run_cycles(n) or run_frame() to
+    execute a batch of instructions.  The framebuffer is a list of 32 rows,
+    each a 64 bit integer with the leftmost pixel in the top bit, and
+    dirty_rows is a bitmask of the rows changed since the front end last
+    cleared it.
+    """
+
+    def __init__(self, cycles_per_frame=15, quirks=()):
+        # Memory - The CHIP8 has 4K (4096) bytes of RAM
+        self.memory = bytearray(4096)
+
+        # Framebuffer - one 64 bit integer per row, bit 63 is x = 0
+        self.framebuffer = [0] * HEIGHT
+
+        # Decoded instruction cache - one entry per address holding the
+        # handler and the decoded fields, None if not decoded yet
+        self._decoded = [None] * 4096
+
+        # Registers
+        #    sixteen 8 bit registers V0-VF, a bytearray so a value that
+        #    isn't masked to 8 bits raises instead of being stored
+        #    sixteen bit index register
+        self.regs = bytearray(16)
+
+        # Stack - STACK_DEPTH return addresses, sp is the number in use.
+        # CALL with the stack full or RET with it empty raises IndexError
+        self.stack = array.array("H", [0] * STACK_DEPTH)
+        self.sp = 0
+
+        # Random number generator for RND - 16 bit xorshift state, see
+        # random_byte().  It keeps running through reset() so each ROM
+        # gets new numbers, seed() starts it somewhere known
+        self.rng = rng_state(0)
+
+        # Number of instructions run_frame() executes between timer ticks.
+        # 15 per frame is 900 instructions per second at 60Hz
+        self.cycles_per_frame = cycles_per_frame
+
+        # Dispatch tables, filled in by set_quirks() - see _build_tables
+        self._primary = [None] * 16
+        self._sys_table = [None] * 256
+        self._alu_table = [None] * 16
+        self._key_table = [None] * 256
+        self._misc_table = [None] * 256
+        self.quirks = None
+
+        self.set_quirks(quirks)
+        self.reset()
+
+    def reset(self):
+        """ Put the machine back to its power on state with the font loaded
+
+        Memory, framebuffer, registers and stack are cleared in place so a
+        machine can be reused for the next ROM without allocating
+        """
+
+        memory = self.memory
+        for addr in range(0, len(memory), len(_ZEROS)):
+            memory[addr:addr + len(_ZEROS)] = _ZEROS
+        chip8_tools.load_font(memory)
+        self._invalidate(0, len(memory) - 1)
+
+        for row in range(HEIGHT):
+            self.framebuffer[row] = 0
+        self.dirty_rows = ALL_ROWS
+
+        for entry in range(STACK_DEPTH):
+            self.stack[entry] = 0
+        self.sp = 0
+
+        # Timers
+        self.delay_timer = 0
+        self.sound_timer = 0
+
+        for reg in range(16):
+            self.regs[reg] = 0
+        self.index_reg = 0
+
+        # Program counter - initialize to 0x200 since that is where most ROMS load
+        self.pc = 0x200
+        self.end_addr = 0xFFF
+        self.rom_info = None
+
+        # Keyboard state - set by the front end once per frame.  Bit n of
+        # keys is set while key n is down, bit n of keys_released is set
+        # for the frame after key n went up
+        self.keys = 0
+        self.keys_released = 0
+
+        # Count of instructions executed since reset, of those skipped over
+        # in idle loops and of unknown opcodes
+        self.cycles = 0
+        self.idle_cycles = 0
+        self.traps = 0
+        self.last_trap = None
+
+    def load_rom(self, rom, start_addr=0x200):
+        """ Load a ROM into memory and point the pc at it
+
+        rom is a filename or a bytes like object, see chip8_tools.load_rom.
+        Returns the end address of the ROM, the full chip8_tools.RomInfo is
+        kept in rom_info
+        """
+
+        self.rom_info = chip8_tools.load_rom(self.memory, rom, start_addr)
+        self.end_addr = self.rom_info.end_addr
+        self.pc = start_addr
+
+        # Decode the whole ROM up front so the main loop never has to
+        self._invalidate(start_addr - 1, self.end_addr)
+        for addr in range(start_addr, self.end_addr, 2):
+            self._decode(addr)
+        return self.end_addr
+
+    def set_keys(self, keys):
+        """ Set the 16 bit mask of keys that are down, bit n for key n.
+        Called once per frame with the whole keypad (see chip8_input.py)
+        """
+
+        self.keys_released |= self.keys & ~keys
+        self.keys = keys
+
+    def seed(self, seed):
+        """ Start the random number generator from seed, so RND gives the
+        same numbers on any python.  The state it is in is kept in rng,
+        which save states and recordings store
+        """
+
+        self.rng = rng_state(seed)
+
+    def random_byte(self):
+        """ The next random byte for RND
+
+        A 16 bit xorshift (7, 9, 8), period 65535.  The state never leaves
+        small ints so it doesn't allocate under circuitpython, and it is
+        the same generator everywhere, unlike the random module
+        """
+
+        rng = self.rng
+        rng ^= (rng << 7) & 0xFFFF
+        rng ^= rng >> 9
+        rng ^= (rng << 8) & 0xFFFF
+        self.rng = rng
+        return rng & 0xFF
+
+    def set_quirks(self, quirks):
+        """ Switch on the quirks named in quirks (see QUIRKS), off the rest
+
+        The dispatch tables are rebuilt with the handlers for those quirks
+        and the decoded instructions dropped, so the handlers never test a
+        quirk themselves
+        """
+
+        for quirk in quirks:
+            if quirk not in QUIRKS:
+                raise ValueError("unknown quirk: %r" % (quirk,))
+        quirks = tuple(quirk for quirk in QUIRKS if quirk in quirks)
+        if quirks == self.quirks:
+            # Nothing to rebuild, starting each ROM with its quirks
+            # doesn't cost anything when they're the same as before
+            return
+        self.quirks = quirks
+        self._build_tables()
+        self._invalidate(0, len(self.memory) - 1)
+
+    def press_key(self, key):
+        """ A CHIP8 key (0-F) went down """
+
+        self.keys |= 1 << key
+
+    def release_key(self, key):
+        """ A CHIP8 key went up.  Returns True if it was down """
+
+        bit = 1 << key
+        if not self.keys & bit:
+            return False
+        self.keys &= ~bit
+        self.keys_released |= bit
+        return True
+
+    @property
+    def running(self):
+        # Stop if for some reason the pc goes beyond the end of the loaded
+        # ROM. This shouldn't happen but check anyway
+        return self.pc <= self.end_addr
+
+    def tick_timers(self):
+        """ Decrement the timers, called at 60Hz.  Key releases are only
+        seen by LD Vx, K in the frame they happen
+        """
+
+        if self.delay_timer > 0:
+            self.delay_timer -= 1
+        if self.sound_timer > 0:
+            self.sound_timer -= 1
+        self.keys_released = 0
+
+    def run_frame(self):
+        """ Run one 60Hz frame - cycles_per_frame instructions then a timer tick """
+
+        executed = self.run_cycles(self.cycles_per_frame)
+        self.tick_timers()
+        return executed
+
+    def run_cycles(self, n):
+        """ Execute up to n instructions, returns the number executed """
+
+        decoded = self._decoded
+        decode = self._decode
+        end_addr = self.end_addr
+        executed = 0
+        try:
+            while executed < n:
+                # Fetch the decoded instruction at PC and increment the
+                # program counter
+                pc = self.pc
+                if pc > end_addr:
+                    break
+                entry = decoded[pc]
+                if entry is None:
+                    entry = decode(pc)
+                self.pc = pc + 2
+
+                handler, x, y, nib, nn, nnn = entry
+                handler(x, y, nib, nn, nnn)
+                executed += 1
+        except Idle as idle:
+            # Nothing the loop looks at can change until the next timer tick
+            # or key press, so account for the rest of the budget going
+            # round the loop instead of running it
+            remaining = n - executed
+            self.pc += 2 * (remaining % idle.args[0])
+            self.idle_cycles += remaining - 1
+            executed = n
+        self.cycles += executed
+        return executed
+
+    def step(self):
+        """ Fetch, decode and execute a single instruction """
+
+        return self.run_cycles(1)
+
+    #*********************************************
     #
-    with open(romname, "rb") as f:
-        while (byte := f.read(1)):
-            memory[startaddr] = list(byte)[0]
-            startaddr += 1
-    return startaddr -1
-
-# Read in ROM file into memory at 0x200
-end_addr = read_rom("IBM Logo.ch8", 0x200)
-print("end address: %#x" % end_addr)
-
-# Main loop
-#   Fetch/decode/execute
-#
-
-# Simply cycle through memory and echo 
-while pc <= end_addr:
-
-# Fetch instruction at PC
-
-    inst_high = memory[pc]
-    inst_low = memory[pc + 1]
-
-# Increment the program counter
-    pc = pc + 2
-
-# Break out instruction values here to use later
-    inst_type = (inst_high & 0xF0) >> 4        # First nibble
-    inst_X = inst_high & 0x0F                  # Second nibble
-    inst_Y = (inst_low & 0xF0) >> 4            # Third Nibble
-    inst_N = inst_low & 0x0F                   # Fourth Nibble
-    inst_NN = inst_low                         # Third & Fourth Nibbles
-    inst_NNN = (inst_X << 8) + inst_low        # Second, Third Fouth nibbles
-
-    # Decode instruction type - For now echo instruction
-    if inst_type == 0:
-        if inst_Y == 0xE:
-            print("%#x    CLS" % (pc-2))
+    # Opcode dispatch
+    #
+    # Every handler takes the decoded fields of the instruction
+    #   x   - second nibble          y   - third nibble
+    #   n   - fourth nibble          nn  - low byte
+    #   nnn - low 12 bits
+    # and is called with the pc already pointing at the next instruction.
+    #
+    # The first nibble indexes the 16 entry primary table.  The 0x0, 0x8,
+    # 0xE and 0xF groups index a secondary table, anything not in a table
+    # ends up in _op_trap.
+    #
+    # Instructions are decoded once into the _decoded cache, the grouped
+    # opcodes resolved straight to their final handler.  The only
+    # instructions that write memory (Fx33 and Fx55) drop the cache entries
+    # they overwrite so self modifying ROMs still work
+    #
+    # Handlers for the quirks (see QUIRKS) are chosen when the tables are
+    # built, quirks only cost anything when set_quirks() is called.
+    #
+    # Two idle patterns get their own handlers when decoded: Fx0A and the
+    # LD Vx, DT / SE Vx, 0 / JP back delay loop.  While they would just
+    # spin they raise Idle and run_cycles skips to the end of its budget,
+    # leaving the machine exactly as running the loop would have
+
+    def _build_tables(self):
+        """ Fill the primary and secondary dispatch tables for the quirks
+        set.  The table lists are made once in __init__ and refilled in
+        place, which is also where the profiler swaps its wrappers in
+        """
+
+        trap = self._op_trap
+        quirks = self.quirks
+
+        # 00E0 / 00EE - indexed by the low byte
+        table = self._sys_table
+        for op in range(256):
+            table[op] = trap
+        table[0xE0] = self._op_cls
+        table[0xEE] = self._op_ret
+
+        # 8xyN - indexed by the last nibble
+        table = self._alu_table
+        for op in range(16):
+            table[op] = trap
+        table[0x0] = self._op_ld_vx_vy
+        table[0x1] = self._op_or
+        table[0x2] = self._op_and
+        table[0x3] = self._op_xor
+        table[0x4] = self._op_add_vx_vy
+        table[0x5] = self._op_sub
+        table[0x6] = self._op_shr_vy if "shift" in quirks else self._op_shr
+        table[0x7] = self._op_subn
+        table[0xE] = self._op_shl_vy if "shift" in quirks else self._op_shl
+
+        # ExNN - indexed by the low byte
+        table = self._key_table
+        for op in range(256):
+            table[op] = trap
+        table[0x9E] = self._op_skp
+        table[0xA1] = self._op_sknp
+
+        # FxNN - indexed by the low byte
+        table = self._misc_table
+        for op in range(256):
+            table[op] = trap
+        table[0x07] = self._op_ld_vx_dt
+        table[0x0A] = self._op_ld_vx_k
+        table[0x15] = self._op_ld_dt_vx
+        table[0x18] = self._op_ld_st_vx
+        table[0x1E] = self._op_add_i_vx
+        table[0x29] = self._op_ld_f_vx
+        table[0x33] = self._op_ld_b_vx
+        if "memory" in quirks:
+            table[0x55] = self._op_ld_i_vx_inc
+            table[0x65] = self._op_ld_vx_i_inc
+        else:
+            table[0x55] = self._op_ld_i_vx
+            table[0x65] = self._op_ld_vx_i
+
+        # 0, 8, E and F go through the tables above and stay None
+        table = self._primary
+        table[0x1] = self._op_jp
+        table[0x2] = self._op_call
+        table[0x3] = self._op_se_vx_nn
+        table[0x4] = self._op_sne_vx_nn
+        table[0x5] = self._op_se_vx_vy
+        table[0x6] = self._op_ld_vx_nn
+        table[0x7] = self._op_add_vx_nn
+        table[0x9] = self._op_sne_vx_vy
+        table[0xA] = self._op_ld_i
+        table[0xB] = self._op_jp_vx if "jump" in quirks else self._op_jp_v0
+        table[0xC] = self._op_rnd
+        table[0xD] = self._op_drw_wrap if "wrap" in quirks else self._op_drw
+
+    def _decode(self, addr):
+        """ Decode the instruction at addr into the cache and return it """
+
+        memory = self.memory
+        inst_high = memory[addr]
+        inst_low = memory[addr + 1]
+
+        # Break out instruction values here to use later
+        inst_type = inst_high >> 4              # First nibble
+        inst_X = inst_high & 0x0F               # Second nibble
+        inst_Y = inst_low >> 4                  # Third Nibble
+        inst_N = inst_low & 0x0F                # Fourth Nibble
+        inst_NN = inst_low                      # Third & Fourth Nibbles
+        inst_NNN = (inst_X << 8) | inst_low     # Second, Third Fouth nibbles
+
+        # Resolve the grouped opcodes straight to their final handler
+        if inst_type == 0x0:
+            if inst_X == 0:
+                handler = self._sys_table[inst_NN]
+            else:
+                handler = self._op_trap
+        elif inst_type == 0x8:
+            handler = self._alu_table[inst_N]
+        elif inst_type == 0xE:
+            handler = self._key_table[inst_NN]
+        elif inst_type == 0xF:
+            if inst_NN == 0x0A:
+                handler = self._op_ld_vx_k_idle
+            elif inst_NN == 0x07 and self._is_delay_loop(addr, inst_X):
+                handler = self._op_ld_vx_dt_idle
+            else:
+                handler = self._misc_table[inst_NN]
+        else:
+            handler = self._primary[inst_type]
+
+        entry = (handler, inst_X, inst_Y, inst_N, inst_NN, inst_NNN)
+        self._decoded[addr] = entry
+        return entry
+
+    def _is_delay_loop(self, addr, x):
+        """ True if addr starts LD Vx, DT / SE Vx, 0 / JP addr """
+
+        memory = self.memory
+        return (addr + 5 < len(memory)
+                and memory[addr + 2] == 0x30 | x and memory[addr + 3] == 0
+                and memory[addr + 4] == 0x10 | (addr >> 8)
+                and memory[addr + 5] == addr & 0xFF)
+
+    def _invalidate(self, start_addr, end_addr):
+        """ Drop the decoded instructions overlapping start_addr..end_addr
+
+        An instruction is two bytes so the one starting just before
+        start_addr is dropped too
+        """
+
+        decoded = self._decoded
+        for addr in range(max(start_addr - 1, 0), min(end_addr, 4095) + 1):
+            decoded[addr] = None
+
+    def _op_trap(self, x, y, n, nn, nnn):
+        # Unknown or unsupported opcode - count it and carry on like the
+        # original interpreter did
+        pc = self.pc - 2
+        self.traps += 1
+        self.last_trap = (pc, (self.memory[pc] << 8) | self.memory[pc + 1])
+
+    # Flow control
+
+    def _op_cls(self, x, y, n, nn, nnn):           # CLS
+        # Clear screen
+        fb = self.framebuffer
+        for row in range(HEIGHT):
+            fb[row] = 0
+        self.dirty_rows = ALL_ROWS
+
+    def _op_ret(self, x, y, n, nn, nnn):           # RET
+        # Return from subroutine
+        sp = self.sp - 1
+        if sp < 0:
+            raise IndexError("stack underflow")
+        self.pc = self.stack[sp]
+        self.sp = sp
+
+    def _op_jp(self, x, y, n, nn, nnn):            # JP nnn
+        # Jump to location nnn
+        self.pc = nnn
+
+    def _op_call(self, x, y, n, nn, nnn):          # CALL nnn
+        # Call subroutine at nnn
+        sp = self.sp
+        if sp >= STACK_DEPTH:
+            raise IndexError("stack overflow")
+        self.stack[sp] = self.pc
+        self.sp = sp + 1
+        self.pc = nnn
+
+    def _op_se_vx_nn(self, x, y, n, nn, nnn):      # SE Vx, nn
+        # Skip next instruction if Vx == nn
+        if self.regs[x] == nn:
+            self.pc += 2
+
+    def _op_sne_vx_nn(self, x, y, n, nn, nnn):     # SNE Vx, nn
+        # Skip next instruction if Vx != nn
+        if self.regs[x] != nn:
+            self.pc += 2
+
+    def _op_se_vx_vy(self, x, y, n, nn, nnn):      # SE Vx, Vy
+        # Skip next instruction if Vx = Vy
+        if self.regs[x] == self.regs[y]:
+            self.pc += 2
+
+    def _op_sne_vx_vy(self, x, y, n, nn, nnn):     # SNE Vx, Vy
+        # Skip next instruction if Vx != Vy
+        if self.regs[x] != self.regs[y]:
+            self.pc += 2
+
+    def _op_jp_v0(self, x, y, n, nn, nnn):         # JP V0, addr
+        self.pc = self.regs[0] + nnn
+
+    def _op_jp_vx(self, x, y, n, nn, nnn):         # JP Vx, addr (jump quirk)
+        self.pc = self.regs[x] + nnn
+
+    # Registers and arithmetic
+
+    def _op_ld_vx_nn(self, x, y, n, nn, nnn):      # LD Vx, nn
+        # Set Vx = nn
+        self.regs[x] = nn
+
+    def _op_add_vx_nn(self, x, y, n, nn, nnn):     # ADD Vx, nn
+        # Set Vx = Vx + nn
+        regs = self.regs
+        regs[x] = (regs[x] + nn) & 0xFF
+
+    def _op_ld_vx_vy(self, x, y, n, nn, nnn):      # LD Vx, Vy
+        self.regs[x] = self.regs[y]
+
+    def _op_or(self, x, y, n, nn, nnn):            # OR Vx, Vy
+        self.regs[x] |= self.regs[y]
+
+    def _op_and(self, x, y, n, nn, nnn):           # AND Vx, Vy
+        self.regs[x] &= self.regs[y]
+
+    def _op_xor(self, x, y, n, nn, nnn):           # XOR Vx, Vy
+        self.regs[x] ^= self.regs[y]
+
+    def _op_add_vx_vy(self, x, y, n, nn, nnn):     # ADD Vx, Vy
+        regs = self.regs
+        result = regs[x] + regs[y]
+        regs[x] = result & 0xFF
+        regs[0xF] = 1 if result > 255 else 0
+
+    def _op_sub(self, x, y, n, nn, nnn):           # SUB Vx, Vy
+        regs = self.regs
+        flag = 1 if regs[x] > regs[y] else 0
+        regs[x] = (regs[x] - regs[y]) & 0xFF
+        regs[0xF] = flag
+
+    def _op_shr(self, x, y, n, nn, nnn):           # SHR Vx
+        regs = self.regs
+        flag = regs[x] & 0x1
+        regs[x] = regs[x] >> 1
+        regs[0xF] = flag
+
+    def _op_subn(self, x, y, n, nn, nnn):          # SUBN Vx, Vy
+        regs = self.regs
+        flag = 1 if regs[y] > regs[x] else 0
+        regs[x] = (regs[y] - regs[x]) & 0xFF
+        regs[0xF] = flag
+
+    def _op_shl(self, x, y, n, nn, nnn):           # SHL Vx
+        regs = self.regs
+        flag = (regs[x] & 0x80) >> 7
+        regs[x] = (regs[x] << 1) & 0xFF
+        regs[0xF] = flag
+
+    def _op_shr_vy(self, x, y, n, nn, nnn):        # SHR Vx, Vy (shift quirk)
+        regs = self.regs
+        flag = regs[y] & 0x1
+        regs[x] = regs[y] >> 1
+        regs[0xF] = flag
+
+    def _op_shl_vy(self, x, y, n, nn, nnn):        # SHL Vx, Vy (shift quirk)
+        regs = self.regs
+        flag = (regs[y] & 0x80) >> 7
+        regs[x] = (regs[y] << 1) & 0xFF
+        regs[0xF] = flag
+
+    def _op_rnd(self, x, y, n, nn, nnn):           # RND Vx, byte
+        # Set Vx = random AND nn
+        self.regs[x] = self.random_byte() & nn
+
+    # Display
+
+    def _op_drw(self, x, y, n, nn, nnn):           # DRW Vx, Vy, nibble
+        regs = self.regs
+        memory = self.memory
+        fb = self.framebuffer
+
+        # Set the x and y coords
+        x_coord = regs[x] % WIDTH
+        y_coord = regs[y] % HEIGHT
+
+        # Each sprite byte is shifted into place in the row once, pixels
+        # off the right or bottom edge are clipped
+        if x_coord <= WIDTH - 8:
+            shift = WIDTH - 8 - x_coord
+            clip = 0
+        else:
+            shift = 0
+            clip = x_coord - (WIDTH - 8)
+        rows = min(n, HEIGHT - y_coord)
+
+        collision = 0
+        index_reg = self.index_reg
+        for row_y in range(y_coord, y_coord + rows):
+            sprite = (memory[index_reg] >> clip) << shift
+            index_reg += 1
+            collision |= fb[row_y] & sprite
+            fb[row_y] ^= sprite
+
+        # Set the collision flag if any pixel was turned off
+        regs[0xF] = 1 if collision else 0
+        if rows > 0:
+            self.dirty_rows |= ((1 << rows) - 1) << y_coord
+
+    def _op_drw_wrap(self, x, y, n, nn, nnn):      # DRW Vx, Vy, nibble (wrap quirk)
+        regs = self.regs
+        memory = self.memory
+        fb = self.framebuffer
+
+        # Pixels off the right edge come back on the left, rows off the
+        # bottom come back at the top
+        x_coord = regs[x] % WIDTH
+        row_y = regs[y] % HEIGHT
+
+        collision = 0
+        dirty = 0
+        index_reg = self.index_reg
+        for _ in range(n):
+            wide = memory[index_reg] << (WIDTH - 8)
+            sprite = ((wide >> x_coord) | (wide << (WIDTH - x_coord))) & ROW_MASK
+            index_reg += 1
+            collision |= fb[row_y] & sprite
+            fb[row_y] ^= sprite
+            dirty |= 1 << row_y
+            row_y = (row_y + 1) % HEIGHT
+
+        regs[0xF] = 1 if collision else 0
+        self.dirty_rows |= dirty
+
+    def frame_bytes(self):
+        """ The framebuffer as 256 bytes, 8 per row with the leftmost pixel
+        in the top bit of the first byte
+        """
+
+        frame = bytearray(HEIGHT * 8)
+        for row in range(HEIGHT):
+            frame[row * 8:row * 8 + 8] = self.framebuffer[row].to_bytes(8, "big")
+        return frame
+
+    # Keyboard
+
+    def _op_skp(self, x, y, n, nn, nnn):           # SKP Vx
+        # Skip next instruction if key with value in Vx is pressed
+        if self.keys >> self.regs[x] & 1:
+            self.pc += 2
+
+    def _op_sknp(self, x, y, n, nn, nnn):          # SKNP Vx
+        # Skip next instruction if key with value in Vx is not pressed
+        if not self.keys >> self.regs[x] & 1:
+            self.pc += 2
+
+    def _op_ld_vx_k(self, x, y, n, nn, nnn):       # LD Vx, k
+        # Wait for a key to be pressed and let go and put its value in Vx
+        released = self.keys_released
+        if not released:
+            self.pc -= 2
         else:
-            pass
-    elif inst_type == 1:
-        print("%#x    JMP    %#x" % (pc-2, inst_NNN))
-        pc = inst_NNN
-    elif inst_type == 2:
-        print("%#x    CALL   %#x" % (pc-2, inst_NNN))
-    elif inst_type == 3:
-        print("%#x    SE    V%d, %d" % (pc-2, inst_X, inst_NN))
-    elif inst_type == 6:
-        print("%#x    LD    V%d, %#x" % (pc-2, inst_X, inst_NN))
-        regs[inst_X] = inst_NNN
-    elif inst_type == 7:
-        print("%#x    ADD    V%d, %#x" % (pc-2, inst_X, inst_NN))
-        regs[inst_X] += inst_NN
-    elif inst_type == 0xd:
-        print("%#x    DRW    V%d, V%d, %d" % (pc-2, inst_X, inst_Y, inst_N))
-        bitmap[inst_X, inst_Y] = 1
-    elif inst_type == 0xA:
-        print("%#x    LD    I, %#x" % (pc-2, inst_NNN))
-        index_reg = inst_NNN
-    else:
-       pass 
-
-    time.sleep(0.3)
+            self._take_released(x, released)
+
+    def _op_ld_vx_k_idle(self, x, y, n, nn, nnn):      # LD Vx, k
+        # Same as _op_ld_vx_k but skips the spinning while no key is let go
+        released = self.keys_released
+        if not released:
+            self.pc -= 2
+            raise Idle(1)
+        self._take_released(x, released)
+
+    def _take_released(self, x, released):
+        # Put the lowest key let go in Vx, each release is only taken once
+        key = 0
+        while not released >> key & 1:
+            key += 1
+        self.keys_released = released & ~(1 << key)
+        self.regs[x] = key
+
+    # Timers, index register and memory
+
+    def _op_ld_vx_dt(self, x, y, n, nn, nnn):      # LD Vx, DT
+        # Value of delay time put in Vx
+        self.regs[x] = self.delay_timer
+
+    def _op_ld_vx_dt_idle(self, x, y, n, nn, nnn):     # LD Vx, DT
+        # Start of a delay loop, which spins until the next timer tick if
+        # the timer is running.  The rest of the loop could have been
+        # overwritten since this was decoded so check it again
+        delay_timer = self.delay_timer
+        self.regs[x] = delay_timer
+        if delay_timer and self._is_delay_loop(self.pc - 2, x):
+            self.pc -= 2
+            raise Idle(3)
+
+    def _op_ld_dt_vx(self, x, y, n, nn, nnn):      # LD DT, Vx
+        # put value in Vx into delay timer
+        self.delay_timer = self.regs[x]
+
+    def _op_ld_st_vx(self, x, y, n, nn, nnn):      # LD ST, Vx
+        # put value in Vx into sound timer
+        self.sound_timer = self.regs[x]
+
+    def _op_ld_i(self, x, y, n, nn, nnn):          # LD I, addr
+        self.index_reg = nnn
+
+    def _op_add_i_vx(self, x, y, n, nn, nnn):      # ADD I, Vx
+        self.index_reg = self.index_reg + self.regs[x]
+
+    def _op_ld_f_vx(self, x, y, n, nn, nnn):       # LD F, Vx
+        # Set I to the location of the sprite for Vx
+        self.index_reg = 0x50 + (5 * self.regs[x])
+
+    def _op_ld_b_vx(self, x, y, n, nn, nnn):       # LD B, Vx
+        # Store BCD representation of Vx in locs I, I+1, I+2
+        memory = self.memory
+        index_reg = self.index_reg
+        value = self.regs[x]
+        memory[index_reg] = (value // 100) % 10
+        memory[index_reg + 1] = (value // 10) % 10
+        memory[index_reg + 2] = value % 10
+        self._invalidate(index_reg, index_reg + 2)
+
+    def _op_ld_i_vx(self, x, y, n, nn, nnn):       # LD [I], Vx
+        # Store values of V0 to Vx in memory starting at I
+        memory = self.memory
+        regs = self.regs
+        index_reg = self.index_reg
+        for reg in range(x + 1):
+            memory[index_reg + reg] = regs[reg]
+        self._invalidate(index_reg, index_reg + x)
+
+    def _op_ld_vx_i(self, x, y, n, nn, nnn):       # LD Vx, [I]
+        # Read registers V0 to Vx from memory starting at I
+        memory = self.memory
+        regs = self.regs
+        index_reg = self.index_reg
+        for reg in range(x + 1):
+            regs[reg] = memory[index_reg + reg]
+
+    def _op_ld_i_vx_inc(self, x, y, n, nn, nnn):   # LD [I], Vx (memory quirk)
+        # Store V0 to Vx starting at I and leave I after the last one
+        self._op_ld_i_vx(x, y, n, nn, nnn)
+        self.index_reg += x + 1
+
+    def _op_ld_vx_i_inc(self, x, y, n, nn, nnn):   # LD Vx, [I] (memory quirk)
+        # Read V0 to Vx starting at I and leave I after the last one
+        self._op_ld_vx_i(x, y, n, nn, nnn)
+        self.index_reg += x + 1
@@ -0,0 +1,294 @@
+# chip8_bench.py
+#
+#  Benchmark and regression runner for the CHIP8 interpreter
+#
+#  Runs every ROM in roms/roms.lst headless for a fixed number of frames and
+#  records the instructions per second, DRW calls per frame, the deepest
+#  the stack got and a hash of the final framebuffer.  The report is written
+#  as JSON and compared against a stored baseline, so a change to the
+#  interpreter that alters what any ROM draws shows up straight away.
+#
+#  This runs under regular Python on a PC, not on the macropad:
+#
+#     python chip8_bench.py                        compare with the baseline
+#     python chip8_bench.py --engine translate     same with TranslatingChip8
+#     python chip8_bench.py --save-baseline        store a new baseline
+#
+#  --save-states DIR keeps a save state of every ROM where the run ended,
+#  and --states DIR starts each ROM from its save state instead of from
+#  boot, to benchmark a mid-game position without replaying up to it
+#
+
+# Imports
+#
+import argparse
+import array
+import binascii
+import contextlib
+import io
+import json
+import os
+import sys
+import time
+
+import chip8
+import chip8_catalog
+import chip8_cfg
+import chip8_state
+import chip8_translate
+
+ENGINES = {
+    "interp": chip8.Chip8,
+    "translate": chip8_translate.TranslatingChip8,
+}
+
+ROM_DIR = "./roms/"
+BASELINE = "./bench_baseline.json"
+
+
+class DepthStack(array.array):
+    """ A machine stack that remembers the deepest entry written to it """
+
+    peak = 0
+
+    def __setitem__(self, index, value):
+        array.array.__setitem__(self, index, value)
+        if index >= self.peak:
+            self.peak = index + 1
+
+
+def bench_class(engine):
+    """ A subclass of engine that counts DRW instructions """
+
+    class BenchChip8(engine):
+        drw_calls = 0
+
+        def _op_drw(self, x, y, n, nn, nnn):
+            self.drw_calls += 1
+            engine._op_drw(self, x, y, n, nn, nnn)
+
+        def _op_drw_wrap(self, x, y, n, nn, nnn):
+            self.drw_calls += 1
+            engine._op_drw_wrap(self, x, y, n, nn, nnn)
+
+    return BenchChip8
+
+
+def frame_hash(machine):
+    """ CRC32 of the framebuffer as a hex string """
+
+    return "%08x" % (binascii.crc32(machine.frame_bytes()) & 0xFFFFFFFF)
+
+
+def run_rom(romname, engine="interp", frames=3600, instructions_per_frame=15,
+            seed=0, inputs=None, precompile=False, state=None, save_state=None,
+            quirks=()):
+    """ Run one ROM headless and return its results
+
+    inputs is a list of [frame, key, pressed] events applied at the start
+    of the given frame.  With precompile the translator builds every block
+    chip8_cfg finds before the first frame.  state is a save state file to
+    start from and save_state one to write at the end.  quirks are the
+    chip8.QUIRKS to run with
+    """
+
+    machine = bench_class(ENGINES[engine])(instructions_per_frame, quirks)
+    machine.seed(seed)
+    with contextlib.redirect_stdout(io.StringIO()):
+        machine.load_rom(ROM_DIR + romname)
+    if state is not None:
+        chip8_state.load_file(machine, state)
+    machine.stack = DepthStack("H", machine.stack)
+    start_cycles = machine.cycles
+    if precompile and hasattr(machine, "precompile"):
+        cfg = chip8_cfg.analyze(machine.memory, 0x200, machine.end_addr)
+        machine.precompile(sorted(cfg.blocks))
+
+    events = sorted(inputs or [])
+    next_event = 0
+    error = None
+    frame = 0
+    start = time.perf_counter()
+    try:
+        for frame in range(frames):
+            while next_event < len(events) and events[next_event][0] <= frame:
+                _, key, pressed = events[next_event]
+                if pressed:
+                    machine.press_key(key)
+                else:
+                    machine.release_key(key)
+                next_event += 1
+            machine.run_frame()
+            if not machine.running:
+                break
+    except (IndexError, ValueError) as e:
+        # Stack underflow or running off the end of memory
+        error = "%s at frame %d" % (type(e).__name__, frame)
+    elapsed = time.perf_counter() - start
+    if save_state is not None and error is None:
+        chip8_state.save_file(machine, save_state)
+
+    cycles = machine.cycles - start_cycles
+    return {
+        "cycles": cycles,
+        "frames": frame + 1,
+        "ips": int(cycles / elapsed) if elapsed > 0 else 0,
+        "drw_per_frame": round(machine.drw_calls / (frame + 1), 3),
+        "peak_stack": machine.stack.peak,
+        "traps": machine.traps,
+        "idle_cycles": machine.idle_cycles,
+        "framebuffer": frame_hash(machine),
+        "error": error,
+    }
+
+
+def run_all(roms, engine="interp", frames=3600, instructions_per_frame=15,
+            seed=0, inputs=None, precompile=False, states=None, save_states=None,
+            quirks=None):
+    """ Run a list of ROMs and return the full report
+
+    states and save_states are directories of save states, one per ROM,
+    to start from and to write at the end.  quirks is a dictionary of the
+    quirks to run each ROM with
+    """
+
+    inputs = inputs or {}
+    results = {}
+    total_cycles = 0
+    total_time = 0.0
+    for romname in roms:
+        state = None
+        if states is not None and os.path.exists(os.path.join(states, romname + ".state")):
+            state = os.path.join(states, romname + ".state")
+        save_state = None
+        if save_states is not None:
+            save_state = os.path.join(save_states, romname + ".state")
+        result = run_rom(romname, engine, frames, instructions_per_frame,
+                         seed, inputs.get(romname), precompile, state, save_state,
+                         (quirks or {}).get(romname, ()))
+        results[romname] = result
+        total_cycles += result["cycles"]
+        if result["ips"]:
+            total_time += result["cycles"] / result["ips"]
+
+    return {
+        "engine": engine,
+        "frames": frames,
+        "instructions_per_frame": instructions_per_frame,
+        "seed": seed,
+        "states": states,
+        "quirks": quirks or None,
+        "total_ips": int(total_cycles / total_time) if total_time else 0,
+        "roms": results,
+    }
+
+
+def compare(report, baseline):
+    """ Compare a report with a baseline report
+
+    Returns a list of (rom, message) for every ROM whose behaviour differs.
+    Speed differences are reported but are not failures
+    """
+
+    failures = []
+    for romname, result in report["roms"].items():
+        base = baseline["roms"].get(romname)
+        if base is None:
+            continue
+        for field in ("framebuffer", "cycles", "peak_stack", "traps", "error"):
+            if result[field] != base[field]:
+                failures.append((romname, "%s %s -> %s" % (field, base[field],
+                                                           result[field])))
+    return failures
+
+
+def read_rom_list(filename=ROM_DIR + "roms.lst"):
+    with open(filename, "r") as file:
+        return [line.strip() for line in file if line.strip()]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the CHIP8 interpreter over the ROM library")
+    parser.add_argument("roms", nargs="*", help="ROMs to run (default: all of roms.lst)")
+    parser.add_argument("--engine", choices=sorted(ENGINES), default="interp")
+    parser.add_argument("--frames", type=int, default=3600)
+    parser.add_argument("--ipf", type=int, default=15, help="instructions per frame")
+    parser.add_argument("--seed", type=int, default=0, help="random number seed")
+    parser.add_argument("--inputs", help="JSON file of {rom: [[frame, key, pressed], ...]}")
+    parser.add_argument("--precompile", action="store_true",
+                        help="translate the blocks found by chip8_cfg up front")
+    parser.add_argument("--states", help="start each ROM from its save state in this directory")
+    parser.add_argument("--save-states", help="save the state of each ROM at the end in this directory")
+    parser.add_argument("--quirks", help="comma separated quirks to run every ROM with")
+    parser.add_argument("--catalog", action="store_true",
+                        help="run each ROM with the quirks of its profile in roms/catalog.txt")
+    parser.add_argument("--baseline", default=BASELINE)
+    parser.add_argument("--save-baseline", action="store_true")
+    parser.add_argument("--output", help="write the JSON report here")
+    args = parser.parse_args(argv)
+
+    inputs = None
+    if args.inputs:
+        with open(args.inputs, "r") as file:
+            inputs = json.load(file)
+
+    roms = args.roms or read_rom_list()
+    quirks = {}
+    if args.catalog:
+        catalog = chip8_catalog.Catalog(ROM_DIR + "catalog.txt")
+        for romname in roms:
+            profile = catalog.profile(romname)
+            if profile is not None and profile.quirks:
+                quirks[romname] = list(profile.quirks)
+    if args.quirks:
+        for quirk in args.quirks.split(","):
+            if quirk not in chip8.QUIRKS:
+                parser.error("unknown quirk %r, choose from %s" % (quirk, ",".join(chip8.QUIRKS)))
+        for romname in roms:
+            quirks[romname] = sorted(set(quirks.get(romname, [])) | set(args.quirks.split(",")))
+    if args.save_states:
+        os.makedirs(args.save_states, exist_ok=True)
+    report = run_all(roms, args.engine, args.frames, args.ipf, args.seed, inputs,
+                     args.precompile, args.states, args.save_states, quirks)
+
+    for romname, result in report["roms"].items():
+        print("%-50s %9d IPS  %6.2f DRW/frame  stack %2d  %s%s" % (
+            romname[:50], result["ips"], result["drw_per_frame"],
+            result["peak_stack"], result["framebuffer"],
+            "  " + result["error"] if result["error"] else ""))
+    print("Total: %d IPS (%s)" % (report["total_ips"], report["engine"]))
+
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(report, file, indent=1, sort_keys=True)
+
+    if args.save_baseline:
+        with open(args.baseline, "w") as file:
+            json.dump(report, file, indent=1, sort_keys=True)
+        print("Saved baseline to %s" % args.baseline)
+        return 0
+
+    try:
+        with open(args.baseline, "r") as file:
+            baseline = json.load(file)
+    except OSError:
+        print("No baseline at %s" % args.baseline)
+        return 0
+
+    if (baseline["frames"], baseline["instructions_per_frame"], baseline["seed"],
+            baseline.get("states"), baseline.get("quirks")) != \
+            (report["frames"], report["instructions_per_frame"], report["seed"],
+             report["states"], report["quirks"]):
+        print("Baseline was run with different settings, not comparing")
+        return 0
+
+    failures = compare(report, baseline)
+    for romname, message in failures:
+        print("CHANGED %s: %s" % (romname, message))
+    if baseline["total_ips"]:
+        print("Speed vs baseline: x%.2f" % (report["total_ips"] / baseline["total_ips"]))
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,333 @@
+# chip8_catalog.py
+#
+#  ROM catalogue for the CHIP8 interpreter
+#
+#  Scans the ROM directory once on a PC and writes roms/catalog.txt, an
+#  index of every ROM keyed by the CRC32 of its contents (the checksum
+#  chip8_tools.load_rom gives, so save states and recordings agree) with
+#  a profile for running it:
+#
+#    variant  chip8, schip or xochip, from the opcodes the reachable code
+#             uses (see chip8_cfg.py)
+#    ipf      recommended instructions per frame for the variant
+#    quirks   behaviour switches the ROM expects, see chip8.QUIRKS
+#    keymap   CHIP8 key for each macropad key and the encoder switch (see
+#             chip8_input.py).  When the ROM tests keys the default keymap
+#             doesn't have (C-F), they are moved onto keys it doesn't use.
+#             The encoder switch is left for the menu and rewind
+#
+#  Anything the scan gets wrong can be fixed by hand in roms/profiles.json,
+#  {rom name: {"ipf": 20, "quirks": ["shift"], "keymap": [...]}}, which is
+#  merged in when the catalogue is built.
+#
+#  The catalogue is one tab separated line per ROM, in menu order:
+#
+#     crc32  size  variant  ipf  quirks  keymap  name
+#
+#  quirks is a comma separated list or "-", keymap is 13 hex digits with
+#  "-" for an unused button.  code.py only keeps the names, and where each
+#  ROM's line starts keyed by its CRC32, at boot.  When a ROM is started
+#  its line is read back from the file by the checksum of what was loaded
+#  and parsed, so there is no directory scan or ROM probing on the
+#  macropad.
+#
+#     python chip8_catalog.py              # rebuild roms/catalog.txt
+#     python chip8_catalog.py --show       # print it
+#
+
+# Imports
+#
+import array
+
+import chip8
+import chip8_input
+
+ROM_DIR = "./roms/"
+CATALOG_FILE = ROM_DIR + "catalog.txt"
+PROFILES_FILE = ROM_DIR + "profiles.json"
+
+# Recommended instructions per frame and quirks for each variant
+VARIANT_IPF = {"chip8": 15, "schip": 30, "xochip": 30}
+VARIANT_QUIRKS = {"chip8": (), "schip": ("jump",), "xochip": ("shift", "memory", "wrap")}
+
+_HEADER = "# crc32\tsize\tvariant\tipf\tquirks\tkeymap\tname\n"
+
+
+class Profile:
+    """ How to run one ROM """
+
+    def __init__(self, name, checksum, size, variant="chip8", instructions_per_frame=15,
+                 quirks=(), keymap=chip8_input.DEFAULT_KEYMAP):
+        self.name = name
+        self.checksum = checksum
+        self.size = size
+        self.variant = variant
+        self.instructions_per_frame = instructions_per_frame
+        self.quirks = tuple(quirks)
+        self.keymap = tuple(keymap)
+
+    def to_line(self):
+        keymap = "".join("-" if key is None else "%X" % key for key in self.keymap)
+        return "%08x\t%d\t%s\t%d\t%s\t%s\t%s\n" % (
+            self.checksum, self.size, self.variant, self.instructions_per_frame,
+            ",".join(self.quirks) or "-", keymap, self.name)
+
+    @classmethod
+    def from_line(cls, line):
+        checksum, size, variant, ipf, quirks, keymap, name = line.rstrip("\r\n").split("\t")
+        return cls(name, int(checksum, 16), int(size), variant, int(ipf),
+                   () if quirks == "-" else quirks.split(","),
+                   [None if key == "-" else int(key, 16) for key in keymap])
+
+
+class Catalog:
+    """ The catalogue file, read lazily
+
+    Only the ROM names and the file offset of each ROM's line, keyed by
+    its CRC32, are kept when it is opened.  A profile is read back from
+    the file and parsed when asked for.  ROMs with the same contents under
+    different names share a CRC32, the first one is found by checksum
+    alone and the others by checksum and name.
+    """
+
+    def __init__(self, filename=CATALOG_FILE):
+        self.filename = filename
+        self.names = []
+        self._offsets = array.array("L")
+        self._by_checksum = {}
+        self._duplicates = {}
+        offset = 0
+        with open(filename, "rb") as file:
+            for line in file:
+                # Offsets count bytes, so the file is read as bytes
+                text = line.decode()
+                if not text.startswith("#") and text.strip():
+                    checksum = int(text[:8], 16)
+                    if checksum in self._by_checksum:
+                        self._duplicates.setdefault(checksum, []).append(len(self.names))
+                    else:
+                        self._by_checksum[checksum] = len(self.names)
+                    self.names.append(text[text.rfind("\t") + 1:].rstrip("\r\n"))
+                    self._offsets.append(offset)
+                offset += len(line)
+
+    def __len__(self):
+        return len(self.names)
+
+    def _read(self, index):
+        with open(self.filename, "rb") as file:
+            file.seek(self._offsets[index])
+            return Profile.from_line(file.readline().decode())
+
+    def find(self, checksum, name=None):
+        """ Profile of the ROM with this CRC32, None if there isn't one.
+        When several ROMs have the same contents the one called name is
+        picked, the first one if none is
+        """
+
+        index = self._by_checksum.get(checksum)
+        if index is None:
+            return None
+        for other in self._duplicates.get(checksum, ()):
+            if self.names[other] == name:
+                index = other
+        return self._read(index)
+
+    def profile(self, name):
+        """ Profile of the ROM called name, None if it isn't catalogued """
+
+        if name not in self.names:
+            return None
+        return self._read(self.names.index(name))
+
+
+# Opcodes only the later variants have, as (mask, value)
+_SCHIP_OPCODES = ((0xFFF0, 0x00C0), (0xFFFF, 0x00FB), (0xFFFF, 0x00FC),
+                  (0xFFFF, 0x00FD), (0xFFFF, 0x00FE), (0xFFFF, 0x00FF),
+                  (0xF0FF, 0xF030), (0xF0FF, 0xF075), (0xF0FF, 0xF085))
+_XOCHIP_OPCODES = ((0xFFF0, 0x00D0), (0xF00F, 0x5002), (0xF00F, 0x5003),
+                   (0xFFFF, 0xF000), (0xF0FF, 0xF001), (0xFFFF, 0xF002),
+                   (0xF0FF, 0xF03A))
+
+
+def _matches(opcode, patterns):
+    for mask, value in patterns:
+        if opcode & mask == value:
+            return True
+    return False
+
+
+def detect_variant(cfg):
+    """ chip8, schip or xochip from the invalid (to chip8) opcodes the
+    analysis ran into, and the ROM size
+    """
+
+    variant = "chip8"
+    if cfg.end_addr - cfg.start_addr + 1 > 0x1000 - 0x200:
+        variant = "xochip"
+    for block in cfg.blocks.values():
+        opcode = block.instructions[-1].opcode
+        if block.instructions[-1].mnemonic != "DW":
+            continue
+        if _matches(opcode, _XOCHIP_OPCODES):
+            return "xochip"
+        if _matches(opcode, _SCHIP_OPCODES):
+            variant = "schip"
+    return variant
+
+
+def keys_tested(cfg):
+    """ The keys SKP / SKNP test with a value loaded by LD Vx, nn earlier
+    in the same block, and the keys an LD Vx, K is compared with by a
+    following SE / SNE Vx, nn.  Keys tested through computed registers
+    aren't seen
+    """
+
+    keys = set()
+    for block in cfg.blocks.values():
+        loaded = {}
+        waited = set()
+        for inst in block.instructions:
+            opcode = inst.opcode
+            x = (opcode >> 8) & 0xF
+            if opcode & 0xF000 == 0x6000:
+                loaded[x] = opcode & 0xFF
+                waited.discard(x)
+            elif opcode & 0xF0FF in (0xE09E, 0xE0A1):
+                if loaded.get(x, 0x10) <= 0xF:
+                    keys.add(loaded[x])
+            elif opcode & 0xF0FF == 0xF00A:
+                loaded.pop(x, None)
+                waited.add(x)
+            elif opcode & 0xF000 in (0x3000, 0x4000):
+                # SE / SNE Vx, nn
+                if x in waited and opcode & 0xFF <= 0xF:
+                    keys.add(opcode & 0xFF)
+            elif opcode & 0xF000 in (0x7000, 0x8000, 0xC000) or opcode & 0xF0FF in (0xF007, 0xF065):
+                loaded.pop(x, None)
+                waited.discard(x)
+                if opcode & 0xF0FF == 0xF065:
+                    loaded.clear()
+                    waited.clear()
+    return keys
+
+
+def make_keymap(keys, keymap=chip8_input.DEFAULT_KEYMAP):
+    """ keymap with any of keys it is missing moved onto buttons that
+    stand for keys not in keys.  The encoder switch is never used, holding
+    it is the only way back to the menu, so a ROM testing more keys than
+    there are buttons goes without the last ones
+    """
+
+    missing = sorted(key for key in keys if key not in keymap)
+    if not missing:
+        return tuple(keymap)
+    keymap = list(keymap)
+    spare = [button for button in range(chip8_input.KEY_COUNT)
+             if keymap[button] not in keys]
+    for key, button in zip(missing, spare):
+        keymap[button] = key
+    return tuple(keymap)
+
+
+def scan_rom(name, rom_dir=ROM_DIR):
+    """ Work out the profile of one ROM """
+
+    import chip8_cfg
+    import chip8_tools
+
+    memory = bytearray(4096)
+    info = chip8_tools.load_rom(memory, rom_dir + name)
+    cfg = chip8_cfg.analyze(memory, info.start_addr, info.end_addr)
+    variant = detect_variant(cfg)
+    return Profile(name, info.checksum, info.size, variant, VARIANT_IPF[variant],
+                   VARIANT_QUIRKS[variant], make_keymap(keys_tested(cfg)))
+
+
+def build(rom_dir=ROM_DIR, profiles=None):
+    """ Scan every ROM in rom_dir and return their profiles in menu order,
+    the order of roms.lst then any ROM files it doesn't list.  profiles is
+    a dictionary of hand made overrides by ROM name
+    """
+
+    import contextlib
+    import io
+    import os
+
+    names = []
+    if os.path.exists(rom_dir + "roms.lst"):
+        with open(rom_dir + "roms.lst", "r") as file:
+            names = [line.strip() for line in file if line.strip()]
+    listed = set(names)
+    names += sorted(name for name in os.listdir(rom_dir)
+                    if name.lower().endswith(".ch8") and name not in listed)
+
+    catalog = []
+    for name in names:
+        with contextlib.redirect_stdout(io.StringIO()):
+            profile = scan_rom(name, rom_dir)
+        override = (profiles or {}).get(name, {})
+        if "ipf" in override:
+            profile.instructions_per_frame = override["ipf"]
+        if "quirks" in override:
+            profile.quirks = tuple(override["quirks"])
+        if "keymap" in override:
+            profile.keymap = tuple(override["keymap"])
+        for quirk in profile.quirks:
+            if quirk not in chip8.QUIRKS:
+                raise ValueError("%s: unknown quirk %r" % (name, quirk))
+        catalog.append(profile)
+    return catalog
+
+
+def write(catalog, filename=CATALOG_FILE):
+    with open(filename, "w") as file:
+        file.write(_HEADER)
+        for profile in catalog:
+            file.write(profile.to_line())
+
+
+def main(argv=None):
+    import argparse
+    import json
+    import os
+
+    parser = argparse.ArgumentParser(description="Build the ROM catalogue")
+    parser.add_argument("--roms", default=ROM_DIR, help="ROM directory")
+    parser.add_argument("--profiles", help="JSON profile overrides (default: profiles.json "
+                                           "in the ROM directory, if there is one)")
+    parser.add_argument("--output", help="catalogue file (default: catalog.txt in the ROM directory)")
+    parser.add_argument("--show", action="store_true", help="print the catalogue, don't build it")
+    args = parser.parse_args(argv)
+
+    rom_dir = os.path.join(args.roms, "")
+    output = args.output or rom_dir + "catalog.txt"
+    if args.show:
+        catalog = Catalog(output)
+        catalog = [catalog.profile(name) for name in catalog.names]
+    else:
+        profiles = {}
+        filename = args.profiles or rom_dir + "profiles.json"
+        if args.profiles or os.path.exists(filename):
+            with open(filename, "r") as file:
+                profiles = json.load(file)
+        catalog = build(rom_dir, profiles)
+        write(catalog, output)
+
+    first = {}
+    for profile in catalog:
+        if first.setdefault(profile.checksum, profile) is not profile:
+            print("%s has the same contents as %s" % (profile.name,
+                                                      first[profile.checksum].name))
+    for profile in catalog:
+        print("%08x %5d %-6s %3d %-18s %s %s" % (
+            profile.checksum, profile.size, profile.variant,
+            profile.instructions_per_frame, ",".join(profile.quirks) or "-",
+            "".join("-" if key is None else "%X" % key for key in profile.keymap),
+            profile.name))
+    if not args.show:
+        print("%d ROMs written to %s" % (len(catalog), output))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,326 @@
+# chip8_cfg.py
+#
+#  Static control flow analysis of CHIP8 ROMs
+#
+#  Starting at 0x200 the analyzer follows jumps, calls, returns and skips
+#  (using the chip8_tools decoder) to find every instruction that can be
+#  reached, splits them into basic blocks and marks the remaining bytes of
+#  the ROM as data, noting which LD I instructions point at them (usually
+#  sprites).  The resulting control flow graph can be written out as JSON
+#  or as a DOT graph, and is cached by the ROM's CRC32 (the checksum
+#  chip8_tools.load_rom gives).
+#
+#  JP V0, nnn can't be followed statically, its base address nnn is
+#  treated as a target and the instruction is listed in cfg.indirect.
+#
+#     python chip8_cfg.py roms/Tetris.ch8 --dot tetris.dot
+#     python chip8_cfg.py --all --cache cfg_cache
+#
+
+# Imports
+#
+import json
+import os
+
+import chip8_tools
+
+ROM_DIR = "./roms/"
+
+# Largest number of data bytes shown on one DB line of a listing
+DB_PER_LINE = 8
+
+
+class Block:
+    """ A basic block - straight line code with one way in at the top
+
+    exits and entries are lists of (address, kind) where kind is one of
+    fall, jump, call, skip, return, indirect or invalid.  Exit addresses
+    are None where the target isn't known (return, invalid)
+    """
+
+    def __init__(self, start):
+        self.start = start
+        self.end = start
+        self.instructions = []
+        self.exits = []
+        self.entries = []
+
+
+class CFG:
+    """ Control flow graph of a ROM loaded in memory """
+
+    def __init__(self, memory, start_addr, end_addr):
+        self.memory = memory
+        self.start_addr = start_addr
+        self.end_addr = end_addr
+        self.checksum = None
+
+        # Reachable instructions by address
+        self.instructions = {}
+
+        # Basic blocks by start address
+        self.blocks = {}
+
+        # Data as (start, end) ranges and the LD I instructions that point
+        # into the data, as {data address: [instruction addresses]}
+        self.data = []
+        self.data_refs = {}
+
+        # JP V0 instructions and jumps outside the ROM
+        self.indirect = []
+        self.external = []
+
+    def is_code(self, addr):
+        """ True if addr is the first or second byte of reachable code """
+
+        return addr in self.instructions or (addr - 1) in self.instructions
+
+    def listing(self):
+        """ Generator of Instructions for the whole ROM, with data bytes as
+        DB records instead of decoded as opcodes
+        """
+
+        memory = self.memory
+        addr = self.start_addr
+        while addr <= self.end_addr:
+            inst = self.instructions.get(addr)
+            if inst is not None:
+                yield inst
+                addr += 2
+                continue
+            start = addr
+            values = []
+            while (addr <= self.end_addr and len(values) < DB_PER_LINE
+                   and not self.is_code(addr)):
+                values.append("%#04x" % memory[addr])
+                addr += 1
+            if not values:
+                # The second byte of an instruction that isn't reachable
+                # from its first byte - shouldn't happen but don't get stuck
+                values.append("%#04x" % memory[addr])
+                addr += 1
+            yield chip8_tools.Instruction(start, memory[start], "DB", values,
+                                          None, [])
+
+    def to_json(self):
+        """ The graph as a dictionary, ready for JSON """
+
+        return {
+            "checksum": self.checksum,
+            "start_addr": self.start_addr,
+            "end_addr": self.end_addr,
+            "blocks": [{
+                "start": block.start,
+                "end": block.end,
+                "instructions": [inst.addr for inst in block.instructions],
+                "exits": [list(exit) for exit in block.exits],
+                "entries": [list(entry) for entry in block.entries],
+            } for block in sorted(self.blocks.values(), key=lambda b: b.start)],
+            "data": [list(span) for span in self.data],
+            "data_refs": dict(("%d" % addr, refs) for addr, refs in self.data_refs.items()),
+            "indirect": self.indirect,
+            "external": self.external,
+        }
+
+    @classmethod
+    def from_json(cls, record, memory):
+        """ Rebuild a graph from to_json() output for a ROM in memory """
+
+        cfg = cls(memory, record["start_addr"], record["end_addr"])
+        cfg.checksum = record["checksum"]
+        for entry in record["blocks"]:
+            block = Block(entry["start"])
+            block.end = entry["end"]
+            for addr in entry["instructions"]:
+                inst = chip8_tools.decode((memory[addr] << 8) | memory[addr + 1], addr)
+                cfg.instructions[addr] = inst
+                block.instructions.append(inst)
+            block.exits = [tuple(exit) for exit in entry["exits"]]
+            block.entries = [tuple(entry) for entry in entry["entries"]]
+            cfg.blocks[block.start] = block
+        cfg.data = [tuple(span) for span in record["data"]]
+        cfg.data_refs = dict((int(addr), refs) for addr, refs in record["data_refs"].items())
+        cfg.indirect = record["indirect"]
+        cfg.external = record["external"]
+        return cfg
+
+    def to_dot(self, name="rom"):
+        """ The graph in graphviz DOT format """
+
+        lines = ['digraph "%s" {' % name.replace('"', "'"),
+                 '    node [shape=box fontname="monospace"];']
+        for block in sorted(self.blocks.values(), key=lambda b: b.start):
+            label = "\\l".join(chip8_tools.format_instruction(inst)
+                               for inst in block.instructions) + "\\l"
+            lines.append('    b%03x [label="%s"];' % (block.start, label))
+            for target, kind in block.exits:
+                if target is not None and target in self.blocks:
+                    lines.append('    b%03x -> b%03x [label="%s"];' % (block.start, target, kind))
+        lines.append("}")
+        return "\n".join(lines) + "\n"
+
+
+def analyze(memory, start_addr=0x200, end_addr=0xFFF, entry=None):
+    """ Build the control flow graph of the ROM at start_addr..end_addr """
+
+    cfg = CFG(memory, start_addr, end_addr)
+    instructions = cfg.instructions
+    entry = start_addr if entry is None else entry
+    leaders = set([entry])
+    work = [entry]
+
+    def in_rom(addr):
+        return start_addr <= addr <= end_addr - 1
+
+    def follow(addr):
+        # Queue a branch target, or note it if it leaves the ROM
+        if in_rom(addr):
+            leaders.add(addr)
+            work.append(addr)
+        elif addr not in cfg.external:
+            cfg.external.append(addr)
+
+    # Find everything reachable
+    while work:
+        addr = work.pop()
+        while in_rom(addr) and addr not in instructions:
+            inst = chip8_tools.decode((memory[addr] << 8) | memory[addr + 1], addr)
+            instructions[addr] = inst
+            flow = inst.flow
+            if inst.mnemonic == "DW" or flow == "return":
+                break
+            if flow == "jump":
+                follow(inst.targets[0])
+                break
+            if flow == "indirect":
+                cfg.indirect.append(addr)
+                follow(inst.opcode & 0xFFF)
+                break
+            if flow == "call":
+                follow(inst.targets[0])
+                leaders.add(addr + 2)
+            elif flow == "skip":
+                leaders.add(addr + 2)
+                follow(addr + 4)
+            addr += 2
+
+    # Split into basic blocks
+    block = None
+    for addr in sorted(instructions):
+        inst = instructions[addr]
+        if block is None or addr in leaders or addr != block.end + 2:
+            block = Block(addr)
+            cfg.blocks[addr] = block
+        block.instructions.append(inst)
+        block.end = addr
+        if inst.mnemonic == "DW" or inst.flow in ("jump", "call", "return", "skip", "indirect"):
+            block = None
+
+    # Edges
+    for block in cfg.blocks.values():
+        last = block.instructions[-1]
+        next_addr = last.addr + 2
+        if last.mnemonic == "DW":
+            block.exits.append((None, "invalid"))
+        elif last.flow == "jump":
+            block.exits.append((last.targets[0], "jump"))
+        elif last.flow == "call":
+            block.exits.append((last.targets[0], "call"))
+            block.exits.append((next_addr, "fall"))
+        elif last.flow == "return":
+            block.exits.append((None, "return"))
+        elif last.flow == "skip":
+            block.exits.append((next_addr, "fall"))
+            block.exits.append((last.addr + 4, "skip"))
+        elif last.flow == "indirect":
+            block.exits.append((last.opcode & 0xFFF, "indirect"))
+        elif next_addr in instructions:
+            block.exits.append((next_addr, "fall"))
+    for block in cfg.blocks.values():
+        for target, kind in block.exits:
+            if target in cfg.blocks:
+                cfg.blocks[target].entries.append((block.start, kind))
+
+    # Everything else is data
+    span_start = None
+    for addr in range(start_addr, end_addr + 1):
+        if cfg.is_code(addr):
+            if span_start is not None:
+                cfg.data.append((span_start, addr - 1))
+                span_start = None
+        elif span_start is None:
+            span_start = addr
+    if span_start is not None:
+        cfg.data.append((span_start, end_addr))
+
+    # LD I, nnn pointing into the data
+    for addr, inst in instructions.items():
+        if inst.opcode & 0xF000 == 0xA000:
+            target = inst.opcode & 0xFFF
+            if start_addr <= target <= end_addr and not cfg.is_code(target):
+                cfg.data_refs.setdefault(target, []).append(addr)
+
+    return cfg
+
+
+def analyze_rom(rom, cache_dir=None, start_addr=0x200):
+    """ Analyze a ROM given as a filename or bytes
+
+    If cache_dir is given results are cached there as JSON files named by
+    the CRC32 of the ROM
+    """
+
+    memory = bytearray(4096)
+    info = chip8_tools.load_rom(memory, rom, start_addr)
+
+    filename = None
+    if cache_dir is not None:
+        filename = os.path.join(cache_dir, "%08x.json" % info.checksum)
+        if os.path.exists(filename):
+            with open(filename, "r") as file:
+                return CFG.from_json(json.load(file), memory)
+
+    cfg = analyze(memory, start_addr, info.end_addr)
+    cfg.checksum = info.checksum
+    if filename is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        with open(filename, "w") as file:
+            json.dump(cfg.to_json(), file)
+    return cfg
+
+
+def main(argv=None):
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Control flow analysis of CHIP8 ROMs")
+    parser.add_argument("roms", nargs="*", help="ROM files to analyze")
+    parser.add_argument("--all", action="store_true",
+                        help="analyze every ROM in roms/roms.lst")
+    parser.add_argument("--json", help="write the graph of the (last) ROM as JSON here")
+    parser.add_argument("--dot", help="write the graph of the (last) ROM as DOT here")
+    parser.add_argument("--cache", help="directory to cache the graphs in")
+    args = parser.parse_args(argv)
+
+    romnames = list(args.roms)
+    if args.all:
+        with open(ROM_DIR + "roms.lst", "r") as file:
+            romnames += [ROM_DIR + line.strip() for line in file if line.strip()]
+
+    cfg = None
+    for romname in romnames:
+        cfg = analyze_rom(romname, args.cache)
+        data_bytes = sum(end - start + 1 for start, end in cfg.data)
+        print("%-55s %4d blocks %5d code bytes %5d data bytes %3d sprite refs%s" % (
+            romname[-55:], len(cfg.blocks), 2 * len(cfg.instructions), data_bytes,
+            len(cfg.data_refs), "  JP V0" if cfg.indirect else ""))
+
+    if cfg is not None and args.json:
+        with open(args.json, "w") as file:
+            json.dump(cfg.to_json(), file, indent=1)
+    if cfg is not None and args.dot:
+        with open(args.dot, "w") as file:
+            file.write(cfg.to_dot(os.path.basename(romnames[-1])))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,229 @@
+# chip8_conform.py
+#
+#  Quirk conformance checks for the CHIP8 engines
+#
+#  Each check is a few hand assembled instructions that behave differently
+#  with and without one quirk (see chip8.QUIRKS), and what the registers,
+#  I and screen must hold afterwards either way.  Every check is run on
+#  each engine - chip8.Chip8, chip8_translate.TranslatingChip8 and, with
+#  numpy installed, chip8_numpy.BatchChip8 - with the quirk off and on,
+#  both alone and with every other quirk set, so a quirk can't leak into
+#  the handlers of another.
+#
+#  Programs end in a jump to themselves, which the translator turns into
+#  a loop, so the translated blocks are checked as well as the handlers.
+#
+#     python chip8_conform.py
+#     python chip8_conform.py --engine translate --verbose
+#
+
+# Imports
+#
+import argparse
+import sys
+
+import chip8
+import chip8_translate
+
+try:
+    import chip8_numpy
+except ImportError:
+    chip8_numpy = None
+
+
+# A check is (name, quirk, program, expected with the quirk off, expected
+# with it on).  Expected is a dictionary of "V0".."VF", "I", "pc" or
+# "row N" (the framebuffer row as a 64 bit integer) to the value it must
+# have.  Programs load at 0x200
+CHECKS = [
+    ("SHR takes Vx", "shift",
+     [0x61, 0x81,           # LD V1, 0x81
+      0x62, 0x02,           # LD V2, 0x02
+      0x81, 0x26,           # SHR V1, V2
+      0x12, 0x06],          # JP 0x206
+     {"V1": 0x40, "V2": 0x02, "VF": 1},
+     {"V1": 0x01, "V2": 0x02, "VF": 0}),
+
+    ("SHL takes Vx", "shift",
+     [0x61, 0x01,           # LD V1, 0x01
+      0x62, 0xC0,           # LD V2, 0xC0
+      0x81, 0x2E,           # SHL V1, V2
+      0x12, 0x06],          # JP 0x206
+     {"V1": 0x02, "VF": 0},
+     {"V1": 0x80, "VF": 1}),
+
+    ("SHR into VF", "shift",
+     [0x6F, 0x03,           # LD VF, 0x03
+      0x62, 0x04,           # LD V2, 0x04
+      0x8F, 0x26,           # SHR VF, V2
+      0x12, 0x06],          # JP 0x206
+     {"VF": 1},
+     {"VF": 0}),
+
+    ("LD [I], Vx leaves I", "memory",
+     [0xA3, 0x00,           # LD I, 0x300
+      0x60, 0x11,           # LD V0, 0x11
+      0x61, 0x22,           # LD V1, 0x22
+      0xF1, 0x55,           # LD [I], V1
+      0x12, 0x08],          # JP 0x208
+     {"I": 0x300},
+     {"I": 0x302}),
+
+    ("LD Vx, [I] leaves I", "memory",
+     [0xA2, 0x08,           # LD I, 0x208
+      0xF2, 0x65,           # LD V2, [I]
+      0x12, 0x04,           # JP 0x204
+      0x00, 0x00,
+      0x0A, 0x0B, 0x0C],    # data at 0x208
+     {"V0": 0x0A, "V1": 0x0B, "V2": 0x0C, "I": 0x208},
+     {"V0": 0x0A, "V1": 0x0B, "V2": 0x0C, "I": 0x20B}),
+
+    ("LD [I] then LD Vx, [I]", "memory",
+     [0xA3, 0x00,           # LD I, 0x300
+      0x60, 0x01,           # LD V0, 0x01
+      0xF0, 0x55,           # LD [I], V0
+      0x60, 0x02,           # LD V0, 0x02
+      0xF0, 0x55,           # LD [I], V0
+      0xA3, 0x00,           # LD I, 0x300
+      0xF1, 0x65,           # LD V1, [I]
+      0x12, 0x0E],          # JP 0x20E
+     {"V0": 0x02, "V1": 0x00, "I": 0x300},
+     {"V0": 0x01, "V1": 0x02, "I": 0x302}),
+
+    ("DRW at the corner", "wrap",
+     [0xA2, 0x0C,           # LD I, 0x20C
+      0x60, 0x3C,           # LD V0, 60
+      0x61, 0x1E,           # LD V1, 30
+      0xD0, 0x13,           # DRW V0, V1, 3
+      0x12, 0x08,           # JP 0x208
+      0x00, 0x00,
+      0xFF, 0xFF, 0xFF],    # sprite at 0x20C
+     {"row 30": 0xF, "row 31": 0xF, "row 0": 0, "VF": 0},
+     {"row 30": 0xF00000000000000F, "row 31": 0xF00000000000000F,
+      "row 0": 0xF00000000000000F, "VF": 0}),
+
+    ("DRW wraps and collides", "wrap",
+     [0xA2, 0x0E,           # LD I, 0x20E
+      0x60, 0x3E,           # LD V0, 62
+      0x61, 0x1F,           # LD V1, 31
+      0xD0, 0x12,           # DRW V0, V1, 2
+      0xD0, 0x12,           # DRW V0, V1, 2
+      0x12, 0x0A,           # JP 0x20A
+      0x00, 0x00,
+      0x81, 0x42],          # sprite at 0x20E
+     {"row 31": 0, "row 0": 0, "VF": 1},
+     {"row 31": 0, "row 0": 0, "VF": 1}),
+
+    ("DRW wraps one row", "wrap",
+     [0xA2, 0x0C,           # LD I, 0x20C
+      0x60, 0x3E,           # LD V0, 62
+      0x61, 0x1F,           # LD V1, 31
+      0xD0, 0x12,           # DRW V0, V1, 2
+      0x12, 0x08,           # JP 0x208
+      0x00, 0x00,
+      0x81, 0x42],          # sprite at 0x20C
+     {"row 31": 0x2, "row 0": 0},
+     {"row 31": 0x2 | 1 << 58, "row 0": 0x1 | 1 << 59}),
+
+    ("JP V0 uses Vx", "jump",
+     [0x60, 0x04,           # LD V0, 4
+      0x62, 0x08,           # LD V2, 8
+      0xB2, 0x10,           # JP V0 (V2), 0x210
+      0x12, 0x06,           # JP 0x206
+      0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00,
+      0x00, 0x00, 0x00, 0x00,
+      0x6A, 0x01,           # 0x214: LD VA, 1
+      0x12, 0x16,           # JP 0x216
+      0x6A, 0x02,           # 0x218: LD VA, 2
+      0x12, 0x1A],          # JP 0x21A
+     {"VA": 1, "pc": 0x216},
+     {"VA": 2, "pc": 0x21A}),
+]
+
+ENGINES = ["interp", "translate"] + (["numpy"] if chip8_numpy is not None
+                                     and chip8_numpy.np is not None else [])
+
+# Instructions to run each check for, plenty to reach the final loop
+CYCLES = 64
+
+
+def run_check(engine, program, quirks):
+    """ Run a program with quirks, returns a function giving the value of
+    an expected field
+    """
+
+    if engine == "numpy":
+        batch = chip8_numpy.BatchChip8(1, CYCLES, quirks=quirks)
+        batch.load_rom(bytes(program))
+        batch.run_cycles(CYCLES)
+
+        def value(field):
+            if field == "I":
+                return int(batch.index_reg[0])
+            if field == "pc":
+                return int(batch.pc[0])
+            if field.startswith("row "):
+                return int(batch.framebuffer[0, int(field[4:])])
+            return int(batch.regs[0, int(field[1:], 16)])
+        return value
+
+    machine = (chip8_translate.TranslatingChip8 if engine == "translate" else chip8.Chip8)(
+        CYCLES, quirks)
+    machine.load_rom(bytes(program))
+    machine.run_cycles(CYCLES)
+
+    def value(field):
+        if field == "I":
+            return machine.index_reg
+        if field == "pc":
+            return machine.pc
+        if field.startswith("row "):
+            return machine.framebuffer[int(field[4:])]
+        return machine.regs[int(field[1:], 16)]
+    return value
+
+
+def run(engines=ENGINES, verbose=False):
+    """ Run every check on engines, returns the number of runs and the
+    list of failures as (engine, check name, quirks, field, expected, got)
+    """
+
+    failures = []
+    runs = 0
+    for name, quirk, program, expected_off, expected_on in CHECKS:
+        others = tuple(q for q in chip8.QUIRKS if q != quirk)
+        settings = [((), expected_off), (others, expected_off),
+                    ((quirk,), expected_on), (chip8.QUIRKS, expected_on)]
+        for engine in engines:
+            for quirks, expected in settings:
+                value = run_check(engine, program, quirks)
+                runs += 1
+                failed = len(failures)
+                for field, want in sorted(expected.items()):
+                    got = value(field)
+                    if got != want:
+                        failures.append((engine, name, quirks, field, want, got))
+                if verbose:
+                    print("%-9s %-24s %-26s %s" % (engine, name, ",".join(quirks) or "-",
+                                                   "FAIL" if len(failures) > failed else "ok"))
+    return runs, failures
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Check the quirk handlers of every engine")
+    parser.add_argument("--engine", action="append", choices=ENGINES,
+                        help="engine to check, can be repeated (default: all)")
+    parser.add_argument("--verbose", action="store_true", help="print every run")
+    args = parser.parse_args(argv)
+
+    runs, failures = run(args.engine or ENGINES, args.verbose)
+    for engine, name, quirks, field, want, got in failures:
+        print("FAIL %s %s [%s]: %s is %#x, expected %#x" % (
+            engine, name, ",".join(quirks) or "-", field, got, want))
+    print("%d checks, %d runs on %s, %d failures" % (
+        len(CHECKS), runs, ", ".join(args.engine or ENGINES), len(failures)))
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,225 @@
+# chip8_display.py
+#
+#  Presentation stage for the CHIP8 interpreter
+#
+#  The Presenter copies the CHIP8 framebuffer onto the 2x size macropad
+#  bitmap and refreshes the display once per 60Hz timer tick, instead of
+#  letting displayio auto refresh in the middle of sprite draws.  Only the
+#  pixels that changed since the last refresh are written to the bitmap, a
+#  run of them at a time with bitmaptools.fill_region where CircuitPython
+#  has it, so displayio only sends the changed area over SPI.
+#
+#  StubDisplay and StubBitmap stand in for board.DISPLAY and
+#  displayio.Bitmap when running under CPython, and count the refreshes and
+#  the bytes that would have been pushed to the screen
+#
+
+# Imports
+#
+import time
+
+import chip8
+
+try:
+    import bitmaptools
+except ImportError:
+    bitmaptools = None
+
+
+def fill_region(bitmap, x1, y1, x2, y2, value):
+    """ Set the pixels from (x1, y1) up to but not including (x2, y2),
+    for bitmaps without bitmaptools
+    """
+
+    for y in range(y1, y2):
+        for x in range(x1, x2):
+            bitmap[x, y] = value
+
+
+if bitmaptools is not None:
+    fill_region = bitmaptools.fill_region
+
+
+class Presenter:
+    """ Pushes the changed part of the CHIP8 screen to a display
+
+    Call present() once per 60Hz tick.  It does nothing if the ROM hasn't
+    drawn anything since the last call and the last refresh went through.
+    """
+
+    def __init__(self, display, bitmap, scale=2):
+        self.display = display
+        self.bitmap = bitmap
+        self.scale = scale
+
+        # Only refresh when we say so
+        display.auto_refresh = False
+
+        # What is currently on the bitmap, one 64 bit integer per row, and
+        # whether the bitmap has changes the display hasn't shown yet
+        self.shown = [0] * chip8.HEIGHT
+        self.pending = False
+
+        # Statistics
+        self.refreshes = 0
+        self.pixels_written = 0
+        self.last_rect = None
+
+    def clear(self):
+        """ Blank the bitmap and the display """
+
+        self.bitmap.fill(0)
+        for row in range(chip8.HEIGHT):
+            self.shown[row] = 0
+        self.pending = True
+        if self.display.refresh(target_frames_per_second=None):
+            self.pending = False
+            self.refreshes += 1
+
+    def present(self, machine):
+        """ Copy the changed pixels onto the bitmap and refresh the display,
+        returns True if the display was refreshed
+        """
+
+        dirty = machine.dirty_rows
+        if not dirty and not self.pending:
+            return False
+        machine.dirty_rows = 0
+
+        fb = machine.framebuffer
+        shown = self.shown
+        bitmap = self.bitmap
+        scale = self.scale
+        width = chip8.WIDTH
+        top_bit = width - 1
+
+        # Bounds of the changed area in CHIP8 pixels
+        min_x = width
+        max_x = -1
+        min_y = chip8.HEIGHT
+        max_y = -1
+        for y in range(chip8.HEIGHT):
+            if not dirty & (1 << y):
+                continue
+            row = fb[y]
+            changed = row ^ shown[y]
+            if not changed:
+                continue
+            shown[y] = row
+            min_y = min(min_y, y)
+            max_y = y
+            # Fill each run of changed pixels of one colour in one go, each
+            # CHIP8 pixel a scale x scale block
+            x = 0
+            while x < width:
+                if not (changed >> (top_bit - x)) & 1:
+                    x += 1
+                    continue
+                value = (row >> (top_bit - x)) & 1
+                start = x
+                x += 1
+                while (x < width and (changed >> (top_bit - x)) & 1
+                       and (row >> (top_bit - x)) & 1 == value):
+                    x += 1
+                fill_region(bitmap, start * scale, y * scale, x * scale,
+                            (y + 1) * scale, value)
+                min_x = min(min_x, start)
+                max_x = max(max_x, x - 1)
+                self.pixels_written += x - start
+
+        if max_y >= 0:
+            self.last_rect = (min_x, min_y, max_x + 1, max_y + 1)
+            self.pending = True
+        elif not self.pending:
+            # Sprites drawn twice in one frame (erase and redraw) can leave
+            # nothing to show
+            return False
+
+        # Refresh now, the scheduler does the pacing.  If the display
+        # skips it anyway the changes stay pending for the next tick
+        if not self.display.refresh(target_frames_per_second=None):
+            return False
+        self.pending = False
+        self.refreshes += 1
+        return True
+
+
+class StubBitmap:
+    """ A stand in for displayio.Bitmap that tracks its dirty area """
+
+    def __init__(self, width, height, value_count=2):
+        self.width = width
+        self.height = height
+        self._pixels = bytearray(width * height)
+        self.dirty = None
+
+    def __getitem__(self, xy):
+        return self._pixels[xy[1] * self.width + xy[0]]
+
+    def __setitem__(self, xy, value):
+        x, y = xy
+        self._pixels[y * self.width + x] = value
+        if self.dirty is None:
+            self.dirty = [x, y, x + 1, y + 1]
+        else:
+            dirty = self.dirty
+            dirty[0] = min(dirty[0], x)
+            dirty[1] = min(dirty[1], y)
+            dirty[2] = max(dirty[2], x + 1)
+            dirty[3] = max(dirty[3], y + 1)
+
+    def fill(self, value):
+        for addr in range(len(self._pixels)):
+            self._pixels[addr] = value
+        self.dirty = [0, 0, self.width, self.height]
+
+
+class StubDisplay:
+    """ A stand in for board.DISPLAY
+
+    The macropad screen is a 128x64 one bit per pixel display written in
+    pages of 8 rows, so a refresh pushes one byte per column of each page the
+    dirty area touches.  A slow display can be simulated by giving each
+    refresh a delay in seconds, spent with sleep.  Like displayio,
+    refresh() with a target_frames_per_second waits for the next frame at
+    that rate and returns False without refreshing if it is already past
+    it.  clock returns integer nanoseconds
+    """
+
+    def __init__(self, bitmap=None, width=128, height=64, delay=0.0,
+                 sleep=time.sleep, clock=time.monotonic_ns):
+        self.width = width
+        self.height = height
+        self.auto_refresh = True
+        self.root_group = None
+        self.bitmap = bitmap
+        self.delay = delay
+        self.sleep = sleep
+        self.clock = clock
+        self.last_refresh = None
+
+        self.refreshes = 0
+        self.skipped = 0
+        self.bytes_pushed = 0
+
+    def refresh(self, *, target_frames_per_second=None, minimum_frames_per_second=0):
+        now = self.clock()
+        if target_frames_per_second is not None and self.last_refresh is not None:
+            due = self.last_refresh + 1000000000 // target_frames_per_second
+            if now > due:
+                self.skipped += 1
+                self.last_refresh = now
+                return False
+            self.sleep((due - now) / 1000000000)
+        self.refreshes += 1
+        if self.delay:
+            self.sleep(self.delay)
+        self.last_refresh = self.clock()
+        bitmap = self.bitmap
+        if bitmap is None or bitmap.dirty is None:
+            return True
+        left, top, right, bottom = bitmap.dirty
+        pages = (bottom + 7) // 8 - top // 8
+        self.bytes_pushed += (right - left) * pages
+        bitmap.dirty = None
+        return True
@@ -1,20 +1,89 @@
 #chip8_dissasembler.py
 #
 #  This is a modified version of the CHIP8 interprter that
-#  just generates an assembly code listing of a ROM file
+#  just generates an assembly code listing of ROM files
 #
-#  It is a project to learn circuitpython and the RP2040 
+#  It is a project to learn circuitpython and the RP2040
+#
+#  Run it on a PC:
+#
+#     python chip8_dissasmbler.py roms/Tetris.ch8
+#     python chip8_dissasmbler.py --all --format jsonl --output roms.jsonl
+#
+#  --all disassembles every ROM in roms/roms.lst in one pass and reports the
+#  throughput at the end.  Only code reachable from 0x200 (found by
+#  chip8_cfg) is decoded, the rest is listed as DB data, --linear decodes
+#  every pair of bytes as before
 #
 
+import argparse
+import sys
+import time
+
+import chip8_cfg
 import chip8_tools
 
-# Memory - The CHIP8 has 4K (4096) bytes of RAM
-#          Implement this as a list with 4096 elements initialized to zeros
-#
-memory = [0] * 4096
+ROM_DIR = "./roms/"
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Disassemble CHIP8 ROMs")
+    parser.add_argument("roms", nargs="*", help="ROM files to disassemble")
+    parser.add_argument("--all", action="store_true",
+                        help="disassemble every ROM in roms/roms.lst")
+    parser.add_argument("--format", choices=["text", "jsonl"], default="text")
+    parser.add_argument("--output", help="write the listing here instead of the console")
+    parser.add_argument("--linear", action="store_true",
+                        help="decode every word instead of following the code")
+    args = parser.parse_args(argv)
+
+    romnames = list(args.roms)
+    if args.all:
+        with open(ROM_DIR + "roms.lst", "r") as file:
+            romnames += [ROM_DIR + line.strip() for line in file if line.strip()]
+    if not romnames:
+        romnames = [ROM_DIR + "Tetris.ch8"]
+
+    output = open(args.output, "w") if args.output else sys.stdout
+
+    # Memory - The CHIP8 has 4K (4096) bytes of RAM
+    #          Implement this as a bytearray with 4096 elements initialized to zeros
+    #
+    memory = bytearray(4096)
+    memory = chip8_tools.load_font(memory)
+
+    instructions = 0
+    rom_bytes = 0
+    start = time.perf_counter()
+    try:
+        for romname in romnames:
+            # Clear out the last ROM so an odd sized one ends in zeros
+            memory[0x200:] = bytes(len(memory) - 0x200)
+            info = chip8_tools.load_rom(memory, romname)
+            if args.format == "jsonl":
+                sink = chip8_tools.JsonLinesSink(output, rom=romname)
+            else:
+                output.write("; %s\n" % romname)
+                sink = chip8_tools.TextSink(output)
+            if args.linear:
+                instructions += chip8_tools.disassemble_to(memory, info.start_addr,
+                                                           info.end_addr, sink)
+            else:
+                cfg = chip8_cfg.analyze(memory, info.start_addr, info.end_addr)
+                for inst in cfg.listing():
+                    sink.write(inst)
+                    instructions += 1
+            sink.close()
+            rom_bytes += info.size
+    finally:
+        if output is not sys.stdout:
+            output.close()
+    elapsed = time.perf_counter() - start
 
-memory = chip8_tools.load_font(memory)
+    print("%d ROMs, %d instructions, %d bytes in %.3fs (%.0f instructions/s)" % (
+        len(romnames), instructions, rom_bytes, elapsed,
+        instructions / elapsed if elapsed else 0), file=sys.stderr)
 
-[memory, endaddr] = chip8_tools.read_rom(memory, romname="./roms/Tetris.ch8")
 
-chip8_tools.dissasemble(memory, 0x200,endaddr )
+if __name__ == "__main__":
+    main()
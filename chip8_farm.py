@@ -0,0 +1,232 @@
+# chip8_farm.py
+#
+#  Parallel headless runs of the CHIP8 interpreter
+#
+#  Spreads runs of the ROM library over every core with a process pool.
+#  A job is one ROM with one random number seed, or one ROM with one input
+#  recording (see chip8_record.py).  Each worker sends back a small record
+#  - framebuffer hash, cycle count, traps and an opcode histogram - and
+#  they are merged into one report with totals for the whole farm.
+#
+#  This is for a PC, not the macropad:
+#
+#     python chip8_farm.py --seeds 8 --output farm.json
+#     python chip8_farm.py "Tetris.ch8" --trace "Tetris.ch8:tetris.rec"
+#
+#  Seed runs use the quirks given with --quirks, or with --catalog each
+#  ROM's quirks from roms/catalog.txt.  Recordings replay with the quirks
+#  stored in them unless --quirks is given
+#
+
+# Imports
+#
+import argparse
+import contextlib
+import io
+import json
+import multiprocessing
+import os
+import sys
+import time
+
+import chip8
+import chip8_bench
+import chip8_catalog
+import chip8_profile
+import chip8_record
+
+
+def run_job(job):
+    """ Run one job in a worker and return its result record
+
+    job is a dictionary with rom, engine, frames, instructions_per_frame,
+    seed, trace (a recording file or None), quirks (None for none, or the
+    recording's with a trace) and histogram
+    """
+
+    # A recording brings its own quirks, the machine is made with them so
+    # replay() doesn't change them under the profiler
+    recording = None
+    quirks = job["quirks"] or ()
+    if job["trace"] is not None:
+        recording = chip8_record.load(job["trace"])
+        if job["quirks"] is not None:
+            recording.quirks = tuple(job["quirks"])
+        quirks = recording.quirks
+
+    machine = chip8_bench.ENGINES[job["engine"]](job["instructions_per_frame"], quirks)
+    with contextlib.redirect_stdout(io.StringIO()):
+        machine.load_rom(chip8_bench.ROM_DIR + job["rom"])
+
+    profiler = None
+    if job["histogram"]:
+        profiler = chip8_profile.Profiler(machine)
+        profiler.attach()
+
+    error = None
+    frames = 0
+    start = time.perf_counter()
+    try:
+        if recording is not None:
+            frames = chip8_record.replay(machine, recording, job["frames"])
+        else:
+            machine.seed(job["seed"])
+            for frames in range(1, job["frames"] + 1):
+                machine.run_frame()
+                if not machine.running:
+                    break
+    except (IndexError, ValueError) as e:
+        error = "%s at frame %d" % (type(e).__name__, frames)
+    elapsed = time.perf_counter() - start
+
+    histogram = {}
+    if profiler is not None:
+        profiler.detach()
+        histogram = dict((op, count) for op, count in profiler.op_counts.items() if count)
+
+    return {
+        "rom": job["rom"],
+        "seed": job["seed"],
+        "trace": job["trace"],
+        "quirks": list(machine.quirks),
+        "cycles": machine.cycles,
+        "frames": frames,
+        "seconds": round(elapsed, 4),
+        "traps": machine.traps,
+        "framebuffer": chip8_bench.frame_hash(machine),
+        "error": error,
+        "histogram": histogram,
+    }
+
+
+def make_jobs(roms, seeds, traces, engine="interp", frames=3600,
+              instructions_per_frame=15, histogram=True, quirks=None, trace_quirks=None):
+    """ One job per ROM and seed, plus one per (rom, recording) trace.
+    quirks is a dictionary of the quirks to run each ROM's seeds with,
+    ROMs not in it run without any.  Traces run with trace_quirks, or the
+    recording's if it is None
+    """
+
+    base = {"engine": engine, "frames": frames,
+            "instructions_per_frame": instructions_per_frame,
+            "histogram": histogram, "trace": None}
+    quirks = quirks or {}
+    jobs = []
+    for romname in roms:
+        for seed in seeds:
+            job = dict(base)
+            job.update(rom=romname, seed=seed, quirks=quirks.get(romname))
+            jobs.append(job)
+    for romname, trace in traces:
+        job = dict(base)
+        job.update(rom=romname, seed=None, trace=trace, quirks=trace_quirks)
+        jobs.append(job)
+    return jobs
+
+
+def merge(results):
+    """ Merge worker results into one report """
+
+    histogram = {}
+    cycles = 0
+    seconds = 0.0
+    errors = 0
+    for result in results:
+        cycles += result["cycles"]
+        seconds += result["seconds"]
+        if result["error"]:
+            errors += 1
+        for op, count in result["histogram"].items():
+            histogram[op] = histogram.get(op, 0) + count
+
+    results = sorted(results, key=lambda r: (r["rom"], r["seed"] is None,
+                                             r["seed"] or 0, r["trace"] or ""))
+    return {
+        "jobs": len(results),
+        "cycles": cycles,
+        "worker_seconds": round(seconds, 3),
+        "errors": errors,
+        "histogram": dict(sorted(histogram.items(), key=lambda item: -item[1])),
+        "results": results,
+    }
+
+
+def run_farm(jobs, workers=None):
+    """ Run jobs over a pool of workers, returns the merged report """
+
+    workers = workers or os.cpu_count() or 1
+    start = time.perf_counter()
+    if workers == 1:
+        results = [run_job(job) for job in jobs]
+    else:
+        with multiprocessing.Pool(workers) as pool:
+            results = list(pool.imap_unordered(run_job, jobs))
+    report = merge(results)
+    report["workers"] = workers
+    report["seconds"] = round(time.perf_counter() - start, 3)
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run the ROM library over all cores")
+    parser.add_argument("roms", nargs="*", help="ROMs to run (default: all of roms.lst)")
+    parser.add_argument("--engine", choices=sorted(chip8_bench.ENGINES), default="interp")
+    parser.add_argument("--frames", type=int, default=3600,
+                        help="frames per run, or frames after the last event of a trace")
+    parser.add_argument("--ipf", type=int, default=15, help="instructions per frame")
+    parser.add_argument("--seeds", type=int, default=1, help="seeds 0..N-1 per ROM")
+    parser.add_argument("--trace", action="append", default=[],
+                        help="ROM:recording to replay, can be repeated")
+    parser.add_argument("--workers", type=int, help="processes (default: one per core)")
+    parser.add_argument("--no-histogram", action="store_true",
+                        help="skip the opcode histogram, which slows runs down")
+    parser.add_argument("--quirks", help="comma separated quirks to run every ROM with")
+    parser.add_argument("--catalog", action="store_true",
+                        help="run each ROM with the quirks of its profile in roms/catalog.txt")
+    parser.add_argument("--output", help="write the JSON report here")
+    args = parser.parse_args(argv)
+
+    traces = []
+    for spec in args.trace:
+        romname, _, filename = spec.rpartition(":")
+        traces.append((romname, filename))
+    roms = args.roms or (chip8_bench.read_rom_list() if not traces else [])
+
+    quirks = {}
+    trace_quirks = None
+    if args.catalog:
+        catalog = chip8_catalog.Catalog(chip8_bench.ROM_DIR + "catalog.txt")
+        for romname in roms:
+            profile = catalog.profile(romname)
+            if profile is not None:
+                quirks[romname] = list(profile.quirks)
+    if args.quirks:
+        trace_quirks = args.quirks.split(",")
+        for quirk in trace_quirks:
+            if quirk not in chip8.QUIRKS:
+                parser.error("unknown quirk %r, choose from %s" % (quirk, ",".join(chip8.QUIRKS)))
+        for romname in roms:
+            quirks[romname] = sorted(set(quirks.get(romname, [])) | set(trace_quirks))
+
+    jobs = make_jobs(roms, range(args.seeds), traces, args.engine, args.frames,
+                     args.ipf, not args.no_histogram, quirks, trace_quirks)
+    report = run_farm(jobs, args.workers)
+
+    for result in report["results"]:
+        print("%-50s %-6s %10d cycles  %s%s" % (
+            result["rom"][:50],
+            "trace" if result["trace"] else "seed %d" % result["seed"],
+            result["cycles"], result["framebuffer"],
+            "  " + result["error"] if result["error"] else ""))
+    print("%d jobs, %d cycles in %.2fs on %d workers (%.2fs of work)" % (
+        report["jobs"], report["cycles"], report["seconds"], report["workers"],
+        report["worker_seconds"]))
+
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(report, file, indent=1)
+    return 1 if report["errors"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
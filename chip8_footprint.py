@@ -0,0 +1,121 @@
+# chip8_footprint.py
+#
+#  Memory footprint of the CHIP8 machine state
+#
+#  Measures the heap each part of the machine state takes held the way
+#  chip8.Chip8 keeps it - memory and V0-VF in bytearrays, the stack a
+#  fixed array of STACK_DEPTH 16 bit return addresses - next to the plain
+#  lists the core used to keep (memory = [0] * 4096, regs = [0] * 16 and a
+#  list stack grown to the same depth), then what a whole machine takes
+#  for each engine.
+#
+#  Sizes are the heap still held after building each part, from
+#  tracemalloc under CPython and from the drop in gc.mem_free() under
+#  CircuitPython, so the same report runs on a PC and on the macropad:
+#
+#     python chip8_footprint.py
+#     >>> import chip8_footprint; chip8_footprint.report()     (macropad REPL)
+#
+
+# Imports
+#
+import array
+import gc
+import sys
+
+import chip8
+import chip8_translate
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+ENGINES = {
+    "interp": chip8.Chip8,
+    "translate": chip8_translate.TranslatingChip8,
+}
+
+
+def _stack_list():
+    stack = []
+    for depth in range(chip8.STACK_DEPTH):
+        stack.append(0x200 + 2 * depth)
+    return stack
+
+
+def _stack_array():
+    stack = array.array("H", [0] * chip8.STACK_DEPTH)
+    for depth in range(chip8.STACK_DEPTH):
+        stack[depth] = 0x200 + 2 * depth
+    return stack
+
+
+# Each part of the state as (name, built as a list, built as the core
+# builds it now).  The stacks are full so both hold the same addresses
+PARTS = (
+    ("memory", lambda: [0] * 4096, lambda: bytearray(4096)),
+    ("V0-VF", lambda: [0] * 16, lambda: bytearray(16)),
+    ("stack", _stack_list, _stack_array),
+)
+
+
+def allocated(make):
+    """ Call make() and return the bytes of heap what it made holds """
+
+    gc.collect()
+    if tracemalloc is not None:
+        tracemalloc.start()
+        made = make()
+        size = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+    else:
+        free = gc.mem_free()
+        made = make()
+        gc.collect()
+        size = free - gc.mem_free()
+    del made
+    return size
+
+
+def measure(engines=ENGINES):
+    """ Returns a list of (part, bytes as a list, bytes now) for PARTS and
+    a list of (engine, bytes) for a whole new machine of each engine
+    """
+
+    parts = [(name, allocated(as_list), allocated(as_typed))
+             for name, as_list, as_typed in PARTS]
+    machines = [(name, allocated(engines[name])) for name in sorted(engines)]
+    return parts, machines
+
+
+def report(engines=ENGINES):
+    parts, machines = measure(engines)
+    print("Heap bytes on %s (%s)" % (sys.implementation.name,
+                                     "tracemalloc" if tracemalloc is not None else "gc.mem_free()"))
+    print("%-10s %8s %8s %8s" % ("", "lists", "typed", "saved"))
+    list_total = 0
+    typed_total = 0
+    for name, as_list, as_typed in parts:
+        print("%-10s %8d %8d %8d" % (name, as_list, as_typed, as_list - as_typed))
+        list_total += as_list
+        typed_total += as_typed
+    print("%-10s %8d %8d %8d" % ("total", list_total, typed_total, list_total - typed_total))
+    for name, size in machines:
+        print("%-10s %8d  whole machine" % (name, size))
+    return parts, machines
+
+
+def main(argv=None):
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Report the heap the machine state takes")
+    parser.add_argument("--engine", action="append", choices=sorted(ENGINES),
+                        help="engine to measure a whole machine of, can be repeated (default: all)")
+    args = parser.parse_args(argv)
+
+    report(dict((name, ENGINES[name]) for name in args.engine or ENGINES))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,147 @@
+# chip8_input.py
+#
+#  Keypad input for the CHIP8 interpreter
+#
+#  The macropad's twelve keys and the encoder switch are buttons 0-12.  A
+#  keymap is a table with one entry per button giving the CHIP8 key (0-F)
+#  it stands for, or None if the button isn't used by the game.  Once per
+#  frame the front end drains the key event queue into the Keypad and
+#  hands the machine a 16 bit mask of the CHIP8 keys that are down (see
+#  Chip8.set_keys).
+#
+#  A button pressed and let go between two frames still shows as down for
+#  one frame so short taps aren't lost.
+#
+
+# Buttons
+KEY_COUNT = 12
+ENCODER_SWITCH = 12
+BUTTONS = 13
+
+# The macropad's keys are laid out 3 wide and 4 high:
+#
+#     1 2 3
+#     4 5 6
+#     7 8 9
+#     A 0 B
+#
+DEFAULT_KEYMAP = (0x1, 0x2, 0x3,
+                  0x4, 0x5, 0x6,
+                  0x7, 0x8, 0x9,
+                  0xA, 0x0, 0xB,
+                  None)
+
+
+class Keypad:
+    """ Turns button events into the CHIP8 keys mask through a keymap """
+
+    def __init__(self, keymap=DEFAULT_KEYMAP):
+        self.set_keymap(keymap)
+
+    def set_keymap(self, keymap):
+        """ Use a new keymap, every button is let go """
+
+        if len(keymap) != BUTTONS:
+            raise ValueError("keymap needs %d entries, has %d" % (BUTTONS, len(keymap)))
+        for key in keymap:
+            if key is not None and not 0 <= key <= 0xF:
+                raise ValueError("bad CHIP8 key in keymap: %r" % (key,))
+        self.keymap = tuple(keymap)
+        self._bits = tuple(0 if key is None else 1 << key for key in keymap)
+        self.clear()
+
+    def clear(self):
+        """ Let go of every button """
+
+        self.down = 0           # Buttons down, bit n for button n
+        self._tapped = 0        # Buttons pressed since the last frame()
+        self.keys = 0           # CHIP8 keys mask returned by the last frame()
+
+    def mapped(self, button):
+        """ True if the button stands for a CHIP8 key """
+
+        return self.keymap[button] is not None
+
+    def button(self, number, pressed):
+        """ A button went down or up """
+
+        bit = 1 << number
+        if pressed:
+            self.down |= bit
+            self._tapped |= bit
+        else:
+            self.down &= ~bit
+
+    def drain(self, events, event=None):
+        """ Take every event waiting in a keypad.EventQueue.  If a
+        keypad.Event is given it is reused so nothing is allocated
+        """
+
+        if event is None:
+            event = events.get()
+            while event:
+                self.button(event.key_number, event.pressed)
+                event = events.get()
+        else:
+            while events.get_into(event):
+                self.button(event.key_number, event.pressed)
+
+    def switch(self, pressed):
+        """ The encoder switch's current state, it is a button like the keys """
+
+        if pressed != bool(self.down >> ENCODER_SWITCH & 1):
+            self.button(ENCODER_SWITCH, pressed)
+
+    def frame(self):
+        """ Called once per frame, returns the mask of CHIP8 keys down """
+
+        buttons = self.down | self._tapped
+        self._tapped = 0
+        keys = 0
+        bits = self._bits
+        number = 0
+        while buttons:
+            if buttons & 1:
+                keys |= bits[number]
+            buttons >>= 1
+            number += 1
+        self.keys = keys
+        return keys
+
+
+# What LongPress.update() reports
+SHORT = 1
+LONG = 2
+
+
+class LongPress:
+    """ Tells short presses of one button from long ones
+
+    update() is called every frame with the button's state and the time in
+    nanoseconds.  It returns LONG once the button has been held for
+    hold_ns, SHORT when it is let go before that, and 0 otherwise
+    """
+
+    def __init__(self, hold_ns=1500000000):
+        self.hold_ns = hold_ns
+        self.clear()
+
+    def clear(self):
+        """ Forget a press in progress """
+
+        self._down_at = None
+        self._long = False
+
+    def update(self, pressed, now):
+        if pressed:
+            if self._down_at is None:
+                self._down_at = now
+                self._long = False
+            elif not self._long and now - self._down_at >= self.hold_ns:
+                self._long = True
+                return LONG
+            return 0
+        if self._down_at is None:
+            return 0
+        self._down_at = None
+        return 0 if self._long else SHORT
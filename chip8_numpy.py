@@ -0,0 +1,553 @@
+# chip8_numpy.py
+#
+#  Lockstep CHIP8 engine for running thousands of machines at once
+#
+#  The state of every machine lives in NumPy arrays - memory is an
+#  (N, 4096) uint8 array, the registers (N, 16), and the framebuffer
+#  (N, 32) uint64 rows packed the same way as chip8.Chip8 (bit 63 is
+#  x = 0).  Each step fetches one instruction for every running machine,
+#  groups the machines by opcode and runs each group with masked array
+#  operations, so the opcode semantics are the same as chip8.py for the
+#  whole batch at once.  Every machine has its own copy of chip8.py's
+#  xorshift random number generator, stepped for the whole group at once,
+#  so machine i gives the same numbers as chip8.Chip8 after seed(seeds[i]).
+#
+#  Where chip8.py would raise (a RET with an empty stack, a CALL with a
+#  full one, memory accessed past 0xFFF) the machine is stopped and flagged in error.
+#
+#  This is for a PC with numpy installed, not the macropad:
+#
+#     python chip8_numpy.py "roms/Tetris.ch8" --machines 4096 --frames 600
+#     python chip8_numpy.py --check --frames 600
+#
+
+# Imports
+#
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+import chip8
+import chip8_tools
+
+# Deepest stack a machine can use, deeper calls stop it with an error as
+# they do in chip8.py
+STACK_DEPTH = chip8.STACK_DEPTH
+
+
+class BatchChip8:
+    """ count CHIP8 machines stepped together
+
+    seeds gives each machine's random number seed, range(count) if not
+    given, and quirks the chip8.QUIRKS they all run with.  Load a ROM into
+    all of them with load_rom() and call run_frame() or run_cycles(n).
+    """
+
+    def __init__(self, count, cycles_per_frame=15, seeds=None, quirks=()):
+        if np is None:
+            raise ImportError("BatchChip8 needs numpy")
+        self.count = count
+        self.cycles_per_frame = cycles_per_frame
+        if seeds is None:
+            seeds = range(count)
+        self.seeds = list(seeds)
+        if len(self.seeds) != count:
+            raise ValueError("need one seed per machine")
+
+        self.memory = np.zeros((count, 4096), dtype=np.uint8)
+        self.regs = np.zeros((count, 16), dtype=np.uint8)
+        self.framebuffer = np.zeros((count, chip8.HEIGHT), dtype=np.uint64)
+        self.stack = np.zeros((count, STACK_DEPTH), dtype=np.int32)
+        self.sp = np.zeros(count, dtype=np.int32)
+        self.index_reg = np.zeros(count, dtype=np.int32)
+        self.pc = np.zeros(count, dtype=np.int32)
+        self.delay_timer = np.zeros(count, dtype=np.int32)
+        self.sound_timer = np.zeros(count, dtype=np.int32)
+        self.keys = np.zeros(count, dtype=np.int32)
+        self.keys_released = np.zeros(count, dtype=np.int32)
+        self.cycles = np.zeros(count, dtype=np.int64)
+        self.traps = np.zeros(count, dtype=np.int64)
+        self.rng = np.zeros(count, dtype=np.uint32)
+        self.error = np.zeros(count, dtype=bool)
+        self.end_addr = 0xFFF
+        self.set_quirks(quirks)
+        self.reset()
+
+    def set_quirks(self, quirks):
+        """ Pick the opcode groups for quirks, see chip8.Chip8.set_quirks """
+
+        for quirk in quirks:
+            if quirk not in chip8.QUIRKS:
+                raise ValueError("unknown quirk: %r" % (quirk,))
+        self.quirks = tuple(quirk for quirk in chip8.QUIRKS if quirk in quirks)
+        self._groups = [getattr(self, name) for name in _GROUPS]
+        if "jump" in quirks:
+            self._groups[0xB] = self._group_b_vx
+        if "wrap" in quirks:
+            self._groups[0xD] = self._group_d_wrap
+        self._shift_vy = "shift" in quirks
+        self._memory_inc = "memory" in quirks
+
+    def reset(self):
+        """ Put every machine back to its power on state with the font loaded """
+
+        font = chip8_tools.load_font(bytearray(4096))
+        self.memory[:] = np.frombuffer(bytes(font), dtype=np.uint8)
+        for array in (self.regs, self.framebuffer, self.stack, self.sp,
+                      self.index_reg, self.delay_timer, self.sound_timer,
+                      self.keys, self.keys_released, self.cycles, self.traps,
+                      self.error):
+            array[:] = 0
+        self.pc[:] = 0x200
+        self.end_addr = 0xFFF
+        self.rng[:] = [chip8.rng_state(seed) for seed in self.seeds]
+
+    def load_rom(self, rom, start_addr=0x200):
+        """ Load the same ROM into every machine, returns the end address """
+
+        memory = bytearray(self.memory[0].tobytes())
+        info = chip8_tools.load_rom(memory, rom, start_addr)
+        self.memory[:] = np.frombuffer(bytes(memory), dtype=np.uint8)
+        self.end_addr = info.end_addr
+        self.pc[:] = start_addr
+        return self.end_addr
+
+    @property
+    def running(self):
+        """ Mask of the machines still running """
+
+        return (self.pc <= self.end_addr) & ~self.error
+
+    def press_key(self, key, which=None):
+        """ A key went down on the machines in which (a mask or indexes,
+        all of them if None)
+        """
+
+        which = slice(None) if which is None else which
+        self.keys[which] |= 1 << key
+
+    def release_key(self, key, which=None):
+        """ A key went up, see chip8.Chip8.release_key.  Returns the mask
+        of machines that had it down
+        """
+
+        released = (self.keys >> key & 1) != 0
+        if which is not None:
+            mask = np.zeros(self.count, dtype=bool)
+            mask[which] = True
+            released &= mask
+        self.keys[released] &= ~(1 << key)
+        self.keys_released[released] |= 1 << key
+        return released
+
+    def tick_timers(self):
+        np.maximum(self.delay_timer - 1, 0, out=self.delay_timer)
+        np.maximum(self.sound_timer - 1, 0, out=self.sound_timer)
+        self.keys_released[:] = 0
+
+    def run_frame(self):
+        """ cycles_per_frame instructions on every machine then a timer tick """
+
+        self.run_cycles(self.cycles_per_frame)
+        self.tick_timers()
+
+    def run_cycles(self, n):
+        """ Step every running machine n times """
+
+        for cycle in range(n):
+            if not self.step():
+                break
+
+    def _fail(self, m, bad):
+        # Stop the machines in m where bad is set, returns the rest of m
+        if bad.any():
+            self.error[m[bad]] = True
+            return m[~bad], ~bad
+        return m, None
+
+    def step(self):
+        """ Execute one instruction on every running machine, returns the
+        number of machines that ran one
+        """
+
+        active = np.flatnonzero(self.running)
+        if not len(active):
+            return 0
+        pc = self.pc[active]
+
+        # The second byte of an instruction at 0xFFF is past the end of
+        # memory, which chip8.py fails on
+        active, keep = self._fail(active, pc + 1 > 0xFFF)
+        if keep is not None:
+            pc = pc[keep]
+            if not len(active):
+                return 0
+
+        memory = self.memory
+        high = memory[active, pc].astype(np.int32)
+        low = memory[active, pc + 1].astype(np.int32)
+        self.pc[active] = pc + 2
+        self.cycles[active] += 1
+
+        kind = high >> 4
+        x = high & 0xF
+        y = low >> 4
+        n = low & 0xF
+        nnn = ((high & 0xF) << 8) | low
+
+        for op in np.flatnonzero(np.bincount(kind, minlength=16)):
+            sel = kind == op
+            self._groups[op](active[sel], x[sel], y[sel], n[sel], low[sel], nnn[sel])
+        return len(active)
+
+    # Opcode groups - each gets the machines m running that group this
+    # step and their decoded fields, with the pc already moved on
+
+    def _group_0(self, m, x, y, n, nn, nnn):
+        cls = (x == 0) & (nn == 0xE0)
+        ret = (x == 0) & (nn == 0xEE)
+        if cls.any():
+            self.framebuffer[m[cls]] = 0
+        if ret.any():
+            r = m[ret]
+            r, keep = self._fail(r, self.sp[r] == 0)
+            self.sp[r] -= 1
+            self.pc[r] = self.stack[r, self.sp[r]]
+        self.traps[m[~(cls | ret)]] += 1
+
+    def _group_1(self, m, x, y, n, nn, nnn):            # JP nnn
+        self.pc[m] = nnn
+
+    def _group_2(self, m, x, y, n, nn, nnn):            # CALL nnn
+        m, keep = self._fail(m, self.sp[m] >= STACK_DEPTH)
+        if keep is not None:
+            nnn = nnn[keep]
+        self.stack[m, self.sp[m]] = self.pc[m]
+        self.sp[m] += 1
+        self.pc[m] = nnn
+
+    def _group_3(self, m, x, y, n, nn, nnn):            # SE Vx, nn
+        self.pc[m] += 2 * (self.regs[m, x] == nn)
+
+    def _group_4(self, m, x, y, n, nn, nnn):            # SNE Vx, nn
+        self.pc[m] += 2 * (self.regs[m, x] != nn)
+
+    def _group_5(self, m, x, y, n, nn, nnn):            # SE Vx, Vy
+        self.pc[m] += 2 * (self.regs[m, x] == self.regs[m, y])
+
+    def _group_6(self, m, x, y, n, nn, nnn):            # LD Vx, nn
+        self.regs[m, x] = nn
+
+    def _group_7(self, m, x, y, n, nn, nnn):            # ADD Vx, nn
+        self.regs[m, x] = (self.regs[m, x].astype(np.int32) + nn) & 0xFF
+
+    def _group_8(self, m, x, y, n, nn, nnn):
+        regs = self.regs
+        vx = regs[m, x].astype(np.int32)
+        vy = regs[m, y].astype(np.int32)
+        result = vx.copy()
+        # The shift quirk shifts Vy, the rest shift Vx
+        shifted = vy if self._shift_vy else vx
+        flag = None
+        for op in np.flatnonzero(np.bincount(n, minlength=16)):
+            sel = n == op
+            if op == 0x0:
+                result[sel] = vy[sel]
+            elif op == 0x1:
+                result[sel] = vx[sel] | vy[sel]
+            elif op == 0x2:
+                result[sel] = vx[sel] & vy[sel]
+            elif op == 0x3:
+                result[sel] = vx[sel] ^ vy[sel]
+            elif op in (0x4, 0x5, 0x6, 0x7, 0xE):
+                if flag is None:
+                    flag = np.full(len(m), -1, dtype=np.int32)
+                a = vx[sel]
+                b = vy[sel]
+                if op == 0x4:
+                    result[sel] = (a + b) & 0xFF
+                    flag[sel] = (a + b) > 255
+                elif op == 0x5:
+                    result[sel] = (a - b) & 0xFF
+                    flag[sel] = a > b
+                elif op == 0x6:
+                    a = shifted[sel]
+                    result[sel] = a >> 1
+                    flag[sel] = a & 0x1
+                elif op == 0x7:
+                    result[sel] = (b - a) & 0xFF
+                    flag[sel] = b > a
+                else:
+                    a = shifted[sel]
+                    result[sel] = (a << 1) & 0xFF
+                    flag[sel] = (a & 0x80) >> 7
+            else:
+                # Unknown 8xyN - trapped and otherwise ignored
+                self.traps[m[sel]] += 1
+
+        # The result first then the flag, so VF as the target ends up
+        # holding the flag like chip8.py
+        regs[m, x] = result
+        if flag is not None:
+            flagged = flag >= 0
+            regs[m[flagged], 0xF] = flag[flagged]
+
+    def _group_9(self, m, x, y, n, nn, nnn):            # SNE Vx, Vy
+        self.pc[m] += 2 * (self.regs[m, x] != self.regs[m, y])
+
+    def _group_a(self, m, x, y, n, nn, nnn):            # LD I, nnn
+        self.index_reg[m] = nnn
+
+    def _group_b(self, m, x, y, n, nn, nnn):            # JP V0, nnn
+        self.pc[m] = self.regs[m, 0].astype(np.int32) + nnn
+
+    def _group_b_vx(self, m, x, y, n, nn, nnn):         # JP Vx, nnn (jump quirk)
+        self.pc[m] = self.regs[m, x].astype(np.int32) + nnn
+
+    def _group_c(self, m, x, y, n, nn, nnn):            # RND Vx, nn
+        # chip8.Chip8.random_byte for every machine in the group
+        rng = self.rng[m]
+        rng ^= (rng << 7) & 0xFFFF
+        rng ^= rng >> 9
+        rng ^= (rng << 8) & 0xFFFF
+        self.rng[m] = rng
+        self.regs[m, x] = rng & nn
+
+    def _group_d(self, m, x, y, n, nn, nnn):            # DRW Vx, Vy, n
+        regs = self.regs
+        fb = self.framebuffer
+        x_coord = regs[m, x].astype(np.int32) % chip8.WIDTH
+        y_coord = regs[m, y].astype(np.int32) % chip8.HEIGHT
+        rows = np.minimum(n, chip8.HEIGHT - y_coord)
+        index_reg = self.index_reg[m]
+
+        # chip8.py fails reading a sprite row past the end of memory
+        bad = (rows > 0) & (index_reg + rows - 1 > 0xFFF)
+        m, keep = self._fail(m, bad)
+        if keep is not None:
+            x_coord = x_coord[keep]
+            y_coord = y_coord[keep]
+            rows = rows[keep]
+            index_reg = index_reg[keep]
+
+        right = x_coord <= chip8.WIDTH - 8
+        shift = np.where(right, chip8.WIDTH - 8 - x_coord, 0).astype(np.uint64)
+        clip = np.where(right, 0, x_coord - (chip8.WIDTH - 8)).astype(np.uint64)
+
+        collision = np.zeros(len(m), dtype=np.uint64)
+        for row in range(int(rows.max()) if len(rows) else 0):
+            live = row < rows
+            lm = m[live]
+            row_y = y_coord[live] + row
+            byte = self.memory[lm, index_reg[live] + row].astype(np.uint64)
+            sprite = (byte >> clip[live]) << shift[live]
+            current = fb[lm, row_y]
+            collision[live] |= current & sprite
+            fb[lm, row_y] = current ^ sprite
+        regs[m, 0xF] = collision != 0
+
+    def _group_d_wrap(self, m, x, y, n, nn, nnn):       # DRW Vx, Vy, n (wrap quirk)
+        regs = self.regs
+        fb = self.framebuffer
+        x_coord = (regs[m, x].astype(np.int32) % chip8.WIDTH).astype(np.uint64)
+        y_coord = regs[m, y].astype(np.int32) % chip8.HEIGHT
+        index_reg = self.index_reg[m]
+
+        bad = (n > 0) & (index_reg + n - 1 > 0xFFF)
+        m, keep = self._fail(m, bad)
+        if keep is not None:
+            x_coord = x_coord[keep]
+            y_coord = y_coord[keep]
+            n = n[keep]
+            index_reg = index_reg[keep]
+
+        # Rotate each sprite byte into place, a rotate by 0 is left alone
+        # as shifting a uint64 by 64 isn't defined
+        back = (chip8.WIDTH - x_coord) % chip8.WIDTH
+        collision = np.zeros(len(m), dtype=np.uint64)
+        for row in range(int(n.max()) if len(n) else 0):
+            live = row < n
+            lm = m[live]
+            row_y = (y_coord[live] + row) % chip8.HEIGHT
+            wide = self.memory[lm, index_reg[live] + row].astype(np.uint64) << np.uint64(56)
+            sprite = (wide >> x_coord[live]) | np.where(back[live] == 0, np.uint64(0),
+                                                       wide << back[live])
+            current = fb[lm, row_y]
+            collision[live] |= current & sprite
+            fb[lm, row_y] = current ^ sprite
+        regs[m, 0xF] = collision != 0
+
+    def _group_e(self, m, x, y, n, nn, nnn):
+        skp = nn == 0x9E
+        sknp = nn == 0xA1
+        for sel, skip_if_down in ((skp, True), (sknp, False)):
+            if sel.any():
+                s = m[sel]
+                # Shifting by 16 or more leaves nothing of a 16 bit mask
+                shift = np.minimum(self.regs[s, x[sel]], 16)
+                down = (self.keys[s] >> shift & 1) != 0
+                self.pc[s] += 2 * (down if skip_if_down else ~down)
+        self.traps[m[~(skp | sknp)]] += 1
+
+    def _group_f(self, m, x, y, n, nn, nnn):
+        regs = self.regs
+        memory = self.memory
+        for op in np.flatnonzero(np.bincount(nn, minlength=256)):
+            sel = nn == op
+            s = m[sel]
+            xs = x[sel]
+            if op == 0x07:                              # LD Vx, DT
+                regs[s, xs] = self.delay_timer[s]
+            elif op == 0x0A:                            # LD Vx, K
+                released = self.keys_released[s]
+                waiting = released == 0
+                self.pc[s[waiting]] -= 2
+                got = s[~waiting]
+                # Lowest key let go, each release is only taken once
+                bit = released[~waiting] & -released[~waiting]
+                self.keys_released[got] &= ~bit
+                regs[got, xs[~waiting]] = np.log2(bit).astype(np.uint8)
+            elif op == 0x15:                            # LD DT, Vx
+                self.delay_timer[s] = regs[s, xs]
+            elif op == 0x18:                            # LD ST, Vx
+                self.sound_timer[s] = regs[s, xs]
+            elif op == 0x1E:                            # ADD I, Vx
+                self.index_reg[s] += regs[s, xs]
+            elif op == 0x29:                            # LD F, Vx
+                self.index_reg[s] = 0x50 + 5 * regs[s, xs].astype(np.int32)
+            elif op == 0x33:                            # LD B, Vx
+                s, keep = self._fail(s, self.index_reg[s] + 2 > 0xFFF)
+                if keep is not None:
+                    xs = xs[keep]
+                value = regs[s, xs]
+                index_reg = self.index_reg[s]
+                memory[s, index_reg] = value // 100 % 10
+                memory[s, index_reg + 1] = value // 10 % 10
+                memory[s, index_reg + 2] = value % 10
+            elif op == 0x55 or op == 0x65:              # LD [I], Vx / LD Vx, [I]
+                s, keep = self._fail(s, self.index_reg[s] + xs > 0xFFF)
+                if keep is not None:
+                    xs = xs[keep]
+                index_reg = self.index_reg[s]
+                for reg in range(int(xs.max()) + 1 if len(xs) else 0):
+                    live = reg <= xs
+                    lm = s[live]
+                    if op == 0x55:
+                        memory[lm, index_reg[live] + reg] = regs[lm, reg]
+                    else:
+                        regs[lm, reg] = memory[lm, index_reg[live] + reg]
+                if self._memory_inc:
+                    self.index_reg[s] += xs + 1
+            else:
+                self.traps[s] += 1
+
+    def frame_bytes(self, which):
+        """ The framebuffer of one machine as 256 bytes, like
+        chip8.Chip8.frame_bytes()
+        """
+
+        return bytearray(self.framebuffer[which].astype(">u8").tobytes())
+
+
+_GROUPS = ["_group_%x" % op for op in range(16)]
+
+
+def check(roms, machines=8, frames=600, instructions_per_frame=15, quirks=()):
+    """ Run each ROM on a batch and on chip8.Chip8 with the same seeds and
+    quirks and compare.  Returns a list of (rom, seed, what differed)
+    """
+
+    import contextlib
+    import io
+
+    failures = []
+    for romname in roms:
+        batch = BatchChip8(machines, instructions_per_frame, quirks=quirks)
+        with contextlib.redirect_stdout(io.StringIO()):
+            batch.load_rom(romname)
+        for frame in range(frames):
+            batch.run_frame()
+
+        for i in range(machines):
+            machine = chip8.Chip8(instructions_per_frame, quirks)
+            machine.seed(batch.seeds[i])
+            with contextlib.redirect_stdout(io.StringIO()):
+                machine.load_rom(romname)
+            error = False
+            try:
+                for frame in range(frames):
+                    machine.run_frame()
+                    if not machine.running:
+                        break
+            except (IndexError, ValueError):
+                error = True
+            if error or batch.error[i]:
+                if error != bool(batch.error[i]):
+                    failures.append((romname, batch.seeds[i], "error"))
+                continue
+            for name, scalar, vector in (
+                    ("framebuffer", machine.framebuffer, [int(row) for row in batch.framebuffer[i]]),
+                    ("regs", bytes(machine.regs), batch.regs[i].tobytes()),
+                    ("pc", machine.pc, int(batch.pc[i])),
+                    ("I", machine.index_reg, int(batch.index_reg[i])),
+                    ("cycles", machine.cycles, int(batch.cycles[i])),
+                    ("traps", machine.traps, int(batch.traps[i])),
+                    ("rng", machine.rng, int(batch.rng[i])),
+                    ("memory", bytes(machine.memory), batch.memory[i].tobytes())):
+                if scalar != vector:
+                    failures.append((romname, batch.seeds[i], name))
+                    break
+    return failures
+
+
+def main(argv=None):
+    import argparse
+    import time
+
+    parser = argparse.ArgumentParser(description="Run CHIP8 machines in lockstep with numpy")
+    parser.add_argument("roms", nargs="*", help="ROM files (default: all of roms.lst)")
+    parser.add_argument("--machines", type=int, default=1024)
+    parser.add_argument("--frames", type=int, default=600)
+    parser.add_argument("--ipf", type=int, default=15, help="instructions per frame")
+    parser.add_argument("--check", action="store_true",
+                        help="compare against chip8.Chip8 instead of timing")
+    parser.add_argument("--quirks", default="", help="comma separated chip8.QUIRKS to run with")
+    args = parser.parse_args(argv)
+
+    quirks = tuple(quirk for quirk in args.quirks.split(",") if quirk)
+    roms = args.roms
+    if not roms:
+        with open("./roms/roms.lst", "r") as file:
+            roms = ["./roms/" + line.strip() for line in file if line.strip()]
+
+    if args.check:
+        failures = check(roms, min(args.machines, 8), args.frames, args.ipf, quirks)
+        for romname, seed, what in failures:
+            print("DIFFERS %s seed %d: %s" % (romname, seed, what))
+        print("%d ROMs checked, %d differences" % (len(roms), len(failures)))
+        return 1 if failures else 0
+
+    total_cycles = 0
+    total_time = 0.0
+    for romname in roms:
+        batch = BatchChip8(args.machines, args.ipf, quirks=quirks)
+        batch.load_rom(romname)
+        start = time.perf_counter()
+        for frame in range(args.frames):
+            batch.run_frame()
+        elapsed = time.perf_counter() - start
+        cycles = int(batch.cycles.sum())
+        total_cycles += cycles
+        total_time += elapsed
+        print("%-50s %12d IPS  %d running  %d errors" % (
+            romname[-50:], cycles / elapsed if elapsed else 0,
+            int(batch.running.sum()), int(batch.error.sum())))
+    print("Total: %d IPS over %d machines" % (total_cycles / total_time if total_time else 0,
+                                             args.machines))
+    return 0
+
+
+if __name__ == "__main__":
+    import sys
+    sys.exit(main())
@@ -0,0 +1,273 @@
+# chip8_profile.py
+#
+#  Opcode profiler for the CHIP8 interpreter
+#
+#  Attaching a Profiler to a machine swaps every handler in its dispatch
+#  tables for a counting wrapper and drops the decoded instruction cache,
+#  and a TranslatingChip8's blocks, so the wrappers get picked up.
+#  Detaching puts the original handlers back and drops them again, so a
+#  machine that isn't being profiled runs exactly the same code as before
+#  with no extra checks per instruction.
+#
+#  It counts executions per opcode and per pc, samples the wall time spent
+#  in each handler, counts the pixels DRW draws and measures how regular
+#  the 60Hz timer ticks are.  The interpreter (chip8.Chip8) is fully
+#  profiled.  With TranslatingChip8 only the instructions that go through a
+#  handler are seen, the ones a block runs inline are not counted.
+#
+#     python chip8_profile.py "roms/Tetris.ch8" --frames 3600
+#
+
+# Imports
+#
+import time
+import json
+
+# Wall time is measured on every SAMPLE_EVERY'th call of each handler
+SAMPLE_EVERY = 16
+
+# Number of hot pcs shown in the text report
+HOT_PCS = 16
+
+# Handlers _decode uses without going through a table
+DIRECT_HANDLERS = ("_op_trap", "_op_ld_vx_dt_idle", "_op_ld_vx_k_idle")
+
+
+def _bits(value):
+    # Number of set bits in a byte
+    count = 0
+    while value:
+        value &= value - 1
+        count += 1
+    return count
+
+
+class Profiler:
+    """ Counts what a machine spends its time on while attached """
+
+    def __init__(self, machine):
+        self.machine = machine
+        self.attached = False
+        self.clear()
+
+    def clear(self):
+        """ Forget everything counted so far """
+
+        self.op_counts = {}
+        self.op_samples = {}
+        self.op_sample_ns = {}
+        self.pc_counts = {}
+        self.drw_calls = 0
+        self.drw_pixels = 0
+        self.ticks = 0
+        self.tick_total_ns = 0
+        self.tick_min_ns = None
+        self.tick_max_ns = 0
+        self._last_tick = None
+
+    def attach(self):
+        """ Swap the machine's handlers for counting ones """
+
+        if self.attached:
+            return
+        machine = self.machine
+        self._saved = {}
+        wrappers = {}
+
+        # Bound methods don't carry a usable name everywhere, so match the
+        # table entries against the machine's _op_ methods by name
+        handlers = [(name, getattr(machine, name)) for name in dir(machine)
+                    if name.startswith("_op_")]
+
+        for table_name in ("_primary", "_sys_table", "_alu_table",
+                           "_key_table", "_misc_table"):
+            table = getattr(machine, table_name)
+            self._saved[table_name] = list(table)
+            for index in range(len(table)):
+                handler = table[index]
+                if handler is None:
+                    continue
+                for name, method in handlers:
+                    if method == handler:
+                        break
+                if name not in wrappers:
+                    wrappers[name] = self._wrap(name, handler)
+                table[index] = wrappers[name]
+
+        # _decode looks the trap and idle handlers up directly
+        for name in DIRECT_HANDLERS:
+            if name not in wrappers:
+                wrappers[name] = self._wrap(name, getattr(machine, name))
+            setattr(machine, name, wrappers[name])
+
+        # Time the timer ticks
+        original_tick = machine.tick_timers
+        clock = time.monotonic_ns
+
+        def tick_timers():
+            now = clock()
+            if self._last_tick is not None:
+                interval = now - self._last_tick
+                self.ticks += 1
+                self.tick_total_ns += interval
+                if self.tick_min_ns is None or interval < self.tick_min_ns:
+                    self.tick_min_ns = interval
+                if interval > self.tick_max_ns:
+                    self.tick_max_ns = interval
+            self._last_tick = now
+            original_tick()
+
+        machine.tick_timers = tick_timers
+        self._drop_cached()
+        self.attached = True
+
+    def detach(self):
+        """ Put the original handlers back """
+
+        if not self.attached:
+            return
+        machine = self.machine
+        for table_name, saved in self._saved.items():
+            getattr(machine, table_name)[:] = saved
+        for name in DIRECT_HANDLERS:
+            delattr(machine, name)
+        del machine.tick_timers
+        self._drop_cached()
+        self.attached = False
+
+    def _drop_cached(self):
+        # Decoded instructions and translated blocks hold on to the
+        # handlers they were built with, throw them away so the current
+        # tables are used
+        machine = self.machine
+        decoded = machine._decoded
+        for addr in range(len(decoded)):
+            decoded[addr] = None
+        if hasattr(machine, "_drop_all"):
+            machine._drop_all()
+
+    def _wrap(self, name, handler):
+        """ A counting wrapper for one handler """
+
+        machine = self.machine
+        name = name.replace("_op_", "")
+        op_counts = self.op_counts
+        op_samples = self.op_samples
+        op_sample_ns = self.op_sample_ns
+        pc_counts = self.pc_counts
+        clock = time.monotonic_ns
+        op_counts[name] = 0
+        op_samples[name] = 0
+        op_sample_ns[name] = 0
+
+        def counted(x, y, n, nn, nnn):
+            pc = machine.pc - 2
+            pc_counts[pc] = pc_counts.get(pc, 0) + 1
+            count = op_counts[name] + 1
+            op_counts[name] = count
+            if count % SAMPLE_EVERY:
+                handler(x, y, n, nn, nnn)
+            else:
+                start = clock()
+                handler(x, y, n, nn, nnn)
+                op_sample_ns[name] += clock() - start
+                op_samples[name] += 1
+
+        if name in ("drw", "drw_wrap"):
+            def counted_drw(x, y, n, nn, nnn):
+                memory = machine.memory
+                index_reg = machine.index_reg
+                for row in range(n):
+                    self.drw_pixels += _bits(memory[(index_reg + row) & 0xFFF])
+                self.drw_calls += 1
+                counted(x, y, n, nn, nnn)
+            return counted_drw
+        return counted
+
+    def report(self):
+        """ Everything counted as a dictionary, ready for JSON """
+
+        total = sum(self.op_counts.values())
+        ops = []
+        for name, count in self.op_counts.items():
+            if not count:
+                continue
+            samples = self.op_samples[name]
+            mean_ns = self.op_sample_ns[name] // samples if samples else None
+            ops.append({"op": name, "count": count,
+                        "share": round(count / total, 4) if total else 0,
+                        "mean_ns": mean_ns})
+        ops.sort(key=lambda op: -op["count"])
+
+        pcs = sorted(self.pc_counts.items(), key=lambda item: -item[1])
+
+        ticks = None
+        if self.ticks:
+            ticks = {"count": self.ticks,
+                     "mean_ns": self.tick_total_ns // self.ticks,
+                     "min_ns": self.tick_min_ns,
+                     "max_ns": self.tick_max_ns}
+
+        return {
+            "instructions": total,
+            "ops": ops,
+            "hot_pcs": [{"pc": "%#05x" % pc, "count": count} for pc, count in pcs],
+            "drw_calls": self.drw_calls,
+            "drw_pixels": self.drw_pixels,
+            "ticks": ticks,
+        }
+
+    def print_report(self):
+        """ Print a sorted summary """
+
+        report = self.report()
+        print("Instructions: %d" % report["instructions"])
+        print("%-12s %10s %7s %9s" % ("op", "count", "share", "mean ns"))
+        for op in report["ops"]:
+            print("%-12s %10d %6.2f%% %9s" % (op["op"], op["count"],
+                                              op["share"] * 100,
+                                              op["mean_ns"] if op["mean_ns"] is not None else "-"))
+        print("Hot pcs:")
+        for entry in report["hot_pcs"][:HOT_PCS]:
+            print("  %s %10d" % (entry["pc"], entry["count"]))
+        print("DRW: %d calls, %d pixels" % (report["drw_calls"], report["drw_pixels"]))
+        ticks = report["ticks"]
+        if ticks:
+            print("Timer ticks: %d, interval mean %.2fms min %.2fms max %.2fms" % (
+                ticks["count"], ticks["mean_ns"] / 1e6, ticks["min_ns"] / 1e6,
+                ticks["max_ns"] / 1e6))
+
+    def dump_json(self, filename):
+        with open(filename, "w") as file:
+            json.dump(self.report(), file)
+
+
+def main(argv=None):
+    import argparse
+    import chip8
+
+    parser = argparse.ArgumentParser(description="Profile a CHIP8 ROM headless")
+    parser.add_argument("rom")
+    parser.add_argument("--frames", type=int, default=3600)
+    parser.add_argument("--ipf", type=int, default=15, help="instructions per frame")
+    parser.add_argument("--json", help="write the report as JSON here")
+    args = parser.parse_args(argv)
+
+    machine = chip8.Chip8(args.ipf)
+    machine.load_rom(args.rom)
+    profiler = Profiler(machine)
+    profiler.attach()
+    try:
+        for frame in range(args.frames):
+            machine.run_frame()
+            if not machine.running:
+                break
+    finally:
+        profiler.detach()
+        profiler.print_report()
+        if args.json:
+            profiler.dump_json(args.json)
+
+
+if __name__ == "__main__":
+    main()
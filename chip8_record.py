@@ -0,0 +1,234 @@
+# chip8_record.py
+#
+#  Input recording and replay for the CHIP8 interpreter
+#
+#  The only things that make two runs of a ROM differ are the keys and the
+#  random numbers.  RND comes from the machine's own generator (see
+#  Chip8.random_byte), which gives the same numbers under circuitpython and
+#  CPython, so a Recorder keeps the state it starts from and logs every key
+#  press and release (and every change of instructions per frame) stamped
+#  with the machine's cycle count.  Replaying feeds the log back into a
+#  headless machine at full speed, so something seen on the macropad can
+#  be reproduced and profiled on a PC:
+#
+#     python chip8_record.py "roms/Tetris.ch8" tetris.rec --profile
+#
+#  File layout, little endian:
+#
+#     0   4s  magic "C8IN"
+#     4   B   version
+#     5   B   quirks, bit n set for chip8.QUIRKS[n] (always 0 in version 1)
+#     6   H   instructions per frame at the start
+#     8   I   random number generator state at the start (in versions 1
+#             and 2 a seed for the random module, which RND no longer uses,
+#             so their RND results don't replay)
+#    12   I   CRC32 of the ROM
+#    16       events, 6 bytes each - I cycle, B kind, B value
+#
+#  Events are applied between frames, at the first frame boundary where
+#  the cycle count has reached their stamp, which is where code.py applies
+#  keys when recording.  Recordings start from boot, a machine resumed
+#  from a save state can't be recorded.
+#
+
+# Imports
+#
+import struct
+
+import chip8
+
+MAGIC = b"C8IN"
+VERSION = 3
+
+# Event kinds
+PRESS = 0
+RELEASE = 1
+SET_IPF = 2
+
+_HEADER = "<4sBBHII"
+_HEADER_SIZE = struct.calcsize(_HEADER)
+_EVENT = "<IBB"
+_EVENT_SIZE = struct.calcsize(_EVENT)
+
+
+class Recording:
+    """ A loaded recording - seed is the random number generator state
+    it started from, events a list of (cycle, kind, value) and quirks the
+    chip8.QUIRKS the machine ran with
+    """
+
+    def __init__(self, seed, instructions_per_frame, checksum, events, quirks=()):
+        self.seed = seed
+        self.instructions_per_frame = instructions_per_frame
+        self.checksum = checksum
+        self.events = events
+        self.quirks = tuple(quirks)
+
+
+class Recorder:
+    """ Passes key presses on to a machine and logs them
+
+    Has the same set_keys, press_key and release_key as the machine so the
+    front end can use either.  The machine's random number generator is
+    seeded with seed, or left where it is if none is given, and the state
+    it starts from is kept in seed.  Raises ValueError if the machine has
+    run since its ROM was loaded, replay() starts from boot.
+    """
+
+    def __init__(self, machine, seed=None):
+        if machine.cycles:
+            raise ValueError("can only record from boot, the machine is at cycle %d"
+                             % machine.cycles)
+        self.machine = machine
+        if seed is not None:
+            machine.seed(seed)
+        self.seed = machine.rng
+        self.instructions_per_frame = machine.cycles_per_frame
+        self.quirks = machine.quirks
+        self.events = bytearray()
+
+    def _log(self, kind, value):
+        self.events += struct.pack(_EVENT, self.machine.cycles, kind, value)
+
+    def press_key(self, key):
+        self._log(PRESS, key)
+        self.machine.press_key(key)
+
+    def release_key(self, key):
+        self._log(RELEASE, key)
+        return self.machine.release_key(key)
+
+    def set_keys(self, keys):
+        # Logged as a press or release for each key that changed
+        changed = self.machine.keys ^ keys
+        key = 0
+        while changed:
+            if changed & 1:
+                self._log(PRESS if keys >> key & 1 else RELEASE, key)
+            changed >>= 1
+            key += 1
+        self.machine.set_keys(keys)
+
+    def set_instructions_per_frame(self, value):
+        self._log(SET_IPF, value)
+        self.machine.cycles_per_frame = value
+
+    def save(self, filename):
+        checksum = self.machine.rom_info.checksum if self.machine.rom_info else 0
+        quirks = 0
+        for bit in range(len(chip8.QUIRKS)):
+            if chip8.QUIRKS[bit] in self.quirks:
+                quirks |= 1 << bit
+        with open(filename, "wb") as file:
+            file.write(struct.pack(_HEADER, MAGIC, VERSION, quirks, self.instructions_per_frame,
+                                   self.seed, checksum))
+            file.write(self.events)
+
+
+def load(filename):
+    """ Read a recording file """
+
+    with open(filename, "rb") as file:
+        data = file.read()
+    if len(data) < _HEADER_SIZE:
+        raise ValueError("recording too short")
+    magic, version, quirks, instructions_per_frame, seed, checksum = \
+        struct.unpack_from(_HEADER, data, 0)
+    if magic != MAGIC or version not in (1, 2, VERSION):
+        raise ValueError("not a version 1 to %d recording" % VERSION)
+    events = []
+    for offset in range(_HEADER_SIZE, len(data) - _EVENT_SIZE + 1, _EVENT_SIZE):
+        events.append(struct.unpack_from(_EVENT, data, offset))
+    return Recording(seed, instructions_per_frame, checksum, events,
+                     [chip8.QUIRKS[bit] for bit in range(len(chip8.QUIRKS)) if quirks >> bit & 1])
+
+
+def replay(machine, recording, extra_frames=0):
+    """ Run a recording on a machine with its ROM loaded, as fast as it
+    will go, with the quirks it was made with.  Carries on for
+    extra_frames after the last event.  Returns the number of frames run
+    """
+
+    if (machine.rom_info is not None and recording.checksum
+            and machine.rom_info.checksum != recording.checksum):
+        raise ValueError("recording is for a different ROM")
+    machine.seed(recording.seed)
+    machine.set_quirks(recording.quirks)
+    machine.cycles_per_frame = recording.instructions_per_frame
+    start_cycles = machine.cycles
+
+    events = recording.events
+    next_event = 0
+    frames = 0
+    after = 0
+    while machine.running:
+        cycles = machine.cycles - start_cycles
+        while next_event < len(events) and events[next_event][0] <= cycles:
+            _, kind, value = events[next_event]
+            if kind == PRESS:
+                machine.press_key(value)
+            elif kind == RELEASE:
+                machine.release_key(value)
+            elif kind == SET_IPF:
+                machine.cycles_per_frame = value
+            next_event += 1
+        if next_event >= len(events):
+            if after >= extra_frames:
+                break
+            after += 1
+        machine.run_frame()
+        frames += 1
+    return frames
+
+
+def main(argv=None):
+    import argparse
+    import binascii
+    import time
+    import chip8_profile
+    import chip8_translate
+
+    parser = argparse.ArgumentParser(description="Replay a CHIP8 input recording headless")
+    parser.add_argument("rom")
+    parser.add_argument("recording")
+    parser.add_argument("--engine", choices=["interp", "translate"], default="interp")
+    parser.add_argument("--extra-frames", type=int, default=0,
+                        help="frames to keep running after the last event")
+    parser.add_argument("--profile", action="store_true", help="profile the replay")
+    parser.add_argument("--quirks", help="comma separated quirks to replay with instead of "
+                                         "the recording's (version 1 recordings have none)")
+    args = parser.parse_args(argv)
+
+    recording = load(args.recording)
+    if args.quirks is not None:
+        recording.quirks = tuple(quirk for quirk in args.quirks.split(",") if quirk)
+        for quirk in recording.quirks:
+            if quirk not in chip8.QUIRKS:
+                parser.error("unknown quirk %r, choose from %s" % (quirk, ",".join(chip8.QUIRKS)))
+
+    # Made with the recording's quirks so replay() leaves the tables the
+    # profiler wraps alone
+    if args.engine == "translate":
+        machine = chip8_translate.TranslatingChip8(15, recording.quirks)
+    else:
+        machine = chip8.Chip8(15, recording.quirks)
+    machine.load_rom(args.rom)
+
+    profiler = None
+    if args.profile:
+        profiler = chip8_profile.Profiler(machine)
+        profiler.attach()
+    start = time.perf_counter()
+    frames = replay(machine, recording, args.extra_frames)
+    elapsed = time.perf_counter() - start
+    if profiler is not None:
+        profiler.detach()
+        profiler.print_report()
+
+    print("%d events, %d frames (%.1fs of play) in %.3fs, %d cycles, framebuffer %08x" % (
+        len(recording.events), frames, frames / 60, elapsed, machine.cycles,
+        binascii.crc32(machine.frame_bytes()) & 0xFFFFFFFF))
+
+
+if __name__ == "__main__":
+    main()
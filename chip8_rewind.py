@@ -0,0 +1,368 @@
+# chip8_rewind.py
+#
+#  Rewind for the CHIP8 interpreter
+#
+#  Every `every` frames the machine is saved (see chip8_state.py) and only
+#  the XOR of the new save state with the previous one is kept, run length
+#  encoded.  Between two snapshots most of the 4K of memory and the screen
+#  don't change, so the delta is mostly zeros and packs down to a few
+#  hundred bytes.  The deltas go into one fixed size ring buffer, the
+#  oldest being dropped when it is full, so memory use never goes over
+#  the cap given - which matters with the RP2040's RAM.
+#
+#  Only the newest snapshot is kept whole.  Stepping back XORs the newest
+#  delta into it, which gives the snapshot before, and restores that.
+#
+#  A delta is a list of runs, each a 4 byte header (zero bytes to skip,
+#  literal bytes following, both little endian 16 bit) and the literal
+#  bytes.  The new state is compared with the old one CHUNK bytes at a
+#  time (SKIP at a time through unchanged stretches) and only the changed
+#  chunks are XORed, straight into the ring, so a capture allocates no
+#  more than the small slices compared.
+#
+#  check() runs ROMs on a PC with random keys and snapshots taken at
+#  random intervals, so deltas of all sizes wrap round small rings, and
+#  steps back through every snapshot comparing it with the save state
+#  taken when it was captured:
+#
+#     python chip8_rewind.py --cap 300 --cap 2048
+#
+
+# Imports
+#
+import struct
+import sys
+import time
+
+import chip8_state
+
+# Bytes compared at a time when looking for changes
+CHUNK = 8
+
+# Bytes compared at a time when skipping, a multiple of CHUNK
+SKIP = 64
+
+_RUN = "<HH"
+_RUN_SIZE = struct.calcsize(_RUN)
+
+
+def encode_delta(old, new, out, offset=0):
+    """ Run length encode old XOR new into out at offset.  The XOR is
+    never built whole: unchanged chunks are found by comparing old with
+    new and only the changed bytes are XORed, straight into out
+
+    Returns the encoded length, or -1 if it doesn't fit in out
+    """
+
+    old = memoryview(old)
+    new = memoryview(new)
+    size = len(new)
+    limit = len(out)
+    pos = 0
+    write = offset
+    while pos < size:
+        # Unchanged chunks to skip
+        start = pos
+        while pos < size:
+            if old[pos:pos + SKIP] == new[pos:pos + SKIP]:
+                pos += SKIP
+            elif old[pos:pos + CHUNK] == new[pos:pos + CHUNK]:
+                pos += CHUNK
+            else:
+                break
+        if pos >= size:
+            break
+        skip = pos - start
+
+        # Changed chunks to XOR in
+        literal_start = pos
+        while pos < size and old[pos:pos + CHUNK] != new[pos:pos + CHUNK]:
+            pos += CHUNK
+        pos = min(pos, size)
+        count = pos - literal_start
+
+        if write + _RUN_SIZE + count > limit:
+            return -1
+        struct.pack_into(_RUN, out, write, skip, count)
+        write += _RUN_SIZE
+        for index in range(literal_start, pos):
+            out[write] = old[index] ^ new[index]
+            write += 1
+    return write - offset
+
+
+def rle_apply(encoded, state):
+    """ XOR an encoded delta into state in place.  Raises ValueError if
+    the delta runs past the end of state
+    """
+
+    pos = 0
+    size = len(encoded)
+    addr = 0
+    while pos < size:
+        skip, count = struct.unpack_from(_RUN, encoded, pos)
+        pos += _RUN_SIZE
+        addr += skip
+        if addr + count > len(state) or pos + count > size:
+            raise ValueError("corrupt rewind delta")
+        for index in range(count):
+            state[addr] ^= encoded[pos]
+            pos += 1
+            addr += 1
+
+
+class Rewind:
+    """ Keeps XOR delta snapshots of a machine in a ring buffer of at most
+    cap bytes
+
+    Call frame() after every frame the machine runs, turbo ones included
+    (chip8_timing.Scheduler's on_frame), and step_back() to rewind.
+    """
+
+    def __init__(self, machine, every=30, cap=16384):
+        self.machine = machine
+        self.every = every
+        self.cap = cap
+        self.ring = bytearray(cap)
+        self._current = bytearray(chip8_state.STATE_SIZE)
+        self._next = bytearray(chip8_state.STATE_SIZE)
+        self.clear()
+
+    def clear(self):
+        """ Forget every snapshot """
+
+        self._offsets = []
+        self._lengths = []
+        self._head = 0
+        self._have_current = False
+        self._current_cycles = None
+        self._frames = 0
+
+        # Statistics
+        self.captures = 0
+        self.capture_ns = 0
+        self.capture_max_ns = 0
+        self.delta_bytes = 0
+        self.frames = 0
+
+    @property
+    def snapshots(self):
+        """ Number of snapshots that can be stepped back to """
+
+        return len(self._offsets) + (1 if self._have_current else 0)
+
+    @property
+    def used(self):
+        """ Bytes of the ring buffer holding deltas """
+
+        return sum(self._lengths)
+
+    @property
+    def memory(self):
+        """ Total bytes allocated for rewind, the ring and the two save
+        states.  A capture allocates only the small slices compared
+        """
+
+        return self.cap + 2 * chip8_state.STATE_SIZE
+
+    def frame(self):
+        """ Called once per machine frame, takes a snapshot every `every`
+        frames
+        """
+
+        self.frames += 1
+        self._frames += 1
+        if self._frames >= self.every:
+            self._frames = 0
+            self.capture()
+
+    def capture(self):
+        """ Take a snapshot now """
+
+        start = time.monotonic_ns()
+        chip8_state.save(self.machine, self._next)
+        if self._have_current:
+            self._store(self._current, self._next)
+        self._current, self._next = self._next, self._current
+        self._have_current = True
+        self._current_cycles = self.machine.cycles
+
+        elapsed = time.monotonic_ns() - start
+        self.captures += 1
+        self.capture_ns += elapsed
+        if elapsed > self.capture_max_ns:
+            self.capture_max_ns = elapsed
+
+    def _store(self, old, new):
+        # Put the delta from old to new at the head of the ring, dropping the oldest ones in
+        # its way.  Deltas are never split, if one doesn't fit before the
+        # end of the ring it goes at the start
+        ring = self.ring
+        offsets = self._offsets
+        lengths = self._lengths
+        while True:
+            length = encode_delta(old, new, ring, self._head)
+            if length >= 0:
+                break
+            if self._head == 0:
+                # Bigger than the whole ring - the history before this
+                # snapshot can't be kept
+                offsets.clear()
+                lengths.clear()
+                return
+            self._head = 0
+        start = self._head
+        end = start + length
+
+        # Drop the newest delta the new one overwrote and every delta older
+        # than it, which can't be reached by stepping back any more.  After
+        # a wrap the overwritten ones needn't be the oldest
+        overwritten = -1
+        for index in range(len(offsets)):
+            if offsets[index] < end and offsets[index] + lengths[index] > start:
+                overwritten = index
+        if overwritten >= 0:
+            del offsets[:overwritten + 1]
+            del lengths[:overwritten + 1]
+        offsets.append(start)
+        lengths.append(length)
+        self._head = end
+        self.delta_bytes += length
+
+    def step_back(self):
+        """ Rewind to the newest snapshot, or to the one before if the
+        machine is still at the newest.  Returns False if there is nothing
+        to go back to
+        """
+
+        if not self._have_current:
+            return False
+        if self.machine.cycles == self._current_cycles:
+            if not self._offsets:
+                return False
+            start = self._offsets.pop()
+            length = self._lengths.pop()
+            rle_apply(memoryview(self.ring)[start:start + length], self._current)
+            self._head = start
+        chip8_state.restore(self.machine, self._current)
+        self._current_cycles = self.machine.cycles
+        self._frames = 0
+        return True
+
+    def stats(self):
+        """ Metrics as a dictionary """
+
+        deltas = self.captures - 1 if self.captures else 0
+        return {
+            "snapshots": self.snapshots,
+            "ring_used": self.used,
+            "memory": self.memory,
+            "bytes_per_snapshot": self.delta_bytes // deltas if deltas else 0,
+            "capture_mean_ns": self.capture_ns // self.captures if self.captures else 0,
+            "capture_max_ns": self.capture_max_ns,
+            "capture_ns_per_frame": self.capture_ns // self.frames if self.frames else 0,
+        }
+
+
+def check(romname, every=30, cap=2048, frames=1800, seed=0, instructions_per_frame=15,
+          quirks=()):
+    """ Run a ROM with random key presses and snapshots every 1 to
+    2 * every frames, stepping back part of the way now and then, and
+    finally all the way.  Every snapshot stepped back to is compared with
+    the save state taken when it was captured.  Returns the number of
+    snapshots checked and a list of failures as (frame, what went wrong)
+    """
+
+    import contextlib
+    import io
+    import random
+
+    import chip8
+
+    machine = chip8.Chip8(instructions_per_frame, quirks)
+    with contextlib.redirect_stdout(io.StringIO()):
+        machine.load_rom(romname)
+    machine.seed(seed)
+    keys = random.Random(seed)
+    rewind = Rewind(machine, every, cap)
+    saved = {}
+    checked = 0
+    failures = []
+
+    def step_back(count):
+        # Step back count snapshots (all of them if None), checking each
+        nonlocal checked
+        while count is None or count > 0:
+            try:
+                if not rewind.step_back():
+                    break
+            except ValueError as e:
+                failures.append((frame, "step back: %s" % e))
+                return False
+            state = saved.get(machine.cycles)
+            if state != bytes(chip8_state.save(machine)):
+                failures.append((frame, "snapshot at cycle %d differs" % machine.cycles))
+                return False
+            checked += 1
+            if count is not None:
+                count -= 1
+        return True
+
+    next_capture = keys.randint(1, 2 * every)
+    frame = 0
+    try:
+        for frame in range(frames):
+            if keys.random() < 0.1:
+                machine.set_keys(1 << keys.randrange(16) if keys.random() < 0.7 else 0)
+            machine.run_frame()
+            if not machine.running:
+                break
+            next_capture -= 1
+            if next_capture == 0:
+                next_capture = keys.randint(1, 2 * every)
+                rewind.capture()
+                saved[machine.cycles] = bytes(rewind._current)
+                if keys.random() < 0.05 and not step_back(keys.randint(1, 4)):
+                    return checked, failures
+    except (IndexError, ValueError):
+        # The ROM itself stopped, check what was captured up to here
+        pass
+    expected = rewind.snapshots
+    before = checked
+    if step_back(None) and checked - before != expected:
+        failures.append((frame, "stepped back %d of %d snapshots" % (checked - before, expected)))
+    return checked, failures
+
+
+def main(argv=None):
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Check rewind against saved states")
+    parser.add_argument("roms", nargs="*", help="ROM files (default: all of roms.lst)")
+    parser.add_argument("--every", type=int, default=30, help="mean frames between snapshots")
+    parser.add_argument("--cap", type=int, action="append",
+                        help="ring buffer bytes, can be repeated (default: 300, 2048 and 16384)")
+    parser.add_argument("--frames", type=int, default=1800)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+
+    roms = args.roms
+    if not roms:
+        with open("./roms/roms.lst", "r") as file:
+            roms = ["./roms/" + line.strip() for line in file if line.strip()]
+
+    total = 0
+    failed = 0
+    for cap in args.cap or [300, 2048, 16384]:
+        for romname in roms:
+            checked, failures = check(romname, args.every, cap, args.frames, args.seed)
+            total += checked
+            for frame, what in failures:
+                failed += 1
+                print("FAIL %s cap %d frame %d: %s" % (romname, cap, frame, what))
+    print("%d ROMs, %d snapshots checked, %d failures" % (len(roms), total, failed))
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,142 @@
+# chip8_state.py
+#
+#  Save states for the CHIP8 interpreter
+#
+#  The whole machine - memory, V0-VF, I, pc, stack, timers, key state,
+#  random number generator and framebuffer - is packed into one fixed layout binary blob of STATE_SIZE
+#  bytes.  Saving packs straight into a buffer that can be reused, and
+#  restoring copies the blob straight into the machine's own memory,
+#  register, stack and framebuffer buffers, so nothing is allocated per
+#  field.
+#
+#  Layout (version 3, little endian unless noted):
+#
+#     0    4s   magic "C8SV"
+#     4    B    version
+#     5    B    stack depth
+#     6    H    I
+#     8    H    pc
+#    10    H    end address of the ROM
+#    12    I    CRC32 of the ROM, 0 if not known
+#    16    Q    cycles executed
+#    24    B    delay timer
+#    25    B    sound timer
+#    26    H    keys down mask
+#    28    H    keys released mask
+#    30    H    random number generator state (padding in version 2)
+#    32    16s  V0-VF
+#    48    16H  stack, unused entries zero
+#    80    4096 memory
+#  4176    32Q  framebuffer rows, big endian so it matches frame_bytes()
+#  4432         end
+#
+
+# Imports
+#
+import struct
+
+import chip8
+
+MAGIC = b"C8SV"
+VERSION = 3
+
+# Return addresses a save state holds, the whole of the machine's stack
+STACK_SIZE = chip8.STACK_DEPTH
+
+_HEADER = "<4sBBHHHIQBBHHH"
+REGS_OFFSET = struct.calcsize(_HEADER)
+STACK_OFFSET = REGS_OFFSET + 16
+MEMORY_OFFSET = STACK_OFFSET + 2 * STACK_SIZE
+FRAME_OFFSET = MEMORY_OFFSET + 4096
+STATE_SIZE = FRAME_OFFSET + 8 * chip8.HEIGHT
+
+_FRAME = ">%dQ" % chip8.HEIGHT
+_EMPTY_STACK = bytes(2 * STACK_SIZE)
+
+
+def save(machine, buffer=None):
+    """ Pack the machine state into buffer, a new one if not given, and
+    return it
+    """
+
+    if buffer is None:
+        buffer = bytearray(STATE_SIZE)
+    depth = machine.sp
+    checksum = machine.rom_info.checksum if machine.rom_info is not None else 0
+
+    struct.pack_into(_HEADER, buffer, 0, MAGIC, VERSION, depth,
+                     machine.index_reg, machine.pc, machine.end_addr, checksum,
+                     machine.cycles, machine.delay_timer, machine.sound_timer,
+                     machine.keys, machine.keys_released, machine.rng)
+    buffer[REGS_OFFSET:STACK_OFFSET] = machine.regs
+    buffer[STACK_OFFSET:MEMORY_OFFSET] = _EMPTY_STACK
+    struct.pack_into("<%dH" % depth, buffer, STACK_OFFSET, *machine.stack[:depth])
+    buffer[MEMORY_OFFSET:FRAME_OFFSET] = machine.memory
+    struct.pack_into(_FRAME, buffer, FRAME_OFFSET, *machine.framebuffer)
+    return buffer
+
+
+def restore(machine, state):
+    """ Put the machine back to a state made by save()
+
+    Raises ValueError if state isn't a save state this version can read,
+    or if it was saved from a different ROM than the one loaded
+    """
+
+    state = memoryview(state)
+    if len(state) != STATE_SIZE:
+        raise ValueError("save state is %d bytes, expected %d" % (len(state), STATE_SIZE))
+    (magic, version, depth, index_reg, pc, end_addr, checksum, cycles,
+     delay_timer, sound_timer, keys, keys_released, rng) = \
+        struct.unpack_from(_HEADER, state, 0)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError("not a version %d save state" % VERSION)
+    if depth > STACK_SIZE:
+        raise ValueError("bad stack depth in save state: %d" % depth)
+    if (machine.rom_info is not None and checksum
+            and checksum != machine.rom_info.checksum):
+        raise ValueError("save state is for a different ROM")
+
+    machine.memory[:] = state[MEMORY_OFFSET:FRAME_OFFSET]
+    machine._invalidate(0, len(machine.memory) - 1)
+    machine.regs[:] = state[REGS_OFFSET:STACK_OFFSET]
+    stack = machine.stack
+    for entry, addr in enumerate(struct.unpack_from("<%dH" % STACK_SIZE, state, STACK_OFFSET)):
+        stack[entry] = addr
+    machine.sp = depth
+    machine.framebuffer[:] = struct.unpack_from(_FRAME, state, FRAME_OFFSET)
+    machine.dirty_rows = chip8.ALL_ROWS
+
+    machine.index_reg = index_reg
+    machine.pc = pc
+    machine.end_addr = end_addr
+    machine.cycles = cycles
+    machine.delay_timer = delay_timer
+    machine.sound_timer = sound_timer
+    machine.keys = keys
+    machine.keys_released = keys_released
+    machine.rng = chip8.rng_state(rng)
+
+
+def save_file(machine, filename, buffer=None):
+    """ Save the machine state to a file """
+
+    buffer = save(machine, buffer)
+    with open(filename, "wb") as file:
+        file.write(buffer)
+    return buffer
+
+
+def load_file(machine, filename, buffer=None):
+    """ Restore the machine state from a file, reading it into buffer if
+    given so nothing new is allocated
+    """
+
+    if buffer is None:
+        buffer = bytearray(STATE_SIZE)
+    with open(filename, "rb") as file:
+        size = file.readinto(buffer)
+    if size != STATE_SIZE:
+        raise ValueError("save state file is %d bytes, expected %d" % (size, STATE_SIZE))
+    restore(machine, buffer)
+    return buffer
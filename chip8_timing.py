@@ -0,0 +1,224 @@
+# chip8_timing.py
+#
+#  Frame scheduler for the CHIP8 interpreter
+#
+#  The CHIP8 timers run at 60Hz, so the interpreter is paced a frame at a
+#  time: run a fixed number of instructions, do exactly one timer and
+#  display tick, then sleep for whatever is left of the 1/60 s.  Deadlines
+#  are kept as absolute times so a slow frame is made up by not sleeping
+#  after the next ones, and if we fall too far behind we give up on the
+#  missed frames rather than running flat out to catch up
+#
+#  In turbo mode each 1/60 s runs `turbo` frames of the machine, timers and
+#  all, and only the last one is shown, so the game runs that many times
+#  faster without the display having to keep up
+#
+#  The time spent running instructions and presenting is measured every
+#  frame.  With max_skip set, a frame that is already past its deadline
+#  once its instructions have run isn't presented (at most max_skip in a
+#  row), so a slow display costs pictures rather than game speed.  Sound
+#  is never skipped, it is updated every 1/60 s whether the frame is shown
+#  or not.
+#
+#  SimClock stands in for the real clock and sleep to try all this
+#  headless, together with a slow chip8_display.StubDisplay:
+#
+#     python chip8_timing.py "roms/Tetris.ch8" --refresh-ms 25 --max-skip 4
+#
+
+# Imports
+#
+import time
+
+# Nanoseconds per second
+NS = 1000000000
+
+
+class Scheduler:
+    """ Runs a machine at a fixed number of instructions per 60Hz frame
+
+    on_tick is called after the timers tick in every frame that is shown,
+    for the display.  on_sound(sounding) is called every 1/60 s, shown or
+    not, with whether the sound timer was running after any of the
+    machine frames it ran, so skipping and turbo never delay or lose a
+    beep.  on_frame is called after every machine frame, turbo ones
+    included.  max_skip is the most frames in a row that may go unshown when
+    running late.  clock and sleep can be replaced for testing, clock
+    returns integer nanoseconds.
+    """
+
+    def __init__(self, machine, instructions_per_frame=None, hz=60,
+                 on_tick=None, max_behind=4, max_skip=0,
+                 clock=time.monotonic_ns, sleep=time.sleep, on_sound=None,
+                 on_frame=None):
+        self.machine = machine
+        if instructions_per_frame is not None:
+            machine.cycles_per_frame = instructions_per_frame
+        self.hz = hz
+        self.period = NS // hz
+        self.on_tick = on_tick
+        self.on_sound = on_sound
+        self.on_frame = on_frame
+        self.max_behind = max_behind
+        self.max_skip = max_skip
+        self.clock = clock
+        self.sleep = sleep
+
+        # Machine frames per 1/60 s
+        self.turbo = 1
+
+        # Statistics - periods counts calls of run_frame, frames the machine
+        # frames run and presented the ones on_tick was called for.
+        # run_ns and present_ns are smoothed costs of the last frames
+        self.periods = 0
+        self.frames = 0
+        self.presented = 0
+        self.skipped_frames = 0
+        self.dropped_frames = 0
+        self.run_ns = 0
+        self.present_ns = 0
+        self._skipped = 0
+        self.ips = 0
+        self.fps = 0.0
+        self.restart()
+
+    @property
+    def instructions_per_frame(self):
+        return self.machine.cycles_per_frame
+
+    @instructions_per_frame.setter
+    def instructions_per_frame(self, value):
+        self.machine.cycles_per_frame = max(1, value)
+
+    def restart(self):
+        """ Start timing from now, forgetting any missed frames """
+
+        now = self.clock()
+        self.next_frame = now + self.period
+        self._report_time = now
+        self._report_frames = self.frames
+        self._report_cycles = self.machine.cycles
+
+    def run_frame(self):
+        """ Run one frame and wait for the start of the next one """
+
+        machine = self.machine
+        clock = self.clock
+        on_frame = self.on_frame
+        start = clock()
+        sounding = False
+        for frame in range(self.turbo):
+            machine.run_frame()
+            if machine.sound_timer > 0:
+                sounding = True
+            if on_frame is not None:
+                on_frame()
+        if self.on_sound is not None:
+            self.on_sound(sounding)
+        now = clock()
+        self.run_ns = (3 * self.run_ns + now - start) // 4
+        self.frames += self.turbo
+        self.periods += 1
+
+        # Present unless we are already late, as long as we haven't
+        # already skipped max_skip frames
+        if self.on_tick is not None:
+            if self._skipped < self.max_skip and now > self.next_frame:
+                self._skipped += 1
+                self.skipped_frames += 1
+            else:
+                self.on_tick()
+                start = now
+                now = clock()
+                self.present_ns = (3 * self.present_ns + now - start) // 4
+                self._skipped = 0
+                self.presented += 1
+
+        # Sleep off the rest of the frame.  If we are late just carry on,
+        # the following frames won't sleep until we have caught up
+        if now < self.next_frame:
+            self.sleep((self.next_frame - now) / NS)
+        elif now - self.next_frame > self.period * self.max_behind:
+            # Too far behind to catch up - drop the missed frames
+            missed = (now - self.next_frame) // self.period
+            self.dropped_frames += missed
+            self.next_frame += missed * self.period
+        self.next_frame += self.period
+
+        # Update the measured speed once a second
+        elapsed = now - self._report_time
+        if elapsed >= NS:
+            self.ips = (self.machine.cycles - self._report_cycles) * NS // elapsed
+            self.fps = (self.frames - self._report_frames) * NS / elapsed
+            self._report_time = now
+            self._report_frames = self.frames
+            self._report_cycles = self.machine.cycles
+
+
+class SimClock:
+    """ Simulated time for running a Scheduler headless - sleep() and
+    advance() move the clock on instead of waiting
+    """
+
+    def __init__(self):
+        self.now = 0
+
+    def clock(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += int(seconds * NS)
+
+    def advance(self, ns):
+        self.now += ns
+
+
+def main(argv=None):
+    import argparse
+    import chip8
+    import chip8_display
+
+    parser = argparse.ArgumentParser(description="Run a ROM against a simulated slow display")
+    parser.add_argument("rom")
+    parser.add_argument("--frames", type=int, default=600, help="60Hz periods to run")
+    parser.add_argument("--ipf", type=int, default=15, help="instructions per frame")
+    parser.add_argument("--refresh-ms", type=float, default=25.0,
+                        help="simulated time each display refresh takes")
+    parser.add_argument("--cpu-ms", type=float, default=2.0,
+                        help="simulated time each frame of instructions takes")
+    parser.add_argument("--max-skip", type=int, default=4)
+    args = parser.parse_args(argv)
+
+    sim = SimClock()
+    machine = chip8.Chip8()
+    machine.load_rom(args.rom)
+    run_frame = machine.run_frame
+
+    def slow_run_frame():
+        sim.advance(int(args.cpu_ms * 1e6))
+        return run_frame()
+
+    machine.run_frame = slow_run_frame
+    bitmap = chip8_display.StubBitmap(128, 64)
+    display = chip8_display.StubDisplay(bitmap, delay=args.refresh_ms / 1000,
+                                        sleep=sim.sleep, clock=sim.clock)
+    presenter = chip8_display.Presenter(display, bitmap)
+    sound = []
+    scheduler = Scheduler(machine, args.ipf, on_tick=lambda: presenter.present(machine),
+                          max_skip=args.max_skip, clock=sim.clock, sleep=sim.sleep,
+                          on_sound=sound.append)
+    for period in range(args.frames):
+        scheduler.run_frame()
+        if not machine.running:
+            break
+
+    seconds = sim.now / NS
+    print("%.2fs simulated: %d frames run (%.1f/s), %d presented, %d skipped, "
+          "%d dropped, %d refreshes, sound on for %d periods" % (
+              seconds, scheduler.frames, scheduler.frames / seconds,
+              scheduler.presented, scheduler.skipped_frames,
+              scheduler.dropped_frames, display.refreshes, sound.count(True)))
+
+
+if __name__ == "__main__":
+    main()
@@ -5,7 +5,10 @@
 
 # Imports
 #
-import time
+import os
+import json
+import binascii
+import collections
 
 def load_font(memory = []):
     """ This routine loads the font into memory starting at address 0x50 as 
@@ -115,140 +118,213 @@ def load_font(memory = []):
     # Return memory with font loaded
     return memory
 
+# Information about a loaded ROM
+RomInfo = collections.namedtuple("RomInfo",
+                                 ["name", "size", "start_addr", "end_addr", "checksum"])
+
+
+def load_rom(memory, rom, start_addr=0x200):
+    """ Load a ROM into memory starting at start_addr
+
+    rom is either a filename or a bytes like object holding the ROM.  A
+    file is read straight into memory through a memoryview with no per byte
+    copying.  ROMs that don't fit between start_addr and the end of memory
+    are rejected with a ValueError before anything is written.  Returns a
+    RomInfo with the size, end address and CRC32 checksum of the ROM
+    """
+
+    space = len(memory) - start_addr
+    view = memoryview(memory)
+
+    if isinstance(rom, str):
+        name = rom
+        size = os.stat(rom)[6]
+        if size > space:
+            raise ValueError("ROM %s is %d bytes, only %d fit at %#x" %
+                             (rom, size, space, start_addr))
+        with open(rom, "rb") as f:
+            f.readinto(view[start_addr:start_addr + size])
+    else:
+        name = None
+        size = len(rom)
+        if size > space:
+            raise ValueError("ROM is %d bytes, only %d fit at %#x" %
+                             (size, space, start_addr))
+        view[start_addr:start_addr + size] = rom
+
+    checksum = binascii.crc32(view[start_addr:start_addr + size]) & 0xFFFFFFFF
+    return RomInfo(name, size, start_addr, start_addr + size - 1, checksum)
+
+
 def read_rom(memory, romname = "IBM Logo.ch8", start_addr=0x200):
     # Function to read a rom into memory starting at address 0x200
     #
     print("ROM: %s, loading at address: %#x" %(romname, start_addr))
-    with open(romname, "rb") as f:
-        while (byte := f.read(1)):
-            memory[start_addr] = list(byte)[0]
-            start_addr += 1
-
-    print("End address: %#x" % (start_addr-1))
-    return [memory, start_addr-1] 
+    info = load_rom(memory, romname, start_addr)
+    print("End address: %#x" % info.end_addr)
+    return [memory, info.end_addr]
 
 def print_memory(memory, start_addr, end_addr):
     # Prints bytes in memory
     for pc in range(start_addr, end_addr+1, 1):
         print("%#x : %#x" % (pc, memory[pc]))
 
-def dissasemble(memory, start_addr, end_addr):
-    # Function to create an assembly code listing of a block of memory
-    # defined by the start and end addresses
+# Instruction decode table shared by the disassembler and the analyzer.
+# Each entry is (mask, value, mnemonic, operands, flow) - an opcode matches
+# when opcode & mask == value.  The operands string lists the fields to
+# show: x/y are registers, n/nn/nnn are the immediate fields and anything
+# else is shown as is.  flow says how the instruction changes the pc:
+#   None       - carries on with the next instruction
+#   "jump"     - goes to nnn
+#   "call"     - calls nnn, comes back to the next instruction
+#   "return"   - returns to the caller
+#   "skip"     - goes to the next instruction or the one after it
+#   "indirect" - goes to V0 + nnn
+#   "wait"     - stays put until a key is pressed
+OPCODES = [
+    (0xFFFF, 0x00E0, "CLS", "", None),
+    (0xFFFF, 0x00EE, "RET", "", "return"),
+    (0xF000, 0x1000, "JP", "nnn", "jump"),
+    (0xF000, 0x2000, "CALL", "nnn", "call"),
+    (0xF000, 0x3000, "SE", "x nn", "skip"),
+    (0xF000, 0x4000, "SNE", "x nn", "skip"),
+    (0xF00F, 0x5000, "SE", "x y", "skip"),
+    (0xF000, 0x6000, "LD", "x nn", None),
+    (0xF000, 0x7000, "ADD", "x nn", None),
+    (0xF00F, 0x8000, "LD", "x y", None),
+    (0xF00F, 0x8001, "OR", "x y", None),
+    (0xF00F, 0x8002, "AND", "x y", None),
+    (0xF00F, 0x8003, "XOR", "x y", None),
+    (0xF00F, 0x8004, "ADD", "x y", None),
+    (0xF00F, 0x8005, "SUB", "x y", None),
+    (0xF00F, 0x8006, "SHR", "x y", None),
+    (0xF00F, 0x8007, "SUBN", "x y", None),
+    (0xF00F, 0x800E, "SHL", "x y", None),
+    (0xF00F, 0x9000, "SNE", "x y", "skip"),
+    (0xF000, 0xA000, "LD", "I nnn", None),
+    (0xF000, 0xB000, "JP", "V0 nnn", "indirect"),
+    (0xF000, 0xC000, "RND", "x nn", None),
+    (0xF000, 0xD000, "DRW", "x y n", None),
+    (0xF0FF, 0xE09E, "SKP", "x", "skip"),
+    (0xF0FF, 0xE0A1, "SKNP", "x", "skip"),
+    (0xF0FF, 0xF007, "LD", "x DT", None),
+    (0xF0FF, 0xF00A, "LD", "x K", "wait"),
+    (0xF0FF, 0xF015, "LD", "DT x", None),
+    (0xF0FF, 0xF018, "LD", "ST x", None),
+    (0xF0FF, 0xF01E, "ADD", "I x", None),
+    (0xF0FF, 0xF029, "LD", "F x", None),
+    (0xF0FF, 0xF033, "LD", "B x", None),
+    (0xF0FF, 0xF055, "LD", "[I] x", None),
+    (0xF0FF, 0xF065, "LD", "x [I]", None),
+]
+
+# The decode table split up by first nibble so decoding only looks at the
+# few entries that can match
+_DECODE = [[] for _ in range(16)]
+for _entry in OPCODES:
+    _DECODE[_entry[1] >> 12].append(_entry)
+
+# A decoded instruction.  mnemonic is "DW" for words that aren't a valid
+# instruction, targets are the addresses flow control can go to
+Instruction = collections.namedtuple("Instruction",
+                                     ["addr", "opcode", "mnemonic", "operands",
+                                      "flow", "targets"])
+
+
+def decode(opcode, addr=0):
+    """ Decode one 16 bit opcode at addr into an Instruction """
+
+    for mask, value, mnemonic, fields, flow in _DECODE[opcode >> 12]:
+        if opcode & mask == value:
+            break
+    else:
+        return Instruction(addr, opcode, "DW", ["%#06x" % opcode], None, [])
+
+    operands = []
+    for field in fields.split():
+        if field == "x":
+            operands.append("V%X" % ((opcode >> 8) & 0xF))
+        elif field == "y":
+            operands.append("V%X" % ((opcode >> 4) & 0xF))
+        elif field == "n":
+            operands.append("%d" % (opcode & 0xF))
+        elif field == "nn":
+            operands.append("%#04x" % (opcode & 0xFF))
+        elif field == "nnn":
+            operands.append("%#05x" % (opcode & 0xFFF))
+        else:
+            operands.append(field)
+
+    if flow == "jump" or flow == "call":
+        targets = [opcode & 0xFFF]
+    elif flow == "skip":
+        targets = [addr + 2, addr + 4]
+    else:
+        targets = []
+    return Instruction(addr, opcode, mnemonic, operands, flow, targets)
+
+
+def disassemble(memory, start_addr, end_addr):
+    """ Generator of the Instructions from start_addr to end_addr """
+
+    for addr in range(start_addr, end_addr + 1, 2):
+        yield decode((memory[addr] << 8) | memory[addr + 1], addr)
+
 
-    for pc in range(start_addr, end_addr+2, 2):
-        # Fetch instruction at PC
-
-        inst_high = memory[pc]
-        inst_low = memory[pc + 1]
-
-        # Increment the program counter
-        pc = pc + 2
-
-        # Break out instruction values here to use later
-        inst_type = (inst_high & 0xF0) >> 4        # First nibble
-        inst_X = inst_high & 0x0F                  # Second nibble
-        inst_Y = (inst_low & 0xF0) >> 4            # Third Nibble
-        inst_N = inst_low & 0x0F                   # Fourth Nibble
-        inst_NN = inst_low                         # Third & Fourth Nibbles
-        inst_NNN = (inst_X << 8) + inst_low        # Second, Third Fouth nibbles
-
-        # Decode instruction type 
-        if inst_type == 0:
-            if inst_Y == 0xE:
-                if inst_N == 0:         # CLS
-                    print("%#x    CLS" % (pc-2))
-                elif inst_N == 0xE:     # RET
-                    print("%#x    RET" % (pc-2)) 
-                else:
-                    print("%#x    NOP    %#x" %(pc-2, (inst_high << 8) + inst_low))
-            else:
-                pass
-        elif inst_type == 1:        # JMP
-            print("%#x    JMP    %#x" % (pc-2, inst_NNN))
-
-        elif inst_type == 2:        # CALL
-            print("%#x    CALL   %#x" % (pc-2, inst_NNN))
-
-        elif inst_type == 3:
-            print("%#x    SE    V%d, %d" % (pc-2, inst_X, inst_NN))
-
-        elif inst_type == 4:
-            print("%#x    SNE   V%d, %d" % (pc-2, inst_X, inst_NN))
-
-        elif inst_type == 5:
-            print("%#x    SE    V%d, V%d" % (pc-2, inst_X, inst_Y))
-
-        elif inst_type == 6:
-            print("%#x    LD    V%d, %#x" % (pc-2, inst_X, inst_NN))
-
-        elif inst_type == 7:
-            print("%#x    ADD    V%d, %#x" % (pc-2, inst_X, inst_NN))
-
-        elif inst_type == 8:
-            if inst_N == 0:             # LD Vx, Vy
-                print("%#x    LD    V%d, V%d" % (pc-2, inst_X, inst_Y))
-            elif inst_N == 1:           # OR Vx, Vy
-                print("%#x    OR    V%d, V%d" % (pc-2, inst_X, inst_Y))
-            elif inst_N == 2:           # AND Vx, Vy
-                print("%#x    AND    V%d, V%d" % (pc-2, inst_X, inst_Y))
-            elif inst_N == 3:           # XOR Vx, Vy
-                print("%#x    XOR    V%d, V%d" % (pc-2, inst_X, inst_Y))
-            elif inst_N == 4:           # ADD Vx, Vy
-                print("%#x    ADD    V%d, V%d" % (pc-2, inst_X, inst_Y))
-            elif inst_N == 5:           # SUB Vx, Vy
-                print("%#x    SUB    V%d, V%d" % (pc-2, inst_X, inst_Y))
-            elif inst_N == 6:           # SHR Vx
-                print("%#x    SHR    V%d" % (pc-2, inst_X))
-            elif inst_N == 7:           # SUBN Vx, Vy
-                print("%#x    SUBN    V%d, V%d" % (pc-2, inst_X, inst_Y))
-            elif inst_N == 0xE:        # SHL Vx
-                print("%#x    SHL    V%d" % (pc-2, inst_X))
-
-        elif inst_type == 0x9:          # SNE Vx, Vy
-            print("%#x    SNE    V%d, V%d" % (pc-2, inst_X, inst_Y))
-
-        elif inst_type == 0xA:          # LD I, addr
-            print("%#x    LD    I, %#x" % (pc-2, inst_NNN))
-
-        elif inst_type == 0xB:          # JP V0, addr
-            print("%#x    JP    I, %#x" % (pc-2, inst_NNN))
-
-        elif inst_type == 0xC:          # RND Vx, nn
-            print("%#x    RND   V%d, %#x" %(pc-2, inst_X, inst_NN))
-
-        elif inst_type == 0xD:
-            print("%#x    DRW    V%d, V%d, %d" % (pc-2, inst_X, inst_Y, inst_N))
-
-        elif inst_type == 0xE:
-            if inst_NN == 0x9E:          # SKP Vx
-                print("%#x    SKP    V%d" % (pc-2, inst_X))
-            elif inst_NN == 0xA1:       # SKNP Vx
-                print("%#x    SKNP    V%d" % (pc-2, inst_X))
-            else:
-                pass
-        
-        elif inst_type == 0xF:
-            if inst_NN == 0x07:         # LD Vx, DT
-                print("%#x    LD    V%d, DT" % (pc-2, inst_X))
-            elif inst_NN == 0x0A:      # LD Vx ,k
-                print("%#x    LD    V%d, k" % (pc-2, inst_X))
-            elif inst_NN == 0x15:      # LD DT, Vx
-                print("%#x    LD    DT, V%d" % (pc-2, inst_X))
-            elif inst_NN == 0x18:      # LD ST, Vx
-                print("%#x    LD    ST, V%d" % (pc-2, inst_X))
-            elif inst_NN == 0x1E:      #ADD I, Vx
-                print("%#x    ADD    I, V%d" % (pc-2, inst_X))
-            elif inst_NN == 0x29:       #LD, F, Vx 
-                print("%#x    LD    F, V%d" % (pc-2, inst_X))
-            elif inst_NN == 0x33:       # LD B, Vx
-                print("%#x    LD    B, V%d" % (pc-2, inst_X))
-            elif inst_NN == 0x55:        # LD [I], Vx
-                print("%#x    LD    [I], V%d" % (pc-2, inst_X))
-            elif inst_NN == 0x65:       # LD Vx, [I]
-                print("%#x    LD     V%d, [I]" % (pc-2, inst_X))
+def format_instruction(inst):
+    """ One line of assembly listing for an Instruction """
 
+    if inst.operands:
+        return "%#05x    %-5s %s" % (inst.addr, inst.mnemonic, ", ".join(inst.operands))
+    return "%#05x    %s" % (inst.addr, inst.mnemonic)
+
+
+class TextSink:
+    """ Writes an assembly listing, to the console if no file is given """
+
+    def __init__(self, file=None):
+        self.file = file
+
+    def write(self, inst):
+        if self.file is None:
+            print(format_instruction(inst))
         else:
-           print("%#x    NOP    %#x" %(pc-2, (inst_high << 8) + inst_low))
-           pass 
+            self.file.write(format_instruction(inst) + "\n")
+
+    def close(self):
+        pass
+
+
+class JsonLinesSink:
+    """ Writes one JSON object per instruction """
+
+    def __init__(self, file, rom=None):
+        self.file = file
+        self.rom = rom
+
+    def write(self, inst):
+        record = {"addr": inst.addr, "opcode": inst.opcode,
+                  "mnemonic": inst.mnemonic, "operands": inst.operands,
+                  "flow": inst.flow, "targets": inst.targets}
+        if self.rom is not None:
+            record["rom"] = self.rom
+        self.file.write(json.dumps(record) + "\n")
 
+    def close(self):
+        pass
+
+
+def disassemble_to(memory, start_addr, end_addr, sink):
+    """ Disassemble into a sink, returns the number of instructions """
+
+    count = 0
+    for inst in disassemble(memory, start_addr, end_addr):
+        sink.write(inst)
+        count += 1
+    return count
+
+
+def dissasemble(memory, start_addr, end_addr):
+    # Function to create an assembly code listing of a block of memory
+    # defined by the start and end addresses
+    disassemble_to(memory, start_addr, end_addr, TextSink())
@@ -0,0 +1,553 @@
+# chip8_translate.py
+#
+#  Basic block translator for the CHIP8 interpreter core
+#
+#  Straight line runs of CHIP8 code starting at the pc are turned into one
+#  generated python function each, with the registers held in locals, and
+#  cached by start address.  Unconditional jumps are followed, a jump back
+#  to the start of the block becomes a loop, skips over simple instructions
+#  run them conditionally, and a block ends at the first call, return or
+#  other skip, which is inlined, or at the first DRW, key instruction or
+#  memory write, which is run through its normal handler at the end of the
+#  block.  Anything that can't be translated is left to the plain
+#  interpreter in chip8.py
+#
+#  Only addresses the code is entered at many times are translated, and a
+#  block only runs when its longest path fits in the cycles left in the
+#  frame, otherwise the interpreter carries on from there.  At the default
+#  15 instructions per frame that keeps it to a handful of blocks per ROM,
+#  about level with the interpreter for the first minute while they're
+#  built and faster after.  It gains most at higher rates
+#
+
+# Imports
+#
+import chip8
+
+# Longest block we translate, in instructions
+MAX_BLOCK = 64
+
+# Marks an address as not worth translating so we don't retry it
+NO_BLOCK = False
+
+# An address is only translated once the interpreter has started there
+# this many times, so code that runs once or twice is never compiled.  At
+# most 255, the counts are kept in a bytearray
+HOT = 128
+
+# Most blocks kept at once, hot spots found after that are left to the
+# interpreter so the memory blocks take stays bounded
+MAX_BLOCKS = 64
+
+# Blocks dropped this many times by self modifying code are left to the
+# interpreter from then on
+MAX_RETRANSLATE = 4
+
+
+# Register arithmetic that can be inlined - 8xyN by last nibble.  Each one
+# is a list of statements using vx, vy and vf as the register locals.  The
+# flag is always written last so VF as the target register behaves like the
+# interpreter
+_ALU = {
+    0x0: ["{vx} = {vy}"],
+    0x1: ["{vx} = {vx} | {vy}"],
+    0x2: ["{vx} = {vx} & {vy}"],
+    0x3: ["{vx} = {vx} ^ {vy}"],
+    0x4: ["t = {vx} + {vy}", "{vx} = t & 0xFF", "vf = 1 if t > 255 else 0"],
+    0x5: ["t = 1 if {vx} > {vy} else 0", "{vx} = ({vx} - {vy}) & 0xFF", "vf = t"],
+    0x6: ["t = {vx} & 0x1", "{vx} = {vx} >> 1", "vf = t"],
+    0x7: ["t = 1 if {vy} > {vx} else 0", "{vx} = ({vy} - {vx}) & 0xFF", "vf = t"],
+    0xE: ["t = ({vx} & 0x80) >> 7", "{vx} = ({vx} << 1) & 0xFF", "vf = t"],
+}
+
+# The shifts with the shift quirk, Vy shifted into Vx
+_ALU_SHIFT_VY = {
+    0x6: ["t = {vy} & 0x1", "{vx} = {vy} >> 1", "vf = t"],
+    0xE: ["t = ({vy} & 0x80) >> 7", "{vx} = ({vy} << 1) & 0xFF", "vf = t"],
+}
+
+
+def _reg(r):
+    return "v%x" % r
+
+
+def _names(expression):
+    # The identifiers used in a generated expression
+    for char in "()[]&|^+-*<>=":
+        expression = expression.replace(char, " ")
+    return expression.split()
+
+
+def _inline(inst_high, inst_low, quirks=()):
+    """ Python statements for an instruction that can live inside a block
+
+    Returns a list of statements using v0..vf, i, dt and st as locals, or
+    None if the instruction has to end the block.  quirks are the
+    machine's chip8.QUIRKS in effect
+    """
+
+    inst_type = inst_high >> 4
+    x = inst_high & 0x0F
+    y = inst_low >> 4
+    n = inst_low & 0x0F
+    nn = inst_low
+    nnn = (x << 8) | inst_low
+
+    if inst_type == 0x6:                            # LD Vx, nn
+        return ["%s = %d" % (_reg(x), nn)]
+    if inst_type == 0x7:                            # ADD Vx, nn
+        return ["%s = (%s + %d) & 0xFF" % (_reg(x), _reg(x), nn)]
+    if inst_type == 0x8 and n in _ALU:
+        alu = _ALU_SHIFT_VY if n in _ALU_SHIFT_VY and "shift" in quirks else _ALU
+        return [line.format(vx=_reg(x), vy=_reg(y)) for line in alu[n]]
+    if inst_type == 0xA:                            # LD I, addr
+        return ["i = %d" % nnn]
+    if inst_type == 0xC:                            # RND Vx, byte
+        return ["%s = m.random_byte() & %d" % (_reg(x), nn)]
+    if inst_type == 0xF:
+        if nn == 0x07:                              # LD Vx, DT
+            return ["%s = m.delay_timer" % _reg(x)]
+        if nn == 0x15:                              # LD DT, Vx
+            return ["m.delay_timer = %s" % _reg(x)]
+        if nn == 0x18:                              # LD ST, Vx
+            return ["m.sound_timer = %s" % _reg(x)]
+        if nn == 0x1E:                              # ADD I, Vx
+            return ["i = i + %s" % _reg(x)]
+        if nn == 0x29:                              # LD F, Vx
+            return ["i = 0x50 + 5 * %s" % _reg(x)]
+        if nn == 0x65:                              # LD Vx, [I]
+            statements = ["%s = memory[i + %d]" % (_reg(r), r) for r in range(x + 1)]
+            if "memory" in quirks:
+                statements.append("i = i + %d" % (x + 1))
+            return statements
+    return None
+
+
+def _skip_condition(inst_high, inst_low):
+    """ The python condition under which a skip instruction skips, or None
+    if the instruction is not a skip
+    """
+
+    inst_type = inst_high >> 4
+    x = inst_high & 0x0F
+    y = inst_low >> 4
+    nn = inst_low
+
+    if inst_type == 0x3:                            # SE Vx, nn
+        return "%s == %d" % (_reg(x), nn)
+    if inst_type == 0x4:                            # SNE Vx, nn
+        return "%s != %d" % (_reg(x), nn)
+    if inst_type == 0x5 and (inst_low & 0x0F) == 0: # SE Vx, Vy
+        return "%s == %s" % (_reg(x), _reg(y))
+    if inst_type == 0x9 and (inst_low & 0x0F) == 0: # SNE Vx, Vy
+        return "%s != %s" % (_reg(x), _reg(y))
+    # The keys only change between calls to run_cycles
+    if inst_type == 0xE and nn == 0x9E:             # SKP Vx
+        return "m.keys >> %s & 1" % _reg(x)
+    if inst_type == 0xE and nn == 0xA1:             # SKNP Vx
+        return "not m.keys >> %s & 1" % _reg(x)
+    return None
+
+
+def _transfer(inst_high, inst_low, addr, quirks=()):
+    """ Python statements for a jump, call or return at addr, or None """
+
+    inst_type = inst_high >> 4
+    x = inst_high & 0x0F
+    nnn = (x << 8) | inst_low
+
+    if inst_type == 0x0 and x == 0 and inst_low == 0xEE:   # RET
+        return ["sp = m.sp - 1",
+                "if sp < 0:",
+                "    raise IndexError('stack underflow')",
+                "m.pc = m.stack[sp]",
+                "m.sp = sp"]
+    if inst_type == 0x1:                            # JP nnn
+        return ["m.pc = %d" % nnn]
+    if inst_type == 0x2:                            # CALL nnn
+        return ["sp = m.sp",
+                "if sp >= %d:" % chip8.STACK_DEPTH,
+                "    raise IndexError('stack overflow')",
+                "m.stack[sp] = %d" % (addr + 2),
+                "m.sp = sp + 1",
+                "m.pc = %d" % nnn]
+    if inst_type == 0xB:                            # JP V0, addr
+        return ["m.pc = %s + %d" % (_reg(x) if "jump" in quirks else "v0", nnn)]
+    return None
+
+
+class TranslatingChip8(chip8.Chip8):
+    """ A Chip8 that runs translated basic blocks where it can
+
+    A block only runs when the cycle budget left covers its longest path,
+    otherwise the interpreter carries on, so instruction counts and timer
+    ticks are exactly the same as the plain interpreter.  Writes through
+    Fx33/Fx55 drop any block covering the written bytes.
+    """
+
+    # Slots keep the instance dict down to the core's attributes.  CPython
+    # only stores up to 30 attributes inline, past that every attribute
+    # lookup in the interpreter's handlers gets slower
+    __slots__ = ("_blocks", "_block_addrs", "_owners", "_dropped", "_hits",
+                 "blocks_translated")
+
+    def __init__(self, cycles_per_frame=15, quirks=()):
+        # Translated blocks by start address, the instruction addresses
+        # each block was built from, the blocks built from each byte, how
+        # often the block at each address was dropped and how often the
+        # interpreter started there
+        self._blocks = [None] * 4096
+        self._block_addrs = {}
+        self._owners = {}
+        self._dropped = bytearray(4096)
+        self._hits = bytearray(4096)
+        self.blocks_translated = 0
+        super().__init__(cycles_per_frame, quirks)
+
+    def run_cycles(self, n):
+        """ Execute up to n instructions, returns the number executed """
+
+        blocks = self._blocks
+        hits = self._hits
+        hot = HOT
+        translate = self._translate
+        decoded = self._decoded
+        decode = self._decode
+        end_addr = self.end_addr
+        executed = 0
+
+        # Blocks are only counted and translated where the code is entered -
+        # jump and call targets, returns, where blocks leave off and after
+        # instructions that can't be translated.  Running on from the
+        # instruction before, or starting where the last frame stopped, is
+        # only the middle of a straight run of code and translating there
+        # would make a block for every place a frame can end.  follow is
+        # where running on gets to
+        follow = self.pc
+        try:
+            while executed < n:
+                pc = self.pc
+                if pc > end_addr:
+                    break
+                block = blocks[pc]
+                if block:
+                    # Blocks return how many instructions they executed,
+                    # none if their longest path didn't fit the budget
+                    ran = block(self, n - executed)
+                    if ran:
+                        executed += ran
+                        follow = -1
+                        continue
+                elif block is None:
+                    if pc != follow:
+                        count = hits[pc] + 1
+                        if count < hot:
+                            hits[pc] = count
+                        else:
+                            translate(pc)
+                            continue
+                else:
+                    # Never translated, the code after it is entered there
+                    entry = decoded[pc]
+                    if entry is None:
+                        entry = decode(pc)
+                    self.pc = pc + 2
+                    follow = -1
+
+                    handler, x, y, nib, nn, nnn = entry
+                    handler(x, y, nib, nn, nnn)
+                    executed += 1
+                    continue
+
+                # Let the interpreter run along the straight code up to the
+                # next jump or block
+                while True:
+                    entry = decoded[pc]
+                    if entry is None:
+                        entry = decode(pc)
+                    follow = pc + 2
+                    self.pc = follow
+
+                    handler, x, y, nib, nn, nnn = entry
+                    handler(x, y, nib, nn, nnn)
+                    executed += 1
+                    pc = self.pc
+                    if (pc != follow or executed >= n or pc > end_addr
+                            or blocks[pc] is not None):
+                        break
+        except chip8.Idle as idle:
+            # Only the interpreter raises Idle, blocks never contain the
+            # idle handlers
+            remaining = n - executed
+            self.pc += 2 * (remaining % idle.args[0])
+            self.idle_cycles += remaining - 1
+            executed = n
+        self.cycles += executed
+        return executed
+
+    def precompile(self, starts):
+        """ Translate the blocks at starts ahead of time, for example the
+        block starts found by chip8_cfg.  Returns how many were translated
+        """
+
+        blocks = self._blocks
+        translated = 0
+        for start in starts:
+            if blocks[start] is None and start <= self.end_addr:
+                if self._translate(start):
+                    translated += 1
+        return translated
+
+    def _invalidate(self, start_addr, end_addr):
+        super()._invalidate(start_addr, end_addr)
+
+        if start_addr <= 0 and end_addr >= 4095:
+            # All of memory - a reset, a restored save state or a change
+            # of quirks rather than the ROM writing over its own code, so
+            # start again without counting it against any block
+            self._drop_all()
+            return
+
+        # Drop the blocks built from any of the written bytes
+        owners = self._owners
+        for addr in range(max(start_addr, 0), min(end_addr, 4095) + 1):
+            if addr in owners:
+                for start in list(owners[addr]):
+                    self._drop_block(start)
+
+    def _drop_all(self):
+        # In place, run_cycles holds on to these while it runs
+        self._blocks[:] = [None] * 4096
+        self._dropped[:] = bytes(4096)
+        self._hits[:] = bytes(4096)
+        self._block_addrs.clear()
+        self._owners.clear()
+
+    def _drop_block(self, start):
+        self._blocks[start] = None
+        if self._dropped[start] < MAX_RETRANSLATE:
+            self._dropped[start] += 1
+        owners = self._owners
+        for addr in self._block_addrs.pop(start):
+            for byte in (addr, addr + 1):
+                owners[byte].remove(start)
+                if not owners[byte]:
+                    del owners[byte]
+
+    def _translate(self, start):
+        """ Translate the block starting at start
+
+        Returns the block function, which takes the machine and the cycle
+        budget and returns the instructions it executed, or NO_BLOCK if it
+        is not worth it.  Unconditional jumps are followed into their
+        target, and a skip over a jump, call or return becomes an early
+        exit, so typical CHIP8 loops end up as one block
+        """
+
+        # Delay loops are left to the interpreter, which skips them
+        entry = self._decoded[start] or self._decode(start)
+        if (self._dropped[start] >= MAX_RETRANSLATE or entry[0] == self._op_ld_vx_dt_idle
+                or len(self._block_addrs) >= MAX_BLOCKS):
+            self._blocks[start] = NO_BLOCK
+            return NO_BLOCK
+
+        memory = self.memory
+        quirks = self.quirks
+        last_addr = min(self.end_addr, 4095) - 1
+        # A block longer than a frame could never run
+        limit = min(MAX_BLOCK, self.cycles_per_frame)
+
+        # Body statements, "@" marks where the registers get written back.
+        # count is the instructions on the path that skips every conditional
+        # one, extra the conditional ones so far and longest the most any
+        # path through the block runs
+        body = []
+        addrs = []
+        count = 0
+        extra = 0
+        longest = 0
+        addr = start
+        handler_exit = None
+        loop = 0
+        while True:
+            if addr > last_addr or addr in addrs or count + extra >= limit:
+                # Out of code, back at an address already in the block or
+                # long enough - carry on from addr next time
+                body += ["@", "m.pc = %d" % addr, "return %d" % count]
+                break
+
+            inst_high = memory[addr]
+            inst_low = memory[addr + 1]
+            addrs.append(addr)
+
+            statements = _inline(inst_high, inst_low, quirks)
+            if statements is not None:
+                body += statements
+                count += 1
+                addr += 2
+                continue
+
+            if inst_high >> 4 == 0x1:
+                # Follow unconditional jumps.  A jump back to the start of
+                # the block becomes a loop that runs until the cycle budget
+                # runs out, with the registers kept in locals throughout
+                count += 1
+                addr = ((inst_high & 0x0F) << 8) | inst_low
+                if addr == start:
+                    loop = count
+                    break
+                continue
+
+            transfer = _transfer(inst_high, inst_low, addr, quirks)
+            if transfer is not None:
+                count += 1
+                body += ["@"] + transfer + ["return %d" % count]
+                break
+
+            condition = _skip_condition(inst_high, inst_low)
+            if (condition is not None and addr + 2 <= last_addr
+                    and addr + 2 not in addrs and count + extra + 2 <= limit):
+                next_high = memory[addr + 2]
+                next_low = memory[addr + 3]
+                transfer = _transfer(next_high, next_low, addr + 2, quirks)
+                statements = _inline(next_high, next_low, quirks)
+                if transfer is not None:
+                    # A skip over a jump, call or return exits the block
+                    # when it doesn't skip, or goes round again for a jump
+                    # back to the start, and carries on at addr + 4 when it
+                    # does
+                    addrs.append(addr + 2)
+                    longest = max(longest, count + extra + 2)
+                    body.append("if not (%s):" % condition)
+                    if next_high >> 4 == 0x1 and ((next_high & 0x0F) << 8 | next_low) == start:
+                        body += ["    c += %d" % (count + 2), "    budget -= %d" % (count + 2),
+                                 "    continue"]
+                        # A loop, but not one that runs to the end of the
+                        # block and jumps back there
+                        loop = -1
+                    else:
+                        body += ["    " + line for line in ["@"] + transfer + ["return %d" % (count + 2)]]
+                    count += 1
+                    addr += 4
+                    continue
+                if statements is not None:
+                    # A skip over an instruction that can be inlined runs it
+                    # conditionally.  Whether it ran is only known at run
+                    # time, so it's counted like the trips round a loop
+                    addrs.append(addr + 2)
+                    body.append("if not (%s):" % condition)
+                    body += ["    " + line for line in ["c += 1", "budget -= 1"] + statements]
+                    count += 1
+                    extra += 1
+                    addr += 4
+                    continue
+            if condition is not None:
+                count += 1
+                body += ["@", "m.pc = %d if %s else %d" % (addr + 4, condition, addr + 2),
+                         "return %d" % count]
+                break
+
+            # Display, keys and memory writes finish the block through their
+            # normal handler.  Unknown opcodes are left for the interpreter
+            # to trap, and key waits for it to skip
+            entry = self._decoded[addr] or self._decode(addr)
+            if entry[0] != self._op_trap and entry[0] != self._op_ld_vx_k_idle:
+                count += 1
+                handler_exit = entry
+                body += ["@", "m.pc = %d" % (addr + 2),
+                         "term(%d, %d, %d, %d, %d)" % entry[1:],
+                         "return %d" % count]
+            else:
+                addrs.pop()
+                body += ["@", "m.pc = %d" % addr, "return %d" % count]
+            break
+        longest = max(longest, count + extra)
+
+        # A lone handler call gains nothing over the interpreter
+        if count == 0 or (count == 1 and handler_exit):
+            self._blocks[start] = NO_BLOCK
+            return NO_BLOCK
+
+        # Work out which locals the block needs to load and store
+        used = set()
+        written = set()
+        for line in body:
+            line = line.strip()
+            if line.startswith("if not ("):
+                used.update(_names(line[3:]))
+            elif " = " in line:
+                target, expression = line.split(" = ", 1)
+                written.add(target)
+                used.add(target)
+                used.update(_names(expression))
+            else:
+                used.update(_names(line))
+
+        writeback = []
+        for r in range(16):
+            if _reg(r) in written:
+                writeback.append("regs[%d] = %s" % (r, _reg(r)))
+        if "i" in written:
+            writeback.append("m.index_reg = i")
+
+        # The budget is checked once on the way in, against the longest
+        # path, so a block runs whole or not at all and the interpreter
+        # takes the rest of the frame.  c counts the instructions the fixed
+        # counts in the returns miss, the conditional ones and the trips
+        # round a loop
+        counted = loop or extra
+        lines = ["def block(m, budget):"]
+        if not loop:
+            lines += ["    if budget < %d:" % longest, "        return 0"]
+        if [r for r in range(16) if _reg(r) in used]:
+            lines.append("    regs = m.regs")
+        if "i" in used:
+            lines.append("    i = m.index_reg")
+        if "memory" in used:
+            lines.append("    memory = m.memory")
+        for r in range(16):
+            if _reg(r) in used:
+                lines.append("    %s = regs[%d]" % (_reg(r), r))
+        if counted:
+            lines.append("    c = 0")
+        prefix = "    "
+        if loop:
+            # Each trip round checks the budget again and costs the
+            # instructions it ran out of it
+            lines.append("    while budget >= %d:" % longest)
+            prefix = "        "
+            if loop > 0:
+                body += ["c += %d" % loop, "budget -= %d" % loop]
+        else:
+            # Nothing looks at the budget again
+            body = [line for line in body if line.strip() != "budget -= 1"]
+        for line in body:
+            indent = line[:len(line) - len(line.lstrip())]
+            if line.strip() == "@":
+                lines += [prefix + indent + wb for wb in writeback]
+            elif counted and line.strip().startswith("return "):
+                lines.append(prefix + indent + "return c + " + line.strip()[7:])
+            else:
+                lines.append(prefix + line)
+        if loop:
+            lines += ["    " + wb for wb in writeback]
+            lines += ["    m.pc = %d" % start, "    return c"]
+
+        namespace = {}
+        if handler_exit:
+            namespace["term"] = handler_exit[0]
+        exec(compile("\n".join(lines) + "\n", "<block %#x>" % start, "exec"),
+             namespace)
+
+        block = namespace["block"]
+        self._blocks[start] = block
+        self._block_addrs[start] = addrs
+        owners = self._owners
+        for addr in addrs:
+            for byte in (addr, addr + 1):
+                if byte in owners:
+                    owners[byte].append(start)
+                else:
+                    owners[byte] = [start]
+        self.blocks_translated += 1
+        return block
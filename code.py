@@ -1,4 +1,4 @@
-#chip8.py
+#code.py
 #
 #  This is an attempt to create a CHIP8 interpreter in circuitpython
 #  for the RP2040 on the Adafruit Macropad
@@ -10,35 +10,39 @@
 
 # Imports
 #
-import time
+import gc
 import random
+import time
 import board
 import displayio
+import keypad
+import terminalio
+import chip8
+import chip8_catalog
+import chip8_display
+import chip8_input
+import chip8_timing
 import chip8_tools
+from adafruit_display_text import label
 from adafruit_macropad import MacroPad
 
 # Initializations
 macropad = MacroPad()
 
-# Read in the list of ROMs and let user select one using the encoder
-with open('./roms/roms.lst','r') as file:
-    roms = [line.strip() for line in file]
-
+# Read in the ROM names from the catalogue (see chip8_catalog.py), or from
+# roms.lst if it hasn't been built
+try:
+    catalog = chip8_catalog.Catalog('./roms/catalog.txt')
+    roms = catalog.names
+except OSError:
+    catalog = None
+    with open('./roms/roms.lst','r') as file:
+        roms = [line.strip() for line in file]
+
+# The menu's text display is made once and shown again each time the menu
+# comes back
 text_lines = macropad.display_text(title = "Select ROM")
-rom_selected = False
-encoder = 1
-
-while rom_selected != True:
-    text_lines[0].text = ""
-    text_lines[1].text = roms[macropad.encoder % len(roms)]
-    if encoder != macropad.encoder:
-        text_lines[1].text = roms[macropad.encoder % len(roms)]
-        encoder = macropad.encoder
-        text_lines.show()
-    if macropad.encoder_switch:
-        rom_selected = True
-        romfile = roms[macropad.encoder % len(roms)] 
-    time.sleep(.2)
+text_lines[0].text = ""
 
 # Setup Display on macropad
 #
@@ -61,36 +65,139 @@ group = displayio.Group()
 # Add the TileGrid to the Group
 group.append(tile_grid)
 
-# Add the Group to the Display
-display.root_group = group
-
-
-# Memory - The CHIP8 has 4K (4096) bytes of RAM
-#          Implement this as a list with 4096 elements initialized to zeros
-#
-memory = [0] * 4096
-
-# Stack - Make it unlimited for now
-stack = []
-
-# Timers
-delay_timer = 0
-sound_timer = 0
-time_now = time.monotonic()
-
-# Registers
-#    sixteen 8 bit registers V0-VF
-#    sixteen bit index register
-#    Stack Pointer
-regs = [0] * 16
-index_reg = 0
-
-# Program counter - initialize to 0x200 since that is where most ROMS load
-pc = 0x200
-
-# Flags for the keyboard
-key_pressed = False             # Flag for keypress
-key_value = 0xFF                # FF indicates no key press in buffer
+# Speed shown over the game for a moment when it is changed
+speed_label = label.Label(terminalio.FONT, text="", color=0xFFFFFF,
+                          background_color=0x000000, x=2, y=6)
+speed_label.hidden = True
+group.append(speed_label)
+
+# The presenter turns off auto refresh and pushes the changed part of the
+# screen once per 60Hz tick - see chip8_display.py
+presenter = chip8_display.Presenter(display, bitmap)
+
+
+# The CHIP8 machine itself - see chip8.py.  With translate set the machine
+# compiles the ROM's hottest basic blocks into python functions as it goes
+# (see chip8_translate.py), which takes more RAM, at most 64 blocks.  At
+# the default 15 instructions per frame it's level with the interpreter
+# for the first minute and faster after, more so at higher rates, see the
+# README.  The modules behind this and the other flags below are only
+# imported when the flag is set, so they needn't be copied to the macropad
+# otherwise
+translate = False
+gc.collect()
+free = gc.mem_free()
+if translate:
+    import chip8_translate
+    machine = chip8_translate.TranslatingChip8()
+else:
+    machine = chip8.Chip8()
+gc.collect()
+print("Machine: {} bytes, {} bytes free".format(free - gc.mem_free(), gc.mem_free()))
+
+# Instructions per 60Hz frame - 15 is 900 instructions a second.  Each
+# ROM runs at rom_ipf, from its catalogue profile or this
+instructions_per_frame = 15
+rom_ipf = instructions_per_frame
+
+
+def tick():
+    # Called after the timers tick in each frame that is shown.  Show
+    # anything that was drawn since the last tick
+    presenter.present(machine)
+
+
+def sound(sounding):
+    # Called every 60Hz period, even when the frame isn't shown, so the
+    # buzzer is on while the sound timer is running
+    if sounding:
+        macropad.start_tone(292)
+    else:
+        macropad.stop_tone()
+
+
+# The scheduler runs instructions_per_frame instructions, ticks the timers
+# and then sleeps off the rest of the frame - see chip8_timing.py.  When a
+# frame runs late the display update is skipped, up to max_skip frames in
+# a row, to keep the game at full speed
+max_skip = 4
+scheduler = chip8_timing.Scheduler(machine,
+                                   instructions_per_frame=instructions_per_frame,
+                                   on_tick=tick, max_skip=max_skip, on_sound=sound)
+
+# Print the measured speed once a second
+show_speed = False
+
+# Speed control - turning the encoder scales the instructions per frame by
+# SPEED_SCALES, and turning it past the top runs the game 2, 4 then 8
+# times as fast with only one frame in that many shown (turbo).  The
+# speed is shown on screen for speed_label_frames
+SPEED_SCALES = (0.25, 0.5, 0.75, 1, 1.5, 2, 3, 4)
+TURBO_STEPS = (2, 4, 8)
+speed = SPEED_SCALES.index(1)
+speed_label_frames = 60
+speed_label_until = 0
+
+
+def set_speed(step):
+    # Apply speed step, returns the text to show for it
+    if step < len(SPEED_SCALES):
+        ipf = max(1, int(rom_ipf * SPEED_SCALES[step]))
+        turbo = 1
+    else:
+        ipf = rom_ipf
+        turbo = TURBO_STEPS[step - len(SPEED_SCALES)]
+    if ipf != machine.cycles_per_frame:
+        set_instructions_per_frame(ipf)
+    scheduler.turbo = turbo
+    if turbo > 1:
+        return "TURBO x%d" % turbo
+    return "IPF %d" % ipf
+
+# Profile - count the opcodes and hot pcs and print a report every 10
+# seconds and when the ROM stops.  Costs nothing when off, see
+# chip8_profile.py
+profile = False
+profiler = None
+if profile:
+    import chip8_profile
+    profiler = chip8_profile.Profiler(machine)
+
+# Save state - with autosave set the machine is saved to state_file every
+# autosave_frames frames and picked up again after a power cycle if the
+# same ROM is chosen.  The flash is read only to circuitpython unless
+# boot.py remounts it, if it is autosave just turns itself off.  See
+# chip8_state.py
+autosave = False
+autosave_frames = 600
+state_file = "/chip8.state"
+state_buffer = None
+if autosave:
+    import chip8_state
+    state_buffer = bytearray(chip8_state.STATE_SIZE)
+
+# Rewind - with rewind_enabled set a snapshot is taken every
+# rewind_every machine frames (so more often in turbo) into a ring buffer
+# of rewind_cap bytes, and each short press of the encoder switch steps
+# back one snapshot.  See chip8_rewind.py
+rewind_enabled = False
+rewind_every = 30
+rewind_cap = 8192
+rewinder = None
+if rewind_enabled:
+    import chip8_rewind
+    rewinder = chip8_rewind.Rewind(machine, rewind_every, rewind_cap)
+    scheduler.on_frame = rewinder.frame
+
+# Record - with record set the random number seed and every key press are
+# logged to record_file (saved every 600 frames) so the game can be
+# replayed exactly on a PC with chip8_record.py.  Like autosave this needs
+# boot.py to make the flash writable.  Rewinding stops the recording, and
+# a game resumed by autosave isn't recorded since replays start from boot
+record = False
+record_file = "/chip8.rec"
+if record:
+    import chip8_record
 
 # Debug - If debug flag is set, can single step instructions using the 
 # encoder, each click executes one instruction and then prints values 
@@ -99,297 +206,260 @@ key_value = 0xFF                # FF indicates no key press in buffer
 debug = False
 encoder = 0
 
+# Keymap - the CHIP8 key (0-F) each macropad key stands for, left to
+# right and top to bottom, then the encoder switch.  None leaves a button
+# unused.  When the encoder switch isn't mapped a short press of it is the
+# rewind button and a long one goes back to the menu, when it is there's
+# no way back to the menu but the ROM stopping.
+# The ROM's catalogue profile replaces it.  The key events are drained
+# once per frame into a mask of the CHIP8 keys that are down, see
+# chip8_input.py
+keymap = chip8_input.DEFAULT_KEYMAP
+keys = chip8_input.Keypad(keymap)
+key_event = keypad.Event()
+
+
+# Menu - holding the encoder switch down for menu_hold_ms goes back to
+# the ROM menu.  Everything above is made once at boot and reused by each
+# ROM, so going round the menu doesn't allocate a new machine or display
+menu_hold_ms = 1500
+menu_hold = chip8_input.LongPress(menu_hold_ms * 1000000)
+
+# Keys go to the machine through the recorder when recording
+key_target = machine
+recorder = None
+
+
+def select_rom():
+    # Show the ROM menu and let the user pick one with the encoder,
+    # returns its name once the encoder switch is pressed and let go
+    text_lines.show()
+    display.auto_refresh = True
+    while macropad.encoder_switch:
+        time.sleep(.02)
+    shown = None
+    while True:
+        if shown != macropad.encoder:
+            shown = macropad.encoder
+            text_lines[1].text = roms[shown % len(roms)]
+        if macropad.encoder_switch:
+            while macropad.encoder_switch:
+                time.sleep(.02)
+            return roms[shown % len(roms)]
+        time.sleep(.02)
+
+
+def set_instructions_per_frame(ipf):
+    # Speed changes are logged when recording so replays keep in step
+    if recorder is not None:
+        recorder.set_instructions_per_frame(ipf)
+    else:
+        machine.cycles_per_frame = ipf
 
-#*********************************************
-# 
-# Initialization complete - Now setup the
-# interpreter
-
-# Load font into memory at 0x50
-memory = chip8_tools.load_font(memory)
-
-# Read ROM file into memory at 0x200
-[memory, end_addr] = chip8_tools.read_rom(memory, 
-                                          romname = "./roms/" + romfile, 
-                                          start_addr = 0x200)
-print("end address: %#x" % end_addr)
 
-
-# Main program loop
-#
-#   The main loop will control the flow of the interpreter and handle the
-#   board stuff and timing as well as running the CHIP 8 interpreter 
+#*********************************************
 #
-
-# Continually loop but stop if for some reason the pc goes beyond the end of the
-# loaded ROM. This shouldn't happen but check anyway
-while pc <= end_addr:
-
-    # Debug  - Single step if true
-    if debug:
-        # Debug flag set so print register values
-        print("Addr: {0:#x} : {1:#x}".format(pc,(memory[pc]<<8) + memory[pc+1]))
-        chip8_tools.dissasemble(memory, pc, pc)
-        print("I: {0:#x}  DT: {1:d}  ST:{2:d}".format(index_reg, delay_timer, sound_timer))
-        for x in range(4):
-            for y in range(4):
-                print("V{0:X}:{1} ".format(y+x*4,regs[y+x*4]),end="") 
-            print("")
-        print("")
-        while encoder == macropad.encoder:
-            time.sleep(0.2)
+# Initialization complete - Now loop over
+# sessions, each one a ROM picked from the
+# menu and played until the encoder switch
+# is held down or the ROM stops
+
+while True:
+    gc.collect()
+    romfile = select_rom()
+    selected = time.monotonic_ns()
+
+    # Reset everything in place for the new ROM, with new random numbers
+    machine.reset()
+    machine.seed(random.getrandbits(16))
+    display.root_group = group
+    display.auto_refresh = False
+    presenter.clear()
+
+    # Read ROM file into memory at 0x200
+    end_addr = machine.load_rom("./roms/" + romfile, start_addr = 0x200)
+    print("ROM: %s, %d bytes, checksum %08x" % (romfile, machine.rom_info.size,
+                                              machine.rom_info.checksum))
+    print("end address: %#x" % end_addr)
+
+    # Run it the way its catalogue profile says, found by the checksum of
+    # what was loaded (and the name, for copies of a ROM under other names)
+    rom_profile = None
+    if catalog is not None:
+        rom_profile = catalog.find(machine.rom_info.checksum, romfile)
+        if rom_profile is None:
+            print("ROM isn't in the catalogue, rebuild it with chip8_catalog.py")
+    if rom_profile is not None:
+        print("Profile: {} ipf {} quirks {}".format(rom_profile.variant,
+                                                   rom_profile.instructions_per_frame,
+                                                   ",".join(rom_profile.quirks) or "none"))
+        machine.set_quirks(rom_profile.quirks)
+        rom_ipf = rom_profile.instructions_per_frame
+        keys.set_keymap(rom_profile.keymap)
+    else:
+        machine.set_quirks(())
+        rom_ipf = instructions_per_frame
+        keys.set_keymap(keymap)
+    if keys.mapped(chip8_input.ENCODER_SWITCH):
+        print("The encoder switch is a CHIP8 key for this ROM")
+    scheduler.instructions_per_frame = rom_ipf
+    scheduler.turbo = 1
+    speed = SPEED_SCALES.index(1)
+    speed_label.hidden = True
+    menu_hold.clear()
+    if rewinder is not None:
+        rewinder.clear()
+
+    if autosave:
+        try:
+            chip8_state.load_file(machine, state_file, state_buffer)
+            print("Resumed from %s at cycle %d" % (state_file, machine.cycles))
+        except (OSError, ValueError) as e:
+            print("Not resuming: {}".format(e))
+    if profile:
+        # Each ROM gets a report of its own
+        profiler.clear()
+        profiler.attach()
+
+    key_target = machine
+    recorder = None
+    if record:
+        try:
+            recorder = chip8_record.Recorder(machine)
+            key_target = recorder
+            print("Recording with seed %d" % recorder.seed)
+        except ValueError as e:
+            print("Not recording: {}".format(e))
+
+    # Speed control counts encoder turns from here on
+    if not debug:
         encoder = macropad.encoder
+    first_frame = True
+    scheduler.restart()
 
-    # Look for keypress
-    key_event = macropad.keys.events.get()
-    if key_event and key_event.pressed:
-        print("Key pressed: {}".format(key_event.key_number))
-        key_value_raw = key_event.key_number
-        key_pressed = True
-        key_read = False
-        # Keyboard remapping
-        if key_value_raw <= 9:
-            key_value = key_value_raw + 1
-        elif key_value_raw == 10:
-            key_value = 0
-        elif key_value_raw == 11:
-            key_value = 11
-    elif key_event and key_event.released and key_read:
-        if key_event.key_number == key_value_raw:
-            print("Key released: {}".format(key_event.key_number))
-            key_pressed = False
-            key_value = 0xFF
-        else:
-            pass
-
-
-    # execute chip8 loop
-
-    # Fetch instruction at PC
-
-    inst_high = memory[pc]
-    inst_low = memory[pc + 1]
-
-    # Increment the program counter
-    pc = pc + 2
 
-    # Break out instruction values here to use later
-    inst_type = (inst_high & 0xF0) >> 4        # First nibble
-    inst_X = inst_high & 0x0F                  # Second nibble
-    inst_Y = (inst_low & 0xF0) >> 4            # Third Nibble
-    inst_N = inst_low & 0x0F                   # Fourth Nibble
-    inst_NN = inst_low                         # Third & Fourth Nibbles
-    inst_NNN = (inst_X << 8) + inst_low        # Second, Third Fouth nibbles
-
-    # Decode instruction type 
-    if inst_type == 0:
-        if inst_Y == 0xE:
-            if inst_N == 0:                 # CLS
-                # Clear screen
-                bitmap.fill(0)
-            elif inst_N == 0xE:             # RET
-                # Return from subroutine
-                pc = stack.pop()
-            else:
-                pass
-        else:
-            pass
-
-    elif inst_type == 1:                    # JP nnn
-        # Jump to location nnn
-        pc = inst_NNN
-
-    elif inst_type == 2:                    # CALL nnn
-        # Call subroutine at nnn
-        stack.append(pc)
-        pc = inst_NNN
-
-    elif inst_type == 3:                    # SE Vx, nn
-        # Skip next instruction if Vx == nn
-        if (regs[inst_X] == inst_NN):
-            pc = pc + 2
-        else:
-            pass
-
-    elif inst_type == 4:                    # SNE Vx, nn
-        # Skip next instruction if Vx != nn
-        if (regs[inst_X] != inst_NN):
-            pc = pc+2
-        else:
-            pass
-
-    elif inst_type == 5:                    # SE Vx, Vy
-        # Skip next instruction if Vx = Vy
-        if regs[inst_X] == regs[inst_Y]:
-            pc = pc + 2
-        else:
-            pass
-
-    elif inst_type == 6:                    # LD nn
-        # Set Vx = nn
-        regs[inst_X] = inst_NN
-
-    elif inst_type == 7:                    # ADD Vx, nn
-        # Set Vx = Vx + nn
-        regs[inst_X] += inst_NN
-        regs[inst_X] &= 0xFF                # Memory is only 1 byte
-
-    elif inst_type == 8:
-        if inst_N == 0:                    # LD Vx, Vy
-            regs[inst_X] = regs[inst_Y]
-        elif inst_N == 1:                  # OR Vx, Vy
-            regs[inst_X] |= regs[inst_Y]
-        elif inst_N == 2:                   # AND Vx, Vy
-            regs[inst_X] &= regs[inst_Y]
-        elif inst_N == 3:                   # XOR Vx, Vy
-            regs[inst_X] ^= regs[inst_Y]
-        elif inst_N == 4:                   # ADD Vx, Vy
-            regs[inst_X] += regs[inst_Y]
-            if regs[inst_X] > 255:
-                regs[0xF] = 1
-                regs[inst_X] &= 0xFF
-            else:
-                regs[0xF] = 0
-        elif inst_N == 5:                   # SUB Vx, Vy
-            if regs[inst_X] > regs[inst_Y]:
-                regs[0xF] = 1
-            else:
-                regs[0xF] = 0
-            regs[inst_X] -= regs[inst_Y]
-        elif inst_N == 6:                   # SHR Vx
-            if (regs[inst_X] & 0x1) == 1:
-                regs[0xF] = 1
-            else:
-                regs[0xF] = 0
-            regs[inst_X] = regs[inst_X] >> 1
-        elif inst_N == 7:                   # SUBN Vx, Vy
-            if (regs[inst_Y] > regs[inst_X]):
-                regs[0xF] = 1
-            else:
-                regs[0xF] = 0
-            regs[inst_X] -= regs[inst_Y]
-        elif inst_N == 0xE:                 # SHL Vx
-            if (regs[inst_X] & 0x80) == 1:
-                regs[0xF] = 1
-            else:
-                regs[0xF] = 0
-            regs[inst_X] = regs[inst_X] << 1
-            regs[inst_X] &= 0xFF
-        else:
-            pass
+    # Main program loop
+    #
+    #   The main loop will control the flow of the interpreter and handle the
+    #   board stuff and timing, the CHIP 8 interpreter itself runs in the
+    #   machine a frame at a time
+    #
 
-    elif inst_type == 0x9:                  # SNE Vx, Vy
-        # Skip next instruction if Vx != Vy
-        if regs[inst_X] != regs[inst_Y]:
-            pc = pc +2
+    # Loop until the encoder switch is held down or the ROM faults, but
+    # stop if for some reason the pc goes beyond the end of the loaded ROM.
+    # This shouldn't happen but check anyway
+    while machine.running:
+
+        # Debug  - Single step if true
+        if debug:
+            # Debug flag set so print register values
+            pc = machine.pc
+            print("Addr: {0:#x} : {1:#x}".format(pc,(machine.memory[pc]<<8) + machine.memory[pc+1]))
+            chip8_tools.dissasemble(machine.memory, pc, pc)
+            print("I: {0:#x}  DT: {1:d}  ST:{2:d}".format(machine.index_reg,
+                                                         machine.delay_timer,
+                                                         machine.sound_timer))
+            for x in range(4):
+                for y in range(4):
+                    print("V{0:X}:{1} ".format(y+x*4,machine.regs[y+x*4]),end="")
+                print("")
+            print("")
+            while encoder == macropad.encoder:
+                time.sleep(0.2)
+            encoder = macropad.encoder
+
+        # Read the keys once per frame
+        keys.drain(macropad.keys.events, key_event)
+        # A long press of the encoder switch goes back to the menu, a short
+        # one rewinds, unless the keymap makes it a CHIP8 key
+        switch = macropad.encoder_switch
+        if keys.mapped(chip8_input.ENCODER_SWITCH):
+            keys.switch(switch)
+            press = 0
         else:
-            pass
-
-    elif inst_type == 0xA:          # LD I, addr
-        index_reg = inst_NNN
-
-    elif inst_type == 0xB:          # JP V0, addr
-        pc = regs[0] + inst_NNN
-
-    elif inst_type == 0xC:          # RND Vx, byte
-        # Set Vx = random AND nn
-        regs[inst_X] = random.randrange(256) & inst_NN
-
-
-    elif inst_type == 0xD:          # DRW Vx, Vy, nibble
-        # Set the x and y coords
-        x_coord = regs[inst_X] % 64
-        y_coord = regs[inst_Y] % 32
-
-        # Clear the collision detection flag
-        regs[0xF] = 0
-
-        # Loop through bytes to display
-        #  - The macropad display is 128x64 so we need to scale up
-        #    the image and turn each pixel into a block of 4 pixels
-        for y in range(inst_N):
-            pixel = memory[index_reg + y]
-            for x in range(8):
-                if (pixel & (0x80 >> x)) != 0:
-                    if (x_coord + x <= 64) and (y_coord + y <=32):
-                        if bitmap[((x_coord + x)*2)%display.width,
-                                  ((y_coord + y)*2)%display.height] == 1:
-                            regs[0xF] = 1
-                        bitmap[((x_coord + x)*2)%display.width,
-                               ((y_coord + y)*2)%display.height] ^= 1
-                        bitmap[((x_coord + x)*2+1)%display.width,
-                               ((y_coord + y)*2)%display.height] ^= 1
-                        bitmap[((x_coord + x)*2)%display.width,
-                               ((y_coord + y)*2+1)%display.height] ^= 1
-                        bitmap[((x_coord + x)*2+1)%display.width,
-                               ((y_coord + y)*2+1)%display.height] ^= 1
-
-    elif inst_type == 0xE:   
-        if inst_NN == 0x9E:         # SKP Vx
-            # Skip next instruction if key with value in Vx is pressed
-            key_read = True
-            if key_value == regs[inst_X]:
-                pc = pc +2
-            else:
-                pass
-        elif inst_NN == 0xA1:       # SKNP Vx
-            # Skip next instruction if key with value in Vx is not pressed
-            key_read = True
-            if key_value != regs[inst_X]:
-                pc = pc + 2
-            else:
-                pass
-
-    elif inst_type == 0xF:
-        if inst_NN == 0x07:         # LD Vx, DT
-            # Value of delay time put in Vx
-            regs[inst_X] = delay_timer
-        elif inst_NN == 0x0A:       # LD Vx, k
-            # Wait for a keypress and put value in Vx
-            if key_pressed == False:
-                pc = pc - 2
+            press = menu_hold.update(switch, time.monotonic_ns())
+        if keys.frame() != machine.keys:
+            key_target.set_keys(keys.keys)
+
+        if press == chip8_input.LONG:
+            break
+        if press == chip8_input.SHORT and rewinder is not None and rewinder.step_back():
+            print("Rewind: {}".format(rewinder.stats()))
+            if recorder is not None:
+                print("Recording stopped by rewind")
+                recorder = None
+                key_target = machine
+            scheduler.restart()
+
+        # Speed control from the encoder
+        if not debug and encoder != macropad.encoder:
+            speed = min(max(speed + macropad.encoder - encoder, 0),
+                        len(SPEED_SCALES) + len(TURBO_STEPS) - 1)
+            encoder = macropad.encoder
+            speed_label.text = set_speed(speed)
+            speed_label.hidden = False
+            speed_label_until = scheduler.periods + speed_label_frames
+            display.refresh()
+        elif not speed_label.hidden and scheduler.periods >= speed_label_until:
+            speed_label.hidden = True
+            display.refresh()
+
+        # execute chip8 instructions.  A ROM that overflows or underflows
+        # the stack, or reads or writes out of range, can't go on - say
+        # where and go back to the menu
+        try:
+            if debug:
+                # One instruction per step, timers tick every step
+                machine.run_cycles(1)
+                machine.tick_timers()
+                tick()
+                sound(machine.sound_timer > 0)
             else:
-                key_read = True
-                regs[inst_X] = key_value
-        elif inst_NN == 0x15:       # LD DT, Vx
-            # put value in Vx into delay timer
-            delay_timer = regs[inst_X]
-        elif inst_NN == 0x18:       # LD ST, Vx
-            # put value in Vx into sound timer
-            sound_timer = regs[inst_X]
-        elif inst_NN == 0x1E:        # ADD I, Vx
-            index_reg = index_reg + regs[inst_X]
-        elif inst_NN == 0x29:        # LD F, Vx
-            # Set I to the location of the sprite for Vx
-            index_reg = 0x50 + (5 * regs[inst_X])
-        elif inst_NN == 0x33:        # LD B, Vx
-            # Store BCD representation of Vx in locs I, I+1, I+2
-            memory[index_reg + 2] = regs[inst_X] % 10
-            memory[index_reg + 1] = int(regs[inst_X]/10) % 10
-            memory[index_reg] = int(regs[inst_X]/100) % 10
-        elif inst_NN == 0x55:       # LD [I], Vx
-            # Store values of V0 to Vx in memory starting at I
-            for x in range(inst_X+1):
-                memory[index_reg+x] = regs[x]
-        elif inst_NN == 0x65:       # LD Vx, [I]
-            #Read registers V0 to Vx from memory starting at I
-            for x in range(inst_X+1):
-                regs[x] = memory[index_reg + x]
-        else:
-            pass 
-
-    # Do timer stuff
-    # Timers get decremented if greater than zero every 1/60 s
-    #
-    if time.monotonic() - time_now >= 1/60:
-        if delay_timer > 0:
-            delay_timer -= 1
-        if sound_timer > 0:
-            sound_timer -= 1
-            macropad.start_tone(292)
-        else: 
-            macropad.stop_tone()
-        time_now = time.monotonic()
-
-    # Wait to slow down loop
-    time.sleep(1/900)
+                # One frame of instructions, one timer tick and the wait for
+                # the next frame
+                scheduler.run_frame()
+        except (IndexError, ValueError) as e:
+            print("ROM fault at pc {:#x}: {}".format(machine.pc, e))
+            break
+
+        if not debug:
+            if first_frame:
+                first_frame = False
+                print("Menu to first frame: {}ms, {} bytes free".format(
+                    (time.monotonic_ns() - selected) // 1000000, gc.mem_free()))
+            if show_speed and scheduler.periods % 60 == 0:
+                print("IPS: {}  FPS: {:.1f}  shown: {}/{}  dropped: {}  "
+                      "run: {}us  present: {}us".format(
+                          scheduler.ips, scheduler.fps, scheduler.presented,
+                          scheduler.frames, scheduler.dropped_frames,
+                          scheduler.run_ns // 1000, scheduler.present_ns // 1000))
+            if profile and scheduler.periods % 600 == 0:
+                profiler.print_report()
+            if autosave and scheduler.periods % autosave_frames == 0:
+                try:
+                    chip8_state.save_file(machine, state_file, state_buffer)
+                except (OSError, ValueError) as e:
+                    print("Autosave off: {}".format(e))
+                    autosave = False
+                scheduler.restart()
+            if recorder is not None and scheduler.periods % 600 == 0:
+                try:
+                    recorder.save(record_file)
+                except OSError as e:
+                    print("Recording off: {}".format(e))
+                    recorder = None
+                    key_target = machine
+                scheduler.restart()
+
+    # Session over - wrap up and back to the menu
+    macropad.stop_tone()
+    if profile:
+        profiler.print_report()
+        profiler.detach()
+    if recorder is not None:
+        try:
+            recorder.save(record_file)
+        except OSError as e:
+            print("Recording not saved: {}".format(e))
+    recorder = None
+    key_target = machine